@@ -4,89 +4,160 @@ Main program to operate the RaspiCar.
 
 File: raspicar.py
 - Class RaspiCar
-- Methods: run, start_lid, stop_lid, close
+- Methods: run, run_async, start_lid, stop_lid, close
+
+Usage: python3 raspicar.py [--sync]
+       --sync: fixed rate loop instead of the asyncio runtime
 
 SLW 20-06-2023
 """
 
 import os
+import sys
 import time
-import ydlidar_x2
 
-import raspicar_socket
 import raspicar_ioctrl
-import raspicar_motors
+import raspicar_scheduler
+# further subsystems are imported in RaspiCar.__init__, after the display shows the first message
 
 # Buttons
 BT_RED = 8
 BT_YELLOW = 4
 BT_GREEN = 2
 BT_BLUE = 1
+# latency of the socket: round trip of requests, one-way delay of pushed packets
+LATENCY_LABELS = {'request': "RTT", 'push': "Delay"}
 
 # Working directory
 workdir = os.path.join("/home", "stela", "Python", "RaspiCar")
 
 
 class RaspiCar:
-    def __init__(self):
+    def __init__(self, rate=10):
+        """ rate -> ticks per second of the main loop """
         # Operating values
         self._automode = False
         self._stop_system = False
         self._shutdown = False
         self._old_buttons = 0
         self._lid_is_active = False
+        self._lid_scan_seq = 0
+        self.loop = raspicar_scheduler.LoopScheduler(rate=rate)
+        self.runtime = None
+        # time (s) needed to import and initiate each subsystem
+        self.startup_times = {}
         # IoCtrl
+        start_time = time.perf_counter()
         self.io = raspicar_ioctrl.IoCtrl()
         self.io.clear_display()
         self.io.send_msg("RaspiCar 0.4")
+        self.startup_times['IoCtrl'] = time.perf_counter() - start_time
         time.sleep(0.4)
         # LiDAR
         self.io.send_msg("Initiating LiDAR")
-        self.lid = ydlidar_x2.YDLidarX2('/dev/serial0')
+        start_time = time.perf_counter()
+        import ydlidar_x2
+        import ydlidar_x2_filter
+        self.lid = ydlidar_x2.YDLidarX2('/dev/serial0', aligned=True)
+        self.lid.set_filter(ydlidar_x2_filter.ScanFilter(depth=3, method='median', outlier_dist=300))
         self.lid.connect()
+        self.startup_times['YDLidarX2'] = time.perf_counter() - start_time
         time.sleep(0.1)
         # Motors
         self.io.send_msg("Starting motors")
+        start_time = time.perf_counter()
+        import raspicar_motors
         self.mot = raspicar_motors.Motors(self.io)
+        self.startup_times['Motors'] = time.perf_counter() - start_time
         time.sleep(0.1)
         # Socket
         self.io.send_msg("Starting socket")
+        start_time = time.perf_counter()
+        import raspicar_socket
         self.sck = raspicar_socket.RaspiCarSocket()
+        self.startup_times['RaspiCarSocket'] = time.perf_counter() - start_time
         if not self.sck.okay:
             self.io.send_msg("Socket failure!")
             self._stop_system = True
             self.io.set_led_red(True)
         else:
             self.sck.send_msg("RaspiCar connected")
+            # the controller streams its data, get_data does not wait for a round trip
+            self.sck.subscribe(rate=20, on_change=True)
         time.sleep(0.2)
         
         
     def run(self):
+        loop = self.loop
+        loop.reset()
         while not self._stop_system:
             # Get input from the controller
-            success, buttons, x, y = self.sck.get_data()
+            with loop.phase('socket'):
+                success, buttons, x, y = self.sck.get_data()
             if not self.sck.okay:
                 self.io.send_msg("Socket no connection!")
                 self._stop_system = True
                 self.io.set_led_red(True)
                 break
             if success:
-                self.io.set_led_red(False)
-                if buttons > 0 and buttons != self._old_buttons:
-                    self._check_buttons(buttons)
+                with loop.phase('io'):
+                    self.io.set_led_red(False)
+                    if buttons > 0 and buttons != self._old_buttons:
+                        self._check_buttons(buttons)
                 self._old_buttons = buttons
                 if not self._automode:
-                    self.mot.run(x, y)
+                    with loop.phase('motors'):
+                        self.mot.run(x, y)
             else:
-                self.io.set_led_red(True)
-            # Get input from the LiDAR
-            if self._lid_is_active and self.lid.available:
-                sectors = self.lid.get_sectors40()
-                print(sectors[18 : 23])
-                
-            time.sleep(0.1)
+                with loop.phase('io'):
+                    self.io.set_led_red(True)
+            # Get input from the LiDAR (new scans only), left out after an overrun
+            if self._lid_is_active and not loop.degraded:
+                # one snapshot: the sectors and the sequence number belong to the same scan
+                distances, scan_seq, _ = self.lid.get_scan()
+                if scan_seq != self._lid_scan_seq:
+                    with loop.phase('lidar'):
+                        self._lid_scan_seq = scan_seq
+                        sectors = self.lid.get_sectors40(distances)
+                    print(sectors[18 : 23])
+            # Wait for the deadline of the next tick
+            loop.wait()
                     
                 
+    def run_async(self):
+        """ Runs the asyncio runtime: motor commands follow each controller packet """
+        import asyncio
+        import raspicar_async
+        self.runtime = raspicar_async.Runtime(self.io, self.mot, self.sck, self.lid)
+        self.runtime.on_buttons = self._check_buttons_async
+        self.runtime.on_scan = lambda sectors: print(sectors[18 : 23])
+        if self._stop_system:
+            return
+        try:
+            asyncio.run(self.runtime.run())
+        finally:
+            self._lid_is_active = self.runtime.lidar_active
+
+
+    async def _check_buttons_async(self, buttons):
+        """ Button actions of the runtime, see _check_buttons """
+        if buttons == (BT_BLUE | BT_GREEN) or self.io.shutdown:
+            self._stop_system = True
+            self.runtime.stop()
+        elif buttons == (BT_BLUE | BT_YELLOW):
+            self._stop_system = True
+            self._shutdown = True
+            self.runtime.stop()
+        elif buttons == BT_RED:
+            if self.runtime.lidar_active:
+                await self.runtime.stop_lidar()
+            else:
+                self.sck.send_msg("Starting LiDAR")
+                await self.runtime.start_lidar()
+        elif buttons == BT_YELLOW:
+            self._show_latency()
+
+
     def _check_buttons(self, buttons):
         if buttons == (BT_BLUE | BT_GREEN) or self.io.shutdown:
             self._stop_system = True
@@ -98,6 +169,15 @@ class RaspiCar:
                 self.stop_lid()
             else:
                 self.start_lid()
+        elif buttons == BT_YELLOW:
+            self._show_latency()
+
+
+    def _show_latency(self):
+        """ Shows the controller latency of the last minute on the controller display """
+        st = self.sck.get_latency_stats(window=True)
+        self.sck.send_msg("{:s} p50/99: {:.0f}/{:.0f} ms".format(LATENCY_LABELS[st['mode']], st['p50'], st['p99']))
+        self.sck.send_msg("Loss: {:.1f}% J: {:.0f}".format(st['loss_rate'] * 100, st['jitter']))
                 
                 
     def start_lid(self):
@@ -129,12 +209,13 @@ class RaspiCar:
         self.io.send_msg("Closing io_ctrl")
         self.io.close()
         if self.sck.okay:
+            label = LATENCY_LABELS['push' if self.sck.push else 'request']
             stats_data = self.sck.get_stats()
             self.sck.send_msg("Connection Stats")
             time.sleep(0.3)
             self.sck.send_msg("Cnt: {:d} ({:d})".format(stats_data[0], stats_data[1]))
             time.sleep(0.5)
-            msg = "Latency: {:d}-{:d}-{:d}".format(round(stats_data[2]), round(stats_data[3]), round(stats_data[4]))                                                     
+            msg = "{:s}: {:d}-{:d}-{:d}".format(label, round(stats_data[2]), round(stats_data[3]), round(stats_data[4]))                                                     
             self.sck.send_msg(msg)
         time.sleep(0.2)
         self.sck.send_msg("Connection closed")
@@ -153,23 +234,54 @@ class RaspiCar:
 os.chdir(workdir)
 
 rc = RaspiCar()
+for name, duration in rc.startup_times.items():
+    print("Startup {:s}: {:.0f} ms".format(name, duration * 1000))
 
 try:
-    rc.run()
+    if "--sync" in sys.argv:
+        rc.run()
+    else:
+        rc.run_async()
 except KeyboardInterrupt:
     pass
 
-stats = rc.sck.get_stats()
 print()
-print("Latency:")
-print("  Count:  {:d} (lost: {:d})".format(stats[0], stats[1]))
-print("  Timing: {:.1f} - {:.1f} - {:.1f} ms".format(stats[2], stats[3], stats[4]))
+for mode in ('request', 'push'):
+    stats = rc.sck.get_latency_stats(window=False, mode=mode)
+    if stats['count'] == 0 and stats['lost'] == 0:
+        continue
+    print("Latency ({:s}, {:s}):".format(mode, "round trip" if mode == 'request' else "one-way delay"))
+    print("  Count:  {:d} (lost: {:d}, {:.1f}%)".format(stats['count'], stats['lost'], stats['loss_rate'] * 100))
+    print("  Timing: {:.1f} - {:.1f} - {:.1f} ms, jitter {:.1f} ms".format(
+          stats['min'], stats['mean'], stats['max'], stats['jitter']))
+    print("  Percentiles: p50 {:.1f}, p90 {:.1f}, p99 {:.1f}, p99.9 {:.1f} ms".format(
+          stats['p50'], stats['p90'], stats['p99'], stats['p999']))
+    rc.sck.dump_stats("latency_stats_{:s}.json".format(mode), mode)
+if rc.runtime is not None:
+    st = rc.runtime.get_stats()
+    t = st['input_to_motor']
+    print("Runtime: packet to motor command p50 {:.2f}, p99 {:.2f}, max {:.2f} ms, watchdog stops: {:d}".format(
+          t['p50'], t['p99'], t['max'], st['watchdog']))
+    for name, dev in st['devices'].items():
+        print("  {:8s} calls: {:d}, timeouts: {:d}, skipped: {:d}, errors: {:d}".format(
+              name, dev['calls'], dev['timeouts'], dev['skipped'], dev['errors']))
+st = rc.loop.get_stats()
+if st['ticks'] > 0:
+    print("Main loop ({:.0f} Hz): {:d} ticks, {:d} overruns, {:d} skipped".format(
+          1 / rc.loop.period, st['ticks'], st['overruns'], st['skipped']))
+    for name, t in [('tick', st['tick']), ('lateness', st['lateness'])] + list(st['phases'].items()):
+        print("  {:8s} mean {:.1f}, p99 {:.1f}, max {:.1f} ms".format(name, t['mean'], t['p99'], t['max']))
+print("Serial lanes (queue/response mean-max ms):")
+for lane, st in rc.io.get_lane_stats().items():
+    print("  {:8s} sent: {:d}, coalesced: {:d}, dropped: {:d}, queue: {:.1f}-{:.1f}, response: {:.1f}-{:.1f}".format(
+          lane, st['sent'], st['coalesced'], st['dropped'],
+          st['queue_mean'], st['queue_max'], st['response_mean'], st['response_max']))
 print()
 
 if rc.shutdown:
     print("Preparing for shutdown")
     rc.io.send_msg("Shutting  down ...")
-    rc.io.send_ser("BX")
+    rc.io.start_shutdown()
     rc.close()
     time.sleep(0.3)
     os.popen("sudo shutdown -h now").read()
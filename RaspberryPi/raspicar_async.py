@@ -0,0 +1,390 @@
+"""
+Modul: raspicar_async.py
+asyncio runtime of the RaspiCar
+
+The controller socket, the status events of the motor driver, the LiDAR
+scans and the camera feed one event loop. The motor command follows each
+controller packet directly, instead of waiting for the next tick of a
+polling loop; a controller that does not stream is polled at POLL_RATE
+from the socket thread. The threads of IoCtrl and YDLidarX2 hand their
+events over with call_soon_threadsafe; the state of the runtime is owned
+by the loop.
+
+Blocking device calls run in one executor thread per device, with a
+timeout. While a timed out call is still running, further calls of the
+device are skipped, so a stalled device only loses its own updates and
+cannot stall motor control. A watchdog stops the motors when the
+controller data gets too old.
+
+- Class: Runtime
+- Methods: run, stop, start_lidar, stop_lidar, get_stats
+
+Usage: runtime = Runtime(io, mot, sck, lid)
+       asyncio.run(runtime.run())
+"""
+
+import time
+import asyncio
+import concurrent.futures
+
+import raspicar_ioctrl
+import raspicar_latency
+
+CONTROL_TIMEOUT = 0.1       # s, the controller task runs at least this often (lease renewal, timeouts)
+POLL_RATE = 20              # Hz, requests to a controller that does not stream
+MOTOR_TIMEOUT = 0.5         # s, the motors stop without controller data
+DEVICE_TIMEOUT = 0.5        # s, timeout of a blocking device call
+CAMERA_INTERVAL = 0.2       # s
+
+
+class _Device:
+    """ Executor thread of a blocking device, with timeout and call statistics """
+
+    def __init__(self, name, timeout=DEVICE_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self._running = None
+        self.calls, self.timeouts, self.skipped, self.errors = 0, 0, 0, 0
+
+
+    async def call(self, func, *args):
+        """ Runs func(*args) in the executor thread. Returns the result,
+            None on timeout, error or while a timed out call is still running. """
+        if self._running is not None and not self._running.done():
+            self.skipped += 1
+            return None
+        self.calls += 1
+        self._running = asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        # asyncio.wait neither cancels the call on timeout nor swallows a cancellation of the task
+        done, _ = await asyncio.wait({self._running}, timeout=self.timeout)
+        if not done:
+            self.timeouts += 1
+            return None
+        try:
+            return self._running.result()
+        except Exception as e:
+            self.errors += 1
+            print(" - runtime: {:s} failed:".format(self.name), e)
+        return None
+
+
+    def get_stats(self):
+        return {'calls': self.calls, 'timeouts': self.timeouts, 'skipped': self.skipped, 'errors': self.errors}
+
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class Runtime:
+
+    def __init__(self, io, mot, sck, lid=None, cam=None):
+        """ io -> IoCtrl, mot -> Motors, sck -> RaspiCarSocket (push mode: subscribe)
+            lid -> YDLidarX2 or None, cam -> CameraMeans or None """
+        self.io, self.mot, self.sck, self.lid, self.cam = io, mot, sck, lid, cam
+        self.on_buttons = None      # coroutine function(buttons), called on a button change
+        self.on_scan = None         # function(sectors), called with the sectors of each new scan
+        self.automode = False       # True: the controller does not drive the motors
+        self.sectors = None
+        self.camera_means = None
+        self.status = (None, '')
+        self._loop = None
+        self._tasks = []
+        self._button_task = None
+        self._lidar_active = False
+        self._old_buttons = 0
+        self._led_red = None
+        self._data_time = None
+        self._readable_time = None
+        self._reader = False
+        self._motors_stopped = True
+        self._watchdog_cnt = 0
+        self._socket_dev = _Device('socket', 2 * DEVICE_TIMEOUT)  # request timeout of the socket: 0.5 s
+        self._lidar_dev = _Device('lidar')
+        self._camera_dev = _Device('camera')
+        # time from the arrival of a controller packet (request mode: from the request) to the motor command
+        self._recorder = raspicar_latency.LatencyRecorder(max_latency=1.0)
+
+
+    async def run(self):
+        """ Runs the tasks until stop() is called or the socket fails """
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._readable = asyncio.Event()
+        self._scan = asyncio.Event()
+        self._add_reader()
+        self.io.subscribe(self._on_status_thread)
+        tasks = [self._control(), self._watchdog()]
+        if self.lid is not None:
+            self.lid.subscribe(self._on_scan_thread)
+            tasks.append(self._lidar())
+        if self.cam is not None:
+            tasks.append(self._camera())
+        self._tasks = [asyncio.create_task(t) for t in tasks]
+        for task in self._tasks:
+            task.add_done_callback(self._task_done)
+        try:
+            await self._stop.wait()
+        finally:
+            if self._button_task is not None:
+                self._tasks.append(self._button_task)
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._remove_reader()
+            self.io.unsubscribe(self._on_status_thread)
+            if self.lid is not None:
+                self.lid.unsubscribe(self._on_scan_thread)
+            for dev in (self._socket_dev, self._lidar_dev, self._camera_dev):
+                dev.close()
+            self._loop = None
+
+
+    def stop(self):
+        """ Ends run(), may be called from any thread """
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._stop.set)
+
+
+    def _task_done(self, task):
+        """ A task ending with an error stops the runtime """
+        if not task.cancelled() and task.exception() is not None:
+            print(" - runtime: task failed:", repr(task.exception()))
+            self._stop.set()
+
+
+    def _add_reader(self):
+        if not self._reader:
+            self._loop.add_reader(self.sck.fileno(), self._on_readable)
+            self._reader = True
+
+
+    def _remove_reader(self):
+        if self._reader:
+            self._loop.remove_reader(self.sck.fileno())
+            self._reader = False
+
+
+    def _on_readable(self):
+        """ Called by the loop when a controller packet arrives """
+        if self._readable_time is None:
+            self._readable_time = time.monotonic()
+        self._readable.set()
+
+
+    def _set_led_red(self, status):
+        if status != self._led_red:
+            self.io.set_led_red(status)
+            self._led_red = status
+
+
+    async def _control(self):
+        """ Controller task: sends the motor command on each controller packet,
+            polls the controller at POLL_RATE if it does not stream """
+        while True:
+            polled = not self.sck.push
+            if not polled:
+                await self._readable.wait()
+                self._readable.clear()
+                input_time, self._readable_time = self._readable_time, None
+                # reads the queued packets, does not block in push mode
+                data = self.sck.get_data()
+            else:
+                # request/response blocks: it runs in the socket thread, and the
+                # loop must not watch the socket meanwhile
+                self._remove_reader()
+                input_time = time.monotonic()
+                data = await self._socket_dev.call(self.sck.get_data)
+                if data is None:
+                    data = (False, 0, 0, 0)
+            if not self._process(*data, input_time):
+                return
+            if polled:
+                await asyncio.sleep(max(input_time + 1 / POLL_RATE - time.monotonic(), 0))
+
+
+    def _process(self, success, buttons, x, y, input_time):
+        """ Handles the controller data: LED, buttons and motor command.
+            Returns False if the socket failed. """
+        if not self.sck.okay:
+            print(" - runtime: socket no connection!")
+            self._set_led_red(True)
+            self._stop.set()
+            return False
+        self._set_led_red(not success)
+        if not success:
+            return True
+        self._data_time = time.monotonic()
+        if buttons > 0 and buttons != self._old_buttons:
+            self._buttons(buttons)
+        self._old_buttons = buttons
+        if not self.automode:
+            self.mot.run(x, y)
+            self._motors_stopped = False
+            if input_time is not None:
+                self._recorder.record(time.monotonic() - input_time)
+        return True
+
+
+    def _buttons(self, buttons):
+        """ Runs the button handler as task, ignores buttons while it is running """
+        if self.on_buttons is None or (self._button_task is not None and not self._button_task.done()):
+            return
+        self._button_task = asyncio.create_task(self.on_buttons(buttons))
+
+
+    async def _watchdog(self):
+        """ Wakes the controller task every CONTROL_TIMEOUT, stops the motors
+            when the controller data is older than MOTOR_TIMEOUT """
+        while True:
+            await asyncio.sleep(CONTROL_TIMEOUT)
+            self._readable.set()
+            if not self._motors_stopped and (self._data_time is None or
+                                             time.monotonic() - self._data_time > MOTOR_TIMEOUT):
+                print(" - runtime: no controller data, stopping motors")
+                self.mot.run(0, 0)
+                self._motors_stopped = True
+                self._watchdog_cnt += 1
+
+
+    def _on_status_thread(self, voltage, status):
+        """ Called by the status thread of IoCtrl """
+        try:
+            self._loop.call_soon_threadsafe(self._on_status, voltage, status)
+        except (AttributeError, RuntimeError):
+            pass        # runtime not running
+
+
+    def _on_status(self, voltage, status):
+        self.status = (voltage, status)
+        if status in raspicar_ioctrl.SHUTDOWN_REQUESTS:
+            # IoCtrl shuts the system down
+            print(" - runtime: shutdown requested ({:s})".format(status))
+            self._stop.set()
+
+
+    def _on_scan_thread(self, snapshot):
+        """ Called by the scan thread of YDLidarX2 """
+        try:
+            self._loop.call_soon_threadsafe(self._scan.set)
+        except (AttributeError, RuntimeError):
+            pass
+
+
+    async def _lidar(self):
+        """ LiDAR task: calculates the sectors of each new scan """
+        while True:
+            await self._scan.wait()
+            self._scan.clear()
+            if not self._lidar_active:
+                continue
+            sectors = await self._lidar_dev.call(self.lid.get_sectors40)
+            if sectors is not None:
+                self.sectors = sectors
+                if self.on_scan is not None:
+                    self.on_scan(sectors)
+
+
+    async def _camera(self):
+        """ Camera task: grid means of the camera image every CAMERA_INTERVAL """
+        while True:
+            means = await self._camera_dev.call(self.cam.get_means)
+            if means is not None:
+                self.camera_means = means
+            await asyncio.sleep(CAMERA_INTERVAL)
+
+
+    async def start_lidar(self):
+        self.io.set_lidar_pwr(True)
+        await asyncio.sleep(0.2)
+        await asyncio.to_thread(self.lid.start_scan)
+        await asyncio.sleep(0.5)
+        self._lidar_active = True
+
+
+    async def stop_lidar(self):
+        self._lidar_active = False
+        await asyncio.to_thread(self.lid.stop_scan)
+        await asyncio.sleep(0.3)
+        self.io.set_lidar_pwr(False)
+        await asyncio.sleep(0.3)
+
+
+    def get_stats(self):
+        """ Returns a dict: latency from controller packet to motor command (ms),
+            watchdog stops and the call statistics of the devices """
+        return {'input_to_motor': self._recorder.stats(window=False),
+                'watchdog': self._watchdog_cnt,
+                'devices': {dev.name: dev.get_stats()
+                            for dev in (self._socket_dev, self._lidar_dev, self._camera_dev)}}
+
+
+    @property
+    def lidar_active(self):
+        return self._lidar_active
+
+
+#- main program starts here ----------------------------------------------
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    import sys
+    import raspicar_motors
+    import raspicar_socket
+    import raspicar_scheduler
+    import raspicar_simulator
+    import raspicar_controller_emulator
+
+    # Age of the controller data at the motor command: fixed rate loop at 10 Hz
+    # against the runtime, with the controller emulator and the motor driver simulator
+    # Usage: python3 raspicar_async.py [seconds] [stream rate (Hz)]
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    rate = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    class MeasuredMotors:
+        """ Records the age of the controller data passed to Motors.run """
+        def __init__(self, mot, sck, emu):
+            self.mot, self.sck, self.emu = mot, sck, emu
+            self.recorder = raspicar_latency.LatencyRecorder(max_latency=1.0)
+        def run(self, x, y):
+            self.mot.run(x, y)
+            if self.sck.controller_time is not None:
+                self.recorder.record(time.monotonic() - self.emu.start_time - self.sck.controller_time / 1000)
+
+    for use_runtime in (False, True):
+        sim = raspicar_simulator.MotorDriverSimulator(latency=0.001, jitter=0.001, seed=1)
+        io = raspicar_ioctrl.IoCtrl(port=sim.port, gpio=raspicar_simulator.SimulatedPi())
+        emu = raspicar_controller_emulator.ControllerEmulator(
+            trajectory=raspicar_controller_emulator.circle(2.0), delay=0.002, jitter=0.003, seed=1)
+        sck = raspicar_socket.RaspiCarSocket(server_addr=emu.address)
+        sck.subscribe(rate=rate)
+        mot = MeasuredMotors(raspicar_motors.Motors(io), sck, emu)
+        if use_runtime:
+            runtime = Runtime(io, mot, sck)
+            async def main():
+                task = asyncio.create_task(runtime.run())
+                await asyncio.sleep(seconds)
+                runtime.stop()
+                await task
+            asyncio.run(main())
+        else:
+            loop = raspicar_scheduler.LoopScheduler(rate=10)
+            start_time = time.monotonic()
+            while time.monotonic() - start_time < seconds:
+                success, buttons, x, y = sck.get_data()
+                if success:
+                    mot.run(x, y)
+                loop.wait()
+        st = mot.recorder.stats(window=False)
+        print("{:s}: {:d} motor commands, data age ms: p50 {:.1f}, p90 {:.1f}, p99 {:.1f}, max {:.1f}".format(
+              "runtime" if use_runtime else "10 Hz loop", st['count'], st['p50'], st['p90'], st['p99'], st['max']))
+        if use_runtime:
+            print("  ", runtime.get_stats()['input_to_motor'])
+        mot.mot.stop()
+        sck.close()
+        emu.close()
+        io.close()
+        sim.close()
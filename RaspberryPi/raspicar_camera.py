@@ -1,14 +1,51 @@
 """ raspicar_camera.py
 
+Mean brightness of a grid of camera image cells, exact means from an
+integral image (see raspicar_camera_grid.py) or approximated by resizing.
+A capture thread grabs the frames and decodes each into a reused buffer
+(triple buffer: capture, latest, in use by the caller), so get_frame and
+get_means return the newest frame without waiting for the camera.
+
+With show_image a FrameViewer thread renders the frames at a capped frame
+rate: a frame is copied to the viewer only when it is due, the grid is
+drawn once into a mask and blended in, text and imshow run in the viewer.
+
+- Class: CameraMeans
+- Methods: get_frame, copy_frame, get_means, show_frame, close
+- Class: FrameViewer
+- Methods: post, close
+
 SLW 01-23-2023
 """
 
 import time
-import cv2
+import threading
+
+import numpy as np
+
+import raspicar_camera_grid
+
+cv2 = None      # OpenCV is imported on first use, see _load_cv2
+
+
+def _load_cv2():
+    """ Imports OpenCV, which takes seconds on a Raspberry Pi """
+    global cv2
+    if cv2 is None:
+        import cv2 as _cv2
+        cv2 = _cv2
+
 
 class CameraMeans:
     
-    def __init__(self, width=800, height=600, rows = 4, cols = 6):
+    def __init__(self, width=800, height=600, rows = 4, cols = 6, threaded=True, method='integral', scale=1,
+                 show_fps=10):
+        """ threaded -> frames are captured by a background thread,
+                        False: each call reads a frame from the camera
+            method -> 'integral': exact cell means, 'resize': resized frame (INTER_LINEAR)
+            scale -> integral method: the frame is downscaled by scale first
+            show_fps -> maximum frame rate of the viewer (show_image, show_frame) """
+        _load_cv2()
         # Calculate parameters
         self.width, self.height = width, height
         self.rows, self.cols = rows, cols
@@ -21,81 +58,264 @@ class CameraMeans:
         self.vid.set(cv2.CAP_PROP_FRAME_WIDTH, width)
         self.vid.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
         self.error = False
-        
+        self.method = method
+        self.grid = raspicar_camera_grid.GridStats(gray=True, scale=scale, variance=False)
+        self._show_fps = show_fps
+        self._viewer = None
+        # Frame buffers: the capture thread decodes into _back and swaps it with _ready,
+        # the caller gets _front, which is not written until its next call
+        self._front, self._ready, self._back = None, None, None
+        self._front_time, self._ready_time = None, None
+        self._new_frame = False
+        self._frame_cnt = 0
+        self._cond = threading.Condition()
+        self._threaded = threaded
+        self._running = threaded
+        if threaded:
+            self._thread = threading.Thread(target=self._capture, daemon=True)
+            self._thread.start()
+
+
+    def _read(self, buf):
+        """ Grabs a frame and decodes it into buf (None: allocates a buffer).
+            Returns the frame or None on a read error. """
+        if not self.vid.grab():
+            return None
+        res, frame = self.vid.retrieve(buf)
+        return frame if res else None
+
+
+    def _capture(self):
+        """ Capture thread: decodes each frame into the back buffer and publishes it """
+        while self._running:
+            frame = self._read(self._back)
+            if frame is None:
+                if self._running:
+                    print("Video stream read errror")
+                    self.error = True
+                break
+            with self._cond:
+                self._back, self._ready = self._ready, frame
+                self._ready_time = time.time()
+                self._new_frame = True
+                self._frame_cnt += 1
+                self._cond.notify_all()
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+
+    def _latest(self, timeout=1.0):
+        """ Returns the newest frame and its time, (None, None) without a frame.
+            Waits up to timeout for the first frame. """
+        if not self._threaded:
+            if self.error:
+                return None, None
+            frame = self._read(self._front)
+            if frame is None:
+                print("Video stream read errror")
+                self.vid.release()
+                self.error = True
+                return None, None
+            self._front, self._front_time = frame, time.time()
+            return self._front, self._front_time
+        with self._cond:
+            self._cond.wait_for(lambda: self._frame_cnt > 0 or not self._running, timeout)
+            if self.error or not self._running:
+                # the capture thread has ended, do not return a frozen frame
+                return None, None
+            if self._new_frame:
+                self._front, self._ready = self._ready, self._front
+                self._front_time = self._ready_time
+                self._new_frame = False
+            return self._front, self._front_time
+
+
     def get_frame(self):
-        _, frame = self.vid.read()
-        return frame
-    
-    def get_means(self, show_image = False):
-        if self.error:
-            return([0 for _ in range(self.rows * self.cols)])
+        """ Returns the newest frame and its time (time.time()). The frame stays
+            valid until the next call of get_frame, get_means or show_frame. """
+        return self._latest()
 
-        res, frame = self.vid.read()
 
-        if not res:
-            print("Video stream read errror")
-            self.vid.release()
-            self.error = True
+    def copy_frame(self, buf=None):
+        """ Copies the newest frame into buf (None or other shape: a new array),
+            for consumers besides the caller of get_frame / get_means, e.g. the
+            stream server. Returns the copy and its time, (None, None) without a frame. """
+        with self._cond:
+            if self._threaded and (self.error or not self._running):
+                return None, None
+            if self._new_frame:
+                frame, frame_time = self._ready, self._ready_time
+            else:
+                frame, frame_time = self._front, self._front_time
+            if frame is None:
+                return None, None
+            if buf is None or buf.shape != frame.shape or buf.dtype != frame.dtype:
+                buf = np.empty_like(frame)
+            # under the lock: the capture thread does not swap the buffers meanwhile
+            np.copyto(buf, frame)
+        return buf, frame_time
+    
+    def get_means(self, show_image = False):
+        frame, _ = self._latest()
+        if frame is None:
             return([0 for _ in range(self.rows * self.cols)])
 
         # Calculate mean values for each cell
-        reduced_frame = cv2.resize(frame, (self.cols, self.rows), interpolation=cv2.INTER_LINEAR)
-        means = reduced_frame.mean(axis=2).flatten()
+        if self.method == 'integral':
+            self.grid.update(frame)
+            means = self.grid.means(self.rows, self.cols).flatten()
+        else:
+            reduced_frame = cv2.resize(frame, (self.cols, self.rows), interpolation=cv2.INTER_LINEAR)
+            means = reduced_frame.mean(axis=2).flatten()
         means = (means - means.mean()).round().astype(int)
 
         if show_image:
-            # draw grid to frame
-            for row in range(1, self.rows):
-                cv2.line(frame, (0, self.y_boundaries[row]), (self.width, self.y_boundaries[row]), (255, 255, 255))
-            for col in range(1, self.cols):
-                cv2.line(frame, (self.x_boundaries[col], 0), (self.x_boundaries[col], self.height), (255, 255, 255))
-            # draw mean values to frame
-            cnt = 0
-            for row in range(self.rows):
-                for col in range(self.cols):
-                    cv2.putText(frame, str(round(means[cnt])),
-                                (self.x_boundaries[col] + self.x_offset, self.y_boundaries[row] + self.y_offset),
-                                self.font, 1, (255, 255, 255), 2)
-                    cnt += 1
-            cv2.imshow("Frame", frame)
-            cv2.waitKey(1)
+            self._show(frame, means)
         
         return means
     
     def show_frame(self):
-        res, frame = self.vid.read()
-
-        if not res:
-            print("Video stream read errror")
-            self.vid.release()
-            self.error = True
-            return
-            
-        cv2.imshow("Frame", frame)
-        cv2.waitKey(1)
-        return
-          
+        frame, _ = self._latest()
+        if frame is not None:
+            self._show(frame, None)
+
+
+    def _show(self, frame, means):
+        """ Passes the frame to the viewer thread, started on first use """
+        if self._viewer is None:
+            self._viewer = FrameViewer(self.rows, self.cols, self._show_fps)
+        self._viewer.post(frame, means)
+
+
+    @property
+    def frame_time(self):
+        """ time (time.time()) of the frame returned by the last call """
+        return self._front_time
+    
     
     def close(self):
+        if self._viewer is not None:
+            self._viewer.close()
+        if self._threaded:
+            self._running = False
+            self._thread.join(1)
         self.vid.release()
         cv2.destroyAllWindows()
 
-#=================================================================================
 
-duration = []
+class FrameViewer:
+    """ Shows frames with the grid and the cell means in a window, rendered by a thread """
+
+    def __init__(self, rows=4, cols=6, max_fps=10, name="Frame"):
+        _load_cv2()
+        self.rows, self.cols = rows, cols
+        self.name = name
+        self._interval = 1 / max_fps
+        self._next_time = 0.0
+        self.font = cv2.FONT_HERSHEY_SIMPLEX
+        self.x_offset, self.y_offset = 10, 30
+        # static overlay, built for the size of the first frame
+        self._shape = None
+        self._grid_pixels = None
+        self._text_pos = []
+        # frame buffers: post copies into _back and swaps it with _ready, the thread renders _shown
+        self._back, self._ready, self._shown = None, None, None
+        self._means = None
+        self._new_frame = False
+        self.posted, self.shown = 0, 0
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+
+    def post(self, frame, means=None):
+        """ Passes a frame and its cell means to the viewer, without waiting.
+            The frame is copied only if the viewer is due for a new one.
+            Returns True if the frame was taken. """
+        now = time.monotonic()
+        if now < self._next_time or not self._running:
+            return False
+        self._next_time = now + self._interval
+        buf = self._back
+        if buf is None or buf.shape != frame.shape:
+            buf = np.empty_like(frame)
+        np.copyto(buf, frame)
+        with self._cond:
+            self._back, self._ready = self._ready, buf
+            self._means = means
+            self._new_frame = True
+            self._cond.notify()
+        self.posted += 1
+        return True
+
+
+    def _overlay(self, shape):
+        """ Draws the grid once into a mask, precomputes the text positions """
+        height, width = shape[:2]
+        x_boundaries = [i * width // self.cols for i in range(self.cols + 1)]
+        y_boundaries = [i * height // self.rows for i in range(self.rows + 1)]
+        mask = np.zeros((height, width), np.uint8)
+        for row in range(1, self.rows):
+            cv2.line(mask, (0, y_boundaries[row]), (width, y_boundaries[row]), 255)
+        for col in range(1, self.cols):
+            cv2.line(mask, (x_boundaries[col], 0), (x_boundaries[col], height), 255)
+        self._grid_pixels = np.nonzero(mask)
+        self._text_pos = [(x_boundaries[col] + self.x_offset, y_boundaries[row] + self.y_offset)
+                          for row in range(self.rows) for col in range(self.cols)]
+        self._shape = shape
+
+
+    def _run(self):
+        """ Viewer thread: renders the newest frame, all GUI calls are made here """
+        while self._running:
+            with self._cond:
+                self._cond.wait_for(lambda: self._new_frame or not self._running, 0.1)
+                if not self._new_frame:
+                    continue
+                self._shown, self._ready = self._ready, self._shown
+                means = self._means
+                self._new_frame = False
+            frame = self._shown
+            if frame.shape != self._shape:
+                self._overlay(frame.shape)
+            frame[self._grid_pixels] = 255
+            if means is not None:
+                for pos, value in zip(self._text_pos, means):
+                    cv2.putText(frame, str(round(value)), pos, self.font, 1, (255, 255, 255), 2)
+            cv2.imshow(self.name, frame)
+            cv2.waitKey(1)
+            self.shown += 1
+        cv2.destroyWindow(self.name)
+
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(1)
+
+#=================================================================================
 
 if __name__ == "__main__":
-    cam = CameraMeans()
-    
-    for i in range(200):
-        start_time = time.time()
-        #cam.show_frame()
-        values = cam.get_means(show_image=True)
-        duration.append(time.time() - start_time)
-        # print(values)
-        time.sleep(0.1)
-                    
-    cam.close()
-    
-    print(round(1000 * sum(duration) / 200, 2), "ms")
-        
+
+    import sys
+
+    # duration of get_means and age of the frame, reading synchronously and with the capture thread
+    # Usage: python3 raspicar_camera.py [show]
+    show_image = len(sys.argv) > 1 and sys.argv[1] == "show"
+    for threaded in (False, True):
+        cam = CameraMeans(threaded=threaded)
+        duration, age = [], []
+        for i in range(200):
+            start_time = time.time()
+            values = cam.get_means(show_image=show_image)
+            duration.append(time.time() - start_time)
+            if cam.frame_time is not None:
+                age.append(start_time - cam.frame_time)
+            time.sleep(0.1)
+        cam.close()
+        print("{:s}: get_means {:.2f} ms, frame age {:.2f} ms".format(
+              "capture thread" if threaded else "synchronous", 1000 * sum(duration) / len(duration),
+              1000 * sum(age) / max(len(age), 1)))
@@ -0,0 +1,188 @@
+"""
+Modul: raspicar_camera_grid.py
+Grid statistics of camera frames from integral images
+
+update() builds one integral image (summed area table) of a frame, and one
+of the squared values if variances are needed. The sum over any rectangle
+then takes four lookups, so the exact means and variances of all cells of
+a grid cost O(1) per cell, and any number of grid layouts can be evaluated
+on the same frame. For speed the frame can be reduced to one gray plane
+(mean of the color channels) and downscaled by summing blocks of
+scale x scale pixels first; the variances are then those of the gray values
+or of the block means.
+
+- Class: GridStats
+- Methods: update, stats, means, boundaries
+
+Usage: grid = GridStats(gray=True)
+       grid.update(frame)
+       means, variances = grid.stats(rows=4, cols=6)
+"""
+
+import numpy as np
+
+
+class GridStats:
+
+    def __init__(self, gray=False, scale=1, variance=True):
+        """ gray -> one plane, the mean of the color channels
+            scale -> downscaling by summing blocks of scale x scale pixels
+            variance -> False: no integral image of the squares, stats returns no variances """
+        self._gray = gray
+        self._scale = scale
+        self._variance = variance
+        self._div = 1           # a plane value is the sum of _div pixel values
+        self._sum = None        # integral images (height + 1, width + 1, planes)
+        self._sq_sum = None
+        self._sq = None
+        self._height, self._width = 0, 0
+
+
+    def update(self, frame):
+        """ Builds the integral images of a frame (height, width[, channels], uint8) """
+        frame = np.asarray(frame)
+        if frame.ndim == 2:
+            frame = frame[:, :, None]
+        height, width, channels = frame.shape
+        s = self._scale
+        h, w = height // s * s, width // s * s
+        div = s * s
+        # the channels and blocks are summed by slices, much faster than sum(axis)
+        if self._gray and channels > 1:
+            div *= channels
+            frame = frame[:h, :w]
+            channel_planes = [frame[:, :, c] for c in range(channels)]
+            plane = channel_planes[0].astype(np.int32)
+            for p in channel_planes[1:]:
+                plane += p
+            plane = plane[:, :, None]
+        else:
+            plane = frame[:h, :w].astype(np.int32)
+        if s > 1:
+            blocks = plane[0::s, 0::s].copy()
+            for dy in range(s):
+                for dx in range(s):
+                    if dy or dx:
+                        blocks += plane[dy::s, dx::s]
+            plane = blocks
+        ph, pw, n = plane.shape
+        if self._sum is None or self._sum.shape != (ph + 1, pw + 1, n):
+            # buffers are reused while the frame size does not change
+            dtype = np.int32 if 255 * div * ph * pw < 2 ** 31 else np.int64
+            self._sum = np.zeros((ph + 1, pw + 1, n), dtype)
+            if self._variance:
+                self._sq_sum = np.zeros((ph + 1, pw + 1, n), np.int64)
+                self._sq = np.empty((ph, pw, n), np.int64)
+        self._div = div
+        self._height, self._width = h, w
+        self._integrate(plane, self._sum)
+        if self._variance:
+            np.multiply(plane, plane, out=self._sq)
+            self._integrate(self._sq, self._sq_sum)
+
+
+    def _integrate(self, plane, table):
+        inner = table[1:, 1:]
+        np.cumsum(plane, axis=0, out=inner)
+        np.cumsum(inner, axis=1, out=inner)
+
+
+    def boundaries(self, rows, cols):
+        """ Returns the cell boundaries (pixels) of a uniform grid: y (rows + 1), x (cols + 1) """
+        return ([i * self._height // rows for i in range(rows + 1)],
+                [i * self._width // cols for i in range(cols + 1)])
+
+
+    def _box(self, table, ys, xs):
+        """ Sums of the cells between the boundaries ys, xs (plane coordinates) """
+        t = table[np.ix_(ys, xs)]
+        return t[1:, 1:] - t[:-1, 1:] - t[1:, :-1] + t[:-1, :-1]
+
+
+    def stats(self, rows=4, cols=6, y_bounds=None, x_bounds=None):
+        """ Returns the means and variances (None without variance) of the cells,
+            arrays (rows, cols, planes). The grid is uniform, or given by the
+            boundaries y_bounds, x_bounds (pixels, ascending, including the edges). """
+        if y_bounds is None or x_bounds is None:
+            y_bounds, x_bounds = self.boundaries(rows, cols)
+        ys = np.asarray(y_bounds) // self._scale
+        xs = np.asarray(x_bounds) // self._scale
+        area = np.maximum(np.outer(np.diff(ys), np.diff(xs))[:, :, None] * self._div, 1)
+        means = self._box(self._sum, ys, xs) / area
+        if not self._variance:
+            return means, None
+        # the squares are summed over plane values (sums of _div pixel values)
+        variances = self._box(self._sq_sum, ys, xs) / (area * self._div) - means * means
+        return means, np.maximum(variances, 0)
+
+
+    def means(self, rows=4, cols=6):
+        """ Returns the cell means over all planes, array (rows, cols) """
+        means, _ = self.stats(rows, cols)
+        return means.mean(axis=2)
+
+
+#- main program starts here ----------------------------------------------
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    import time
+
+    try:
+        import cv2
+    except ImportError:
+        cv2 = None
+
+    # Exact cell means of the current resize based path and the integral image
+    # engine on a synthetic 800 x 600 frame: accuracy and duration per frame
+    rows, cols, n = 4, 6, 20
+    rnd = np.random.default_rng(0)
+    yy, xx = np.mgrid[0:600, 0:800]
+    frame = np.stack([(xx * 255 // 800), (yy * 255 // 600), (xx + yy) % 256], axis=2)
+    frame = np.clip(frame + rnd.normal(0, 30, frame.shape), 0, 255).astype(np.uint8)
+    frame[200:260, 300:420] = 255
+
+    def exact_means(frame, rows, cols):
+        h, w = frame.shape[:2]
+        return np.array([[frame[r * h // rows:(r + 1) * h // rows, c * w // cols:(c + 1) * w // cols].mean()
+                          for c in range(cols)] for r in range(rows)])
+
+    def timed(func):
+        start_time = time.perf_counter()
+        for _ in range(n):
+            result = func()
+        return result, (time.perf_counter() - start_time) / n * 1000
+
+    reference = exact_means(frame, rows, cols)
+    print("{:32s} {:>8s} {:>10s}".format("method", "ms/frame", "max error"))
+    if cv2 is not None:
+        means, ms = timed(lambda: cv2.resize(frame, (cols, rows), interpolation=cv2.INTER_LINEAR).mean(axis=2))
+        print("{:32s} {:8.2f} {:10.2f}".format("resize INTER_LINEAR", ms, abs(means - reference).max()))
+        means, ms = timed(lambda: cv2.resize(frame, (cols, rows), interpolation=cv2.INTER_AREA).mean(axis=2))
+        print("{:32s} {:8.2f} {:10.2f}".format("resize INTER_AREA", ms, abs(means - reference).max()))
+    else:
+        print("(OpenCV not installed, resize path not measured)")
+    for label, kwargs in [("integral color + variance", {}),
+                          ("integral gray + variance", {'gray': True}),
+                          ("integral gray", {'gray': True, 'variance': False}),
+                          ("integral gray, scale 2", {'gray': True, 'scale': 2, 'variance': False}),
+                          ("integral gray, scale 4", {'gray': True, 'scale': 4, 'variance': False})]:
+        grid = GridStats(**kwargs)
+        def run():
+            grid.update(frame)
+            return grid.means(rows, cols)
+        means, ms = timed(run)
+        print("{:32s} {:8.2f} {:10.2f}".format(label, ms, abs(means - reference).max()))
+    # further layouts on the same integral image
+    grid = GridStats(gray=True)
+    grid.update(frame)
+    layouts = [(4, 6), (3, 3), (1, 40), (12, 16)]
+    _, ms = timed(lambda: [grid.stats(r, c) for r, c in layouts])
+    print("{:d} layouts ({:d} cells) on one integral image: {:.3f} ms".format(
+          len(layouts), sum(r * c for r, c in layouts), ms))
+    means, variances = grid.stats(4, 6)
+    ys, xs = grid.boundaries(4, 6)
+    ref_var = np.array([[frame[ys[r]:ys[r + 1], xs[c]:xs[c + 1]].mean(axis=2).var()
+                         for c in range(6)] for r in range(4)])
+    print("variance max error (gray):", round(float(abs(variances[:, :, 0] - ref_var).max()), 4))
@@ -0,0 +1,270 @@
+"""
+Modul: raspicar_camera_stream.py
+HTTP streaming of the camera frames of CameraMeans (multipart MJPEG)
+
+A producer thread copies the newest frame of the camera at a fixed rate and
+encodes it once as JPEG, only while clients are connected. Each client has
+a queue of its own (default: one frame); when it is full, the oldest frame
+is dropped, so slow viewers only lose frames and never back up the capture
+or the other clients. The latency from the capture of a frame until it is
+written to the socket and the frame rate are recorded per client.
+
+Paths: /              page showing the stream
+       /stream.mjpg   multipart MJPEG stream
+       /snapshot.jpg  latest frame
+       /stats         statistics (json)
+
+- Class: CameraStreamServer
+- Methods: get_stats, close
+
+Usage: cam = raspicar_camera.CameraMeans()
+       server = CameraStreamServer(cam, port=8080)
+       ... view http://<raspicar>:8080/ in a browser
+"""
+
+import json
+import time
+import socket
+import threading
+import collections
+import http.server
+
+import raspicar_camera
+import raspicar_latency
+
+BOUNDARY = "FRAME"
+_PAGE = b"""<html><head><title>RaspiCar</title></head>
+<body style="margin:0; background:black"><img src="/stream.mjpg" style="width:100%"></body></html>"""
+
+
+class _Client:
+    """ Frame queue (drop oldest) and statistics of a stream client """
+
+    def __init__(self, address, depth=1):
+        self.address = "{:s}:{:d}".format(*address[:2])
+        self._queue = collections.deque(maxlen=depth)
+        self._cond = threading.Condition()
+        self._connect_time = time.monotonic()
+        self._send_times = collections.deque(maxlen=30)
+        self.sent, self.dropped = 0, 0
+        self.recorder = raspicar_latency.LatencyRecorder(window=10.0, slots=10, max_latency=5.0)
+
+
+    def put(self, item):
+        """ Queues an encoded frame, drops the oldest one if the queue is full """
+        with self._cond:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+            self._queue.append(item)
+            self._cond.notify()
+
+
+    def get(self, timeout):
+        """ Returns the oldest queued frame, None after timeout """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._queue, timeout):
+                return None
+            return self._queue.popleft()
+
+
+    def done(self, frame_time):
+        """ Records a frame sent completely """
+        self.sent += 1
+        self._send_times.append(time.monotonic())
+        self.recorder.record(time.time() - frame_time)
+
+
+    def get_stats(self):
+        times = self._send_times
+        fps = (len(times) - 1) / (times[-1] - times[0]) if len(times) > 1 and times[-1] > times[0] else 0.0
+        if times and time.monotonic() - times[-1] > 2.0:
+            fps = 0.0           # stalled
+        st = self.recorder.stats(window=True)
+        return {'address': self.address, 'connected': round(time.monotonic() - self._connect_time, 1),
+                'sent': self.sent, 'dropped': self.dropped, 'fps': round(fps, 1),
+                'latency_p50': st['p50'], 'latency_p99': st['p99'], 'latency_max': st['max']}
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    timeout = 10        # s, a client not taking data is closed after this time
+
+    def do_GET(self):
+        stream = self.server.stream
+        path = self.path.split('?')[0]
+        if path in ('/', '/index.html'):
+            self._send(200, 'text/html', _PAGE)
+        elif path == '/stream.mjpg':
+            stream._serve(self)
+        elif path == '/snapshot.jpg':
+            item = stream._snapshot()
+            if item is None:
+                self.send_error(503, "no frame")
+            else:
+                self._send(200, 'image/jpeg', item[0])
+        elif path == '/stats':
+            self._send(200, 'application/json', json.dumps(stream.get_stats(), indent=1).encode())
+        else:
+            self.send_error(404)
+
+
+    def _send(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CameraStreamServer:
+
+    def __init__(self, cam, host='0.0.0.0', port=8080, fps=10, quality=70, depth=1):
+        """ cam -> CameraMeans (threaded), frames are taken with copy_frame
+            host, port -> address to serve, '127.0.0.1': localhost only
+            fps -> maximum frame rate of the stream
+            quality -> JPEG quality (0 ... 100)
+            depth -> frames queued per client, the oldest is dropped when full """
+        raspicar_camera._load_cv2()
+        self._cv2 = raspicar_camera.cv2
+        self._cam = cam
+        self._interval = 1 / fps
+        self._params = [self._cv2.IMWRITE_JPEG_QUALITY, quality]
+        self._depth = depth
+        self._clients = []
+        self._lock = threading.Lock()
+        self._latest = None             # (jpeg bytes, frame time)
+        self._snapshot_wanted = threading.Event()
+        self._buf = None
+        self.encoded = 0
+        self._encode_time = raspicar_latency.LatencyRecorder(max_latency=1.0)
+        self._server = http.server.ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.stream = self
+        self._running = True
+        self._server_thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._producer = threading.Thread(target=self._produce, daemon=True)
+        self._server_thread.start()
+        self._producer.start()
+        print(" - camera stream: serving on http://{:s}:{:d}/".format(*self.address))
+
+
+    def _produce(self):
+        """ Producer thread: encodes the newest frame at the stream rate, while needed """
+        next_time = time.monotonic()
+        last_time = None
+        while self._running:
+            if self._clients or self._snapshot_wanted.is_set():
+                self._buf, frame_time = self._cam.copy_frame(self._buf)
+                if self._buf is not None and frame_time != last_time:
+                    last_time = frame_time
+                    start_time = time.perf_counter()
+                    res, jpeg = self._cv2.imencode('.jpg', self._buf, self._params)
+                    self._encode_time.record(time.perf_counter() - start_time)
+                    if res:
+                        item = (jpeg.tobytes(), frame_time)
+                        self._latest = item
+                        self.encoded += 1
+                        self._snapshot_wanted.clear()
+                        with self._lock:
+                            clients = list(self._clients)
+                        for client in clients:
+                            client.put(item)
+            # absolute deadlines, missed ones are skipped
+            next_time += self._interval
+            now = time.monotonic()
+            if next_time < now:
+                next_time = now
+            time.sleep(next_time - now)
+
+
+    def _snapshot(self):
+        """ Returns the latest encoded frame, waits for one if none is streamed """
+        if self._latest is None or not self._clients:
+            self._snapshot_wanted.set()
+            deadline = time.monotonic() + 2.0
+            while self._snapshot_wanted.is_set() and time.monotonic() < deadline:
+                time.sleep(self._interval / 2)
+        return self._latest
+
+
+    def _serve(self, handler):
+        """ Writes the stream to a client, runs in the thread of its request """
+        client = _Client(handler.client_address, self._depth)
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=' + BOUNDARY)
+        handler.send_header('Cache-Control', 'no-cache, private')
+        handler.send_header('Pragma', 'no-cache')
+        handler.end_headers()
+        with self._lock:
+            self._clients.append(client)
+        try:
+            while self._running:
+                item = client.get(1.0)
+                if item is None:
+                    continue
+                jpeg, frame_time = item
+                handler.wfile.write("--{:s}\r\nContent-Type: image/jpeg\r\nContent-Length: {:d}\r\n\r\n".format(
+                                    BOUNDARY, len(jpeg)).encode())
+                handler.wfile.write(jpeg)
+                handler.wfile.write(b"\r\n")
+                handler.wfile.flush()
+                client.done(frame_time)
+        except (ConnectionError, socket.timeout):
+            pass
+        finally:
+            with self._lock:
+                self._clients.remove(client)
+
+
+    def get_stats(self):
+        """ Returns a dict: encoded frames, encoding time (ms) and the statistics
+            of each client (frames sent and dropped, fps, latency in ms) """
+        st = self._encode_time.stats(window=False)
+        with self._lock:
+            clients = list(self._clients)
+        return {'encoded': self.encoded, 'encode_mean': st['mean'], 'encode_max': st['max'],
+                'clients': [client.get_stats() for client in clients]}
+
+
+    def close(self):
+        self._running = False
+        self._server.shutdown()
+        self._server.server_close()
+        self._producer.join(1)
+
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+
+#- main program starts here ----------------------------------------------
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    import sys
+
+    # Streams the camera, prints the client statistics every 5 s
+    # Usage: python3 raspicar_camera_stream.py [port] [fps]
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    fps = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    cam = raspicar_camera.CameraMeans()
+    server = CameraStreamServer(cam, port=port, fps=fps)
+    try:
+        while True:
+            time.sleep(5)
+            st = server.get_stats()
+            print("encoded: {:d}, encoding {:.1f} ms".format(st['encoded'], st['encode_mean']))
+            for c in st['clients']:
+                print("  {:s}: {:.1f} fps, sent {:d}, dropped {:d}, latency p50 {:.0f}, p99 {:.0f} ms".format(
+                      c['address'], c['fps'], c['sent'], c['dropped'], c['latency_p50'], c['latency_p99']))
+    except KeyboardInterrupt:
+        pass
+    server.close()
+    cam.close()
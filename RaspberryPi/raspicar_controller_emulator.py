@@ -0,0 +1,266 @@
+"""
+Modul: raspicar_controller_emulator.py
+Emulator of the RaspiCar controller (RaspiCar-Controller/MicroPython/main.py)
+
+Serves the UDP protocol of the controller on localhost: binary and ASCII
+data requests, streaming subscriptions and display messages. The joystick
+follows a scripted trajectory. Responses are delayed by a configurable
+delay and jitter (so they may be reordered) and lost with a configurable
+probability. Used with RaspiCarSocket(server_addr=emulator.address).
+
+- Class: ControllerEmulator
+- Methods: start, close
+- Functions: constant, sweep, circle, steps (trajectories)
+"""
+
+import math
+import time
+import heapq
+import random
+import socket
+import struct
+import threading
+
+import raspicar_socket
+
+# joystick midpoints (ADC values, 10 bit)
+ADC_X_MID, ADC_Y_MID = 455, 457
+ADC_RANGE = 450
+STREAM_KEEPALIVE = 0.2
+ADC_DEADBAND = 4
+_PACKET = struct.Struct("<BHIBHH")
+
+
+def constant(buttons=0, adcx=ADC_X_MID, adcy=ADC_Y_MID):
+    """ Trajectory: joystick at a fixed position """
+    return lambda t: (buttons, adcx, adcy)
+
+
+def sweep(period=4.0):
+    """ Trajectory: full speed forward and backward, straight """
+    def trajectory(t):
+        phase = (t % period) / period
+        return 0, ADC_X_MID, int(ADC_Y_MID + ADC_RANGE * (1 - 4 * abs(phase - 0.5)))
+    return trajectory
+
+
+def circle(period=4.0, radius=ADC_RANGE):
+    """ Trajectory: joystick moved in a circle """
+    def trajectory(t):
+        a = 2 * math.pi * t / period
+        return 0, int(ADC_X_MID + radius * math.cos(a)), int(ADC_Y_MID + radius * math.sin(a))
+    return trajectory
+
+
+def steps(points):
+    """ Trajectory: list of (duration in s, buttons, adcx, adcy), repeated """
+    total = sum(p[0] for p in points)
+    def trajectory(t):
+        t = t % total
+        for duration, buttons, adcx, adcy in points:
+            if t < duration:
+                return buttons, adcx, adcy
+            t -= duration
+        return points[-1][1:]
+    return trajectory
+
+
+class ControllerEmulator:
+
+    def __init__(self, host='127.0.0.1', port=0, trajectory=None, delay=0.0, jitter=0.0,
+                 loss=0.0, binary=True, seed=None):
+        """ host, port -> address to bind, port 0: any free port
+            trajectory -> function of the time (s) returning buttons, adcx, adcy
+            delay, jitter -> responses are sent after delay + random(0, jitter) s
+            loss -> probability of a lost response or stream packet
+            binary -> support binary packets and streaming (False: old controller) """
+        self._trajectory = trajectory if trajectory is not None else constant()
+        self._delay, self._jitter, self._loss = delay, jitter, loss
+        self._binary = binary
+        self._random = random.Random(seed)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((host, port))
+        self._socket.settimeout(0.05)
+        self._start_time = time.monotonic()
+        self._cond = threading.Condition()
+        self._queue = []            # heap of (send time, counter, data, address)
+        self._queue_cnt = 0
+        # stream state
+        self._stream_addr = None
+        self._stream_period, self._stream_on_change = 0.05, False
+        self._stream_end = self._stream_next = self._stream_sent = 0.0
+        self._stream_seq = 0
+        self._stream_last = None
+        # statistics and display messages
+        self.requests, self.sent, self.lost = 0, 0, 0
+        self.messages = []
+        self._running = False
+        self.start()
+
+
+    def start(self):
+        """ Starts the receiver and sender threads (called by __init__) """
+        if not self._running:
+            self._running = True
+            self._receiver = threading.Thread(target=self._receive, daemon=True)
+            self._sender = threading.Thread(target=self._send, daemon=True)
+            self._receiver.start()
+            self._sender.start()
+
+
+    def _state(self):
+        """ Returns buttons, adcx, adcy of the trajectory at the current time """
+        buttons, adcx, adcy = self._trajectory(time.monotonic() - self._start_time)
+        return buttons, min(max(int(adcx), 0), 1023), min(max(int(adcy), 0), 1023)
+
+
+    def _ticks_ms(self):
+        return int((time.monotonic() - self._start_time) * 1000) & 0xFFFFFFFF
+
+
+    def _enqueue(self, data, addr):
+        """ Schedules a datagram after the delay, or loses it """
+        if self._random.random() < self._loss:
+            self.lost += 1
+            return
+        send_time = time.monotonic() + self._delay + self._random.uniform(0, self._jitter)
+        with self._cond:
+            heapq.heappush(self._queue, (send_time, self._queue_cnt, data, addr))
+            self._queue_cnt += 1
+            self._cond.notify()
+
+
+    def _receive(self):
+        """ Receiver thread: answers requests like the main loop of the controller """
+        while self._running:
+            try:
+                message, addr = self._socket.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if not message:
+                continue
+            self.requests += 1
+            if message[0] == ord('b') and len(message) >= 4 and self._binary:
+                seq = message[2] | (message[3] << 8)
+                self._enqueue(_PACKET.pack(raspicar_socket.PACKET_VERSION, seq, self._ticks_ms(),
+                                           *self._state()), addr)
+            elif message[0] == ord('d'):
+                self._enqueue(bytes("{:d},{:d},{:d}".format(*self._state()), 'UTF-8'), addr)
+            elif message[0] == ord('s') and len(message) >= 5 and self._binary:
+                with self._cond:
+                    self._stream_addr = addr
+                    self._stream_period = 1 / max(message[2], 1)
+                    self._stream_on_change = (message[3] & raspicar_socket.STREAM_ON_CHANGE) != 0
+                    self._stream_end = time.monotonic() + message[4]
+                    self._cond.notify()
+            elif message[0] == ord('u'):
+                self._stream_addr = None
+            elif message[0] == ord('t'):
+                self.messages.append(message[1:].decode('UTF-8', errors='replace'))
+            elif message[0] == ord('x'):
+                self._running = False
+
+
+    def _stream(self, now):
+        """ Creates the next stream packet when due. Called with the lock held. """
+        if self._stream_addr is None or now < self._stream_next:
+            return
+        if now > self._stream_end:
+            self._stream_addr = None            # lease expired
+            return
+        self._stream_next = now + self._stream_period
+        state = self._state()
+        if self._stream_on_change and self._stream_last is not None and \
+           now - self._stream_sent < STREAM_KEEPALIVE and state[0] == self._stream_last[0] and \
+           abs(state[1] - self._stream_last[1]) <= ADC_DEADBAND and abs(state[2] - self._stream_last[2]) <= ADC_DEADBAND:
+            return
+        self._stream_seq = (self._stream_seq + 1) & 0xFFFF
+        self._stream_last, self._stream_sent = state, now
+        # the condition uses a reentrant lock, _enqueue may take it again
+        self._enqueue(_PACKET.pack(raspicar_socket.PACKET_VERSION, self._stream_seq,
+                                   self._ticks_ms(), *state), self._stream_addr)
+
+
+    def _send(self):
+        """ Sender thread: sends queued datagrams when due, creates stream packets """
+        with self._cond:
+            while self._running:
+                now = time.monotonic()
+                self._stream(now)
+                while self._queue and self._queue[0][0] <= now:
+                    _, _, data, addr = heapq.heappop(self._queue)
+                    try:
+                        self._socket.sendto(data, addr)
+                        self.sent += 1
+                    except OSError:
+                        pass
+                timeout = 0.05
+                if self._queue:
+                    timeout = min(timeout, self._queue[0][0] - now)
+                if self._stream_addr is not None:
+                    timeout = min(timeout, self._stream_next - now)
+                self._cond.wait(max(timeout, 0.0005))
+
+
+    def close(self):
+        """ Stops the threads and closes the socket """
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+        self._receiver.join(1)
+        self._sender.join(1)
+        self._socket.close()
+
+
+    @property
+    def address(self):
+        """ (ip address, port) to be passed to RaspiCarSocket """
+        return self._socket.getsockname()
+
+    @property
+    def start_time(self):
+        """ time.monotonic() at controller time 0 """
+        return self._start_time
+
+    @property
+    def streaming(self):
+        return self._stream_addr is not None
+
+
+#- main program starts here ----------------------------------------------
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    import sys
+
+    # Benchmark of RaspiCarSocket against the emulator at a high request rate
+    # Usage: python3 raspicar_controller_emulator.py [rate (Hz)] [seconds] [delay] [jitter] [loss]
+    rate = float(sys.argv[1]) if len(sys.argv) > 1 else 200
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    delay = float(sys.argv[3]) if len(sys.argv) > 3 else 0.002
+    jitter = float(sys.argv[4]) if len(sys.argv) > 4 else 0.003
+    loss = float(sys.argv[5]) if len(sys.argv) > 5 else 0.01
+    for push in (False, True):
+        emu = ControllerEmulator(trajectory=circle(2.0), delay=delay, jitter=jitter, loss=loss, seed=1)
+        sck = raspicar_socket.RaspiCarSocket(server_addr=emu.address)
+        if push:
+            sck.subscribe(rate=int(rate))
+        cnt, fail = 0, 0
+        start_time = next_time = time.perf_counter()
+        while time.perf_counter() - start_time < seconds and sck.okay:
+            success, buttons, x, y = sck.get_data()
+            cnt += 1
+            fail += 0 if success else 1
+            next_time += 1 / rate
+            time.sleep(max(next_time - time.perf_counter(), 0))
+        st = sck.get_latency_stats(window=False)
+        print("{:s}: {:d} calls ({:.0f} Hz), no data: {:d}, datagrams: {:d} requests, {:d} sent, {:d} lost".format(
+              "push" if push else "request", cnt, cnt / (time.perf_counter() - start_time), fail,
+              emu.requests, emu.sent, emu.lost))
+        print("  {:s} ms: p50 {:.2f}, p90 {:.2f}, p99 {:.2f}, p99.9 {:.2f}, max {:.2f}, jitter {:.2f}, loss {:.1f}%".format(
+              "one-way delay" if st['mode'] == 'push' else "round trip", st['p50'], st['p90'], st['p99'], st['p999'], st['max'], st['jitter'], st['loss_rate'] * 100))
+        sck.close()
+        emu.close()
@@ -1,21 +1,37 @@
 """
 Modul: raspicar_ioctrl2.py
 I/O interface for the RaspiCar
-Runs battery voltage control and system shut down as background processes
+Runs battery voltage control and system shut down as background processes.
+Status changes are pushed by the motor driver (command "PE1"), with firmware
+not supporting it the status is polled every second.
 This version 2 of IoCtrl is based on the RPi.GPIO library (and does not require PIGPIO)
 
 - Class: IoCtrl
-- Methods: send_msg, clear_display, set_led_green, set_led_red, set_lidar_pwr, close
+- Methods: send_ser, send_motor, start_shutdown, get_battery_status, send_msg, clear_display,
+           subscribe, unsubscribe, wait_for_status, get_status,
+           set_led_green, set_led_red, set_lidar_pwr, close
 
 SLW 02-12-2023
 """
 
-import RPi.GPIO as GPIO
 import time
 import serial
 import threading
 import os
 
+import raspicar_serial
+
+GPIO = None     # RPi.GPIO is imported on first use, see _load_gpio
+
+
+def _load_gpio():
+    """ Imports the RPi.GPIO library """
+    global GPIO
+    if GPIO is None:
+        import RPi.GPIO as _GPIO
+        GPIO = _GPIO
+
+
 """ Battery status:
 BAT_STATUS_EXTERN              0   // 'EX', external power supply
 BAT_STATUS_OK                  1   // 'OK', battery voltage okay
@@ -25,38 +41,56 @@ BAT_STATUS_SHUTDOWN_REQUESTED  4   // 'SR', the user has pressed shutdown, waiti
 BAT_STATUS_SHUTDOWN_PENDING    5   // 'SP', shutdown was confirmed, waiting for acknowledgment by Raspi
 """
 
+# status requesting the shutdown of the Raspberry Pi (firmware: 'SR' by the user,
+# 'SB' battery very low)
+SHUTDOWN_REQUESTS = ("SR", "SB", "SP")
+STATUS_HEARTBEAT = 10       # s, status poll interval while status events are enabled
+
+
 class IoCtrl:
        
-    def __init__(self):
-        GPIO.setwarnings(False)
-        GPIO.setmode(GPIO.BCM)
+    def __init__(self, binary=True, port="/dev/ttyUSB0", gpio=None):
+        """ binary -> use binary frames on the serial link if the motor driver supports them
+            port -> serial port of the motor driver
+            gpio -> GPIO backend like RPi.GPIO (e.g. raspicar_simulator.SimulatedGPIO),
+                    default: RPi.GPIO """
+        if gpio is None:
+            _load_gpio()
+            gpio = GPIO
+        self._gpio = gpio
+        self._gpio.setwarnings(False)
+        self._gpio.setmode(self._gpio.BCM)
         # pin definitions
         _PIN_LED_RED = 6
         _PIN_LED_GREEN = 13
         _PIN_LIDAR_PWR = 21
-        _serial_port = "/dev/ttyUSB0"
+        _serial_port = port
         # initiate ports
         self.pin_led_green, self.pin_led_red = _PIN_LED_GREEN, _PIN_LED_RED
         self.pin_lidar_pwr = _PIN_LIDAR_PWR
         # initiate operating data
-        self._ser_busy = False
         self.__shutdown = False
         self._status = "OK"
+        self._voltage = None
+        self._status_cond = threading.Condition()
+        self._status_changed = False
+        self._status_callbacks = []
+        self._system_shutdown = False
         # set port mode
-        GPIO.setup(self.pin_led_green, GPIO.OUT)
-        GPIO.setup(self.pin_led_red, GPIO.OUT)
-        GPIO.setup(self.pin_lidar_pwr, GPIO.OUT)
+        self._gpio.setup(self.pin_led_green, self._gpio.OUT)
+        self._gpio.setup(self.pin_led_red, self._gpio.OUT)
+        self._gpio.setup(self.pin_lidar_pwr, self._gpio.OUT)
         # set initial values
-        GPIO.output(self.pin_lidar_pwr, 0)
-        GPIO.output(self.pin_led_green, 0)
-        GPIO.output(self.pin_led_red, 0)
+        self._gpio.output(self.pin_lidar_pwr, 0)
+        self._gpio.output(self.pin_led_green, 0)
+        self._gpio.output(self.pin_led_red, 0)
         # initiate serial interface
         connection_cnt = 0
         connected = False
         while not connected and connection_cnt < 5:
             try:
                 self._ser = serial.Serial(_serial_port, baudrate=115200,
-                                      parity=serial.PARITY_NONE, timeout=1)
+                                      parity=serial.PARITY_NONE, timeout=0.1)
                 connected = True
             except:
                 msg = "warning: failed to open serial port" + str(connection_cnt)
@@ -67,71 +101,160 @@ class IoCtrl:
         if self._ser.isOpen() == False:
             err_msg = "Error: can't open serial port " + _serial_port
             raise Exception(err_msg)            
+        # pipelined command channel, responses are read by its own thread,
+        # commands are scheduled by priority (safety, motion, status, display)
+        self._channel = raspicar_serial.SerialChannel(self._ser)
+        self._scheduler = raspicar_serial.CommandScheduler(self._channel)
         time.sleep(0.5)
         self.send_ser(" ");
         time.sleep(0.5)
+        if binary:
+            self._channel.negotiate()
+        # status changes are pushed by the motor driver, if supported
+        self._channel.set_event_handler(self._on_status)
+        self._events = self.send_ser("PE1") == "OK"
         self.send_ser("DMRaspi connected")
         # starting thread
         self._t = threading.Thread(target = self._read_status)
         self._t.start()       
 
 
+    def _on_status(self, voltage, status):
+        """ Takes a status event or poll result, wakes the status thread on a change """
+        with self._status_cond:
+            if voltage is not None:
+                self._voltage = voltage
+            if status and status != self._status:
+                self._status = status
+                self._status_changed = True
+                self._status_cond.notify_all()
+
+
     def _read_status(self):
+        """ Status thread: reacts to status changes. With status events it polls
+            only as heartbeat, otherwise every second. """
+        interval = STATUS_HEARTBEAT if self._events else 1
+        next_poll = time.monotonic()
         while not self.__shutdown:
-            while self._ser_busy:
-                time.sleep(0.01)
-            self._status = self.send_ser("BS")[-2:]
-            if self._status == "SP":
-                print("Stopping motors ...")
-                self.send_ser("MR0,0")
-                time.sleep(0.1)
-                self.send_ser("MP0,0")
-                time.sleep(0.1)
-                print("Shutting down")
-                print(self.send_ser("BX"))
-                time.sleep(0.1)
-                os.popen("sudo shutdown -h now").read()
-                
-            time.sleep(1)
+            if time.monotonic() >= next_poll:
+                self._on_status(*self.get_battery_status())
+                next_poll = time.monotonic() + interval
+            with self._status_cond:
+                self._status_cond.wait_for(lambda: self._status_changed or self.__shutdown,
+                                           max(next_poll - time.monotonic(), 0))
+                changed, self._status_changed = self._status_changed, False
+                voltage, status = self._voltage, self._status
+            if not changed:
+                continue
+            for callback in list(self._status_callbacks):
+                try:
+                    callback(voltage, status)
+                except Exception as e:
+                    print(" - io_ctrl: status callback failed", e)
+            if status in SHUTDOWN_REQUESTS and not self._system_shutdown:
+                self._run_shutdown()
         print(" - io_ctrl: status thread closed ...")
 
 
+    def _run_shutdown(self):
+        self._system_shutdown = True
+        print("Stopping motors ...")
+        self.send_ser("MR0,0")
+        time.sleep(0.1)
+        self.send_ser("MP0,0")
+        time.sleep(0.1)
+        print("Shutting down")
+        print(self.send_ser("BX"))
+        time.sleep(0.1)
+        os.popen("sudo shutdown -h now").read()
+
+
+    def start_shutdown(self):
+        """ Shutdown started by the Raspberry Pi: sends BX to the motor driver.
+            The resulting status 'SB' does not trigger the shutdown thread again. """
+        self._system_shutdown = True
+        return self.send_ser("BX")
+
+
+    def subscribe(self, callback):
+        """ callback(voltage, status) is called by the status thread on each status change """
+        self._status_callbacks.append(callback)
+
+
+    def unsubscribe(self, callback):
+        if callback in self._status_callbacks:
+            self._status_callbacks.remove(callback)
+
+
+    def wait_for_status(self, timeout=None, status=None):
+        """ Waits until the status differs from status (default: the current status),
+            returns the new status ('' on timeout) """
+        with self._status_cond:
+            if status is None:
+                status = self._status
+            if self._status_cond.wait_for(lambda: self._status != status or self.__shutdown, timeout):
+                return self._status
+            return ''
+
+
     def get_status(self):
         return self._status
 
 
     def set_lidar_pwr(self, pwr):
         if pwr:
-            GPIO.output(self.pin_lidar_pwr, 1)
+            self._gpio.output(self.pin_lidar_pwr, 1)
         else:
-            GPIO.output(self.pin_lidar_pwr, 0)
+            self._gpio.output(self.pin_lidar_pwr, 0)
 
 
     def set_led_red(self, status):
         if status:
-            GPIO.output(self.pin_led_red, 1)
+            self._gpio.output(self.pin_led_red, 1)
         else:
-            GPIO.output(self.pin_led_red, 0)
+            self._gpio.output(self.pin_led_red, 0)
 
 
     def set_led_green(self, status):
         if status:
-            GPIO.output(self.pin_led_green, 1)
+            self._gpio.output(self.pin_led_green, 1)
         else:
-            GPIO.output(self.pin_led_green, 0)
-
-
-    def send_ser(self, msg, ser_delay=0.002):
-        while self._ser_busy == True:
-            time.sleep(ser_delay)
-        self._ser_busy = True
-        msg_bytes = bytes(msg + '\n', 'UTF-8')
-        self._ser.write(msg_bytes)
-        time.sleep(ser_delay)
-        response = self._ser.readline()
-        #response = bytes('OK', 'UTF-8')
-        self._ser_busy = False
-        return response[:-2].decode("UTF-8")
+            self._gpio.output(self.pin_led_green, 0)
+
+
+    def send_ser(self, msg, timeout=None):
+        """ Sends a command to the motor driver and waits for the response.
+            Returns the response without line end, '' in case of a timeout. """
+        return self._scheduler.request(msg, timeout)
+
+
+    def send_ser_async(self, msg):
+        """ Sends a command without waiting. Returns a future for the response. """
+        return self._scheduler.send(msg)
+
+
+    def send_motor(self, dir_a, dir_b, rpm_a, rpm_b, power):
+        """ Sets direction, speed and power of both motors with one binary frame.
+            Returns a future for the response. Requires binary frames, see binary. """
+        return self._scheduler.send(raspicar_serial.motor_payload(dir_a, dir_b, rpm_a, rpm_b, power),
+                                    frame_type=raspicar_serial.FRAME_MOTOR)
+
+
+    def get_battery_status(self, timeout=None):
+        """ Returns battery voltage (V) and status ('OK', 'BL', ...), (None, '') on timeout """
+        if self._channel.binary:
+            result = self._scheduler.request(b'', timeout, frame_type=raspicar_serial.FRAME_STATUS)
+            return result if result else (None, '')
+        result = self.send_ser("BS", timeout)
+        try:
+            return float(result[:-3]), result[-2:]
+        except ValueError:
+            return None, result[-2:]
+
+
+    def get_lane_stats(self):
+        """ Returns the queue and response latency per priority lane """
+        return self._scheduler.get_lane_stats()
     
     
     def send_msg(self, msg):
@@ -143,8 +266,12 @@ class IoCtrl:
       
     
     def close(self):
-        self.__shutdown = True
-        time.sleep(1.5)
+        with self._status_cond:
+            self.__shutdown = True
+            self._status_cond.notify_all()
+        self._t.join(2.5)
+        self._scheduler.close()
+        self._channel.close()
         self._ser.close()
         # self._shutdown = True
         
@@ -152,6 +279,21 @@ class IoCtrl:
     @property
     def shutdown(self):
         return self.__shutdown
+
+    @property
+    def voltage(self):
+        """ battery voltage (V) of the last status, None if unknown """
+        return self._voltage
+
+    @property
+    def events(self):
+        """ True if the motor driver pushes status changes """
+        return self._events
+
+    @property
+    def binary(self):
+        """ True if the serial link uses binary frames """
+        return self._channel.binary
         
     
 
@@ -0,0 +1,206 @@
+"""
+Modul: raspicar_latency.py
+Fixed memory latency recorder
+
+Latencies are counted in a log-bucketed histogram (like HdrHistogram):
+values below 2 * SUB_BUCKETS us are exact, above each power of two is split
+into SUB_BUCKETS buckets, so the relative error is below 1 / SUB_BUCKETS.
+The recorder keeps one histogram per time slot in a ring; statistics of the
+sliding window merge the slots, the totals cover the whole run. Memory does
+not grow with the run time.
+
+- Class: LatencyRecorder
+- Methods: record, record_loss, percentile, stats, dump, reset
+"""
+
+import json
+import time
+import threading
+
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def _index(value):
+    """ Returns the bucket of a value (us) """
+    shift = max(value.bit_length() - SUB_BITS - 1, 0)
+    return SUB_BUCKETS * shift + (value >> shift)
+
+
+def _value(index):
+    """ Returns the center (us) of a bucket """
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return ((index - SUB_BUCKETS * shift) << shift) + (1 << shift) / 2
+
+
+class _Slot:
+    """ Histogram and counters of one time slot """
+
+    def __init__(self, buckets):
+        self.counts = [0] * buckets
+        self.clear(0)
+
+    def clear(self, start):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.start = start
+        self.n, self.lost = 0, 0
+        self.sum, self.min, self.max = 0, None, None
+        self.diff_sum, self.diff_n = 0, 0
+
+    def add(self, other):
+        for i, c in enumerate(other.counts):
+            if c:
+                self.counts[i] += c
+        self.n += other.n
+        self.lost += other.lost
+        self.sum += other.sum
+        if other.n:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        self.diff_sum += other.diff_sum
+        self.diff_n += other.diff_n
+
+
+class LatencyRecorder:
+
+    def __init__(self, window=60.0, slots=12, max_latency=10.0):
+        """ window -> duration (s) of the sliding window, made of slots time slots
+            max_latency -> larger latencies (s) are counted as max_latency """
+        self._slot_time = window / slots
+        self._max_value = int(max_latency * 1e6)
+        self._buckets = _index(self._max_value) + 1
+        self._lock = threading.Lock()
+        self._slots = [_Slot(self._buckets) for _ in range(slots)]
+        self._total = _Slot(self._buckets)
+        self.reset()
+
+
+    def reset(self):
+        """ Clears all statistics """
+        with self._lock:
+            now = time.monotonic()
+            for slot in self._slots:
+                slot.clear(None)
+            self._total.clear(now)
+            self._last = None
+            self._jitter = 0.0
+
+
+    def _slot(self):
+        """ Returns the slot of the current time, clears it when reused. Called with the lock held. """
+        n = int(time.monotonic() // self._slot_time)
+        slot = self._slots[n % len(self._slots)]
+        if slot.start != n:
+            slot.clear(n)
+        return slot
+
+
+    def record(self, latency):
+        """ Adds a latency (s) """
+        value = min(max(int(latency * 1e6), 0), self._max_value)
+        index = _index(value)
+        with self._lock:
+            for slot in (self._slot(), self._total):
+                slot.counts[index] += 1
+                slot.n += 1
+                slot.sum += value
+                slot.min = value if slot.min is None else min(slot.min, value)
+                slot.max = value if slot.max is None else max(slot.max, value)
+                if self._last is not None:
+                    slot.diff_sum += abs(value - self._last)
+                    slot.diff_n += 1
+            if self._last is not None:
+                # interarrival jitter, smoothed like RFC 3550
+                self._jitter += (abs(value - self._last) - self._jitter) / 16
+            self._last = value
+
+
+    def record_loss(self):
+        """ Counts a lost request """
+        with self._lock:
+            self._slot().lost += 1
+            self._total.lost += 1
+
+
+    def _merged(self, window):
+        """ Returns the slot covering the window (True) or the whole run (False) """
+        if not window:
+            return self._total
+        merged = _Slot(self._buckets)
+        oldest = int(time.monotonic() // self._slot_time) - len(self._slots) + 1
+        for slot in self._slots:
+            if slot.start is not None and slot.start >= oldest:
+                merged.add(slot)
+        return merged
+
+
+    def _percentile(self, slot, q):
+        if slot.n == 0:
+            return 0.0
+        rank = max(q / 100 * slot.n, 1)
+        cnt = 0
+        for i, c in enumerate(slot.counts):
+            cnt += c
+            if cnt >= rank:
+                # the bucket center, limited by the exact extremes
+                return min(max(_value(i), slot.min), slot.max) / 1000
+        return slot.max / 1000
+
+
+    def percentile(self, q, window=True):
+        """ Returns the q-th percentile (ms) of the window or the whole run """
+        with self._lock:
+            return self._percentile(self._merged(window), q)
+
+
+    def stats(self, window=True):
+        """ Returns a dict of the window or the whole run: count, lost, loss rate,
+            min, mean, max, percentiles p50 ... p99.9 and jitter (ms) """
+        with self._lock:
+            slot = self._merged(window)
+            result = {'count': slot.n, 'lost': slot.lost,
+                      'loss_rate': round(slot.lost / (slot.n + slot.lost), 4) if slot.n + slot.lost else 0.0,
+                      'min': round(slot.min / 1000, 2) if slot.n else 0.0,
+                      'mean': round(slot.sum / slot.n / 1000, 2) if slot.n else 0.0,
+                      'max': round(slot.max / 1000, 2) if slot.n else 0.0}
+            for q in PERCENTILES:
+                result['p' + str(q).replace('.', '')] = round(self._percentile(slot, q), 2)
+            result['jitter'] = round(slot.diff_sum / slot.diff_n / 1000, 2) if slot.diff_n else 0.0
+            result['jitter_rfc3550'] = round(self._jitter / 1000, 2)
+        return result
+
+
+    def dump(self, filename):
+        """ Writes the statistics of the whole run and its histogram (ms, count) as json """
+        with self._lock:
+            histogram = [[round(_value(i) / 1000, 3), c] for i, c in enumerate(self._total.counts) if c]
+        with open(filename, "w") as f:
+            json.dump({'time': time.time(), 'total': self.stats(window=False),
+                       'window': self.stats(window=True), 'histogram': histogram}, f, indent=1)
+
+
+#- main program starts here ----------------------------------------------
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    import random
+
+    # accuracy against exact percentiles and cost per record
+    rec = LatencyRecorder()
+    rnd = random.Random(0)
+    values = [rnd.lognormvariate(-4.5, 0.6) for _ in range(100000)]
+    start_time = time.perf_counter()
+    for v in values:
+        rec.record(v)
+    duration = time.perf_counter() - start_time
+    values.sort()
+    for q in PERCENTILES:
+        exact = values[min(int(q / 100 * len(values)), len(values) - 1)] * 1000
+        print("p{:<5} exact: {:7.3f} ms, histogram: {:7.3f} ms".format(q, exact, rec.percentile(q)))
+    print("record: {:.2f} us, buckets: {:d}".format(duration / len(values) * 1e6, rec._buckets))
+    print(rec.stats())
@@ -36,6 +36,7 @@ class Motors:
         self._system_wait = 30
         self._old_buttons = 0
         self._last_cmd = ""
+        self._last_state = None
         self._old_button = 0
 
            
@@ -55,27 +56,45 @@ class Motors:
             self._mot_b = -self._mot_b
         else:
             dir_b = False
+        # commands are pipelined, run() does not wait for the responses
+        if self._io.binary:
+            self._run_frame(dir_a, dir_b)
+            return
         if self._mot_a > 0 or self._mot_b > 0:
             if self._mot_stop_cnt >= self._mot_stop_cutoff:
-                self._io.send_ser("MP1,1")
+                self._io.send_ser_async("MP1,1")
             self._mot_stop_cnt = 0
             cmd = "MR" + str(self._mot_a) + "," + str(self._mot_b)
         else:
             cmd = "MR0,0"
             self._mot_stop_cnt += 1
         if (dir_a != self._dir_a) or (dir_b != self._dir_b):
-            self._io.send_ser("MD{:d},{:d}".format(1 if dir_a else 0, 1 if dir_b else 0))
+            self._io.send_ser_async("MD{:d},{:d}".format(1 if dir_a else 0, 1 if dir_b else 0))
             self._dir_a = dir_a
             self._dir_b = dir_b
         if cmd != self._last_cmd:
-            self._io.send_ser(cmd)
+            self._io.send_ser_async(cmd)
             self._last_cmd = cmd
         if self._mot_stop_cnt == self._mot_stop_cutoff:
-            self._io.send_ser("MP0,0")
+            self._io.send_ser_async("MP0,0")
         if debug:
             print(cmd)
         
         
+    def _run_frame(self, dir_a, dir_b):
+        """ Sends direction, speed and power as one motor frame, if anything changed """
+        if self._mot_a > 0 or self._mot_b > 0:
+            self._mot_stop_cnt = 0
+        else:
+            self._mot_stop_cnt += 1
+        state = (dir_a, dir_b, self._mot_a, self._mot_b, self._mot_stop_cnt < self._mot_stop_cutoff)
+        if state != self._last_state:
+            self._io.send_motor(*state)
+            self._last_state = state
+        if debug:
+            print(state)
+
+
     def stop(self):
         self._io.send_ser("MR0,0")
         self._io.send_ser("MP0,0")
@@ -0,0 +1,135 @@
+"""
+Modul: raspicar_scheduler.py
+Fixed rate scheduler for the main loop of the RaspiCar
+
+Ticks start at absolute deadlines (start + n * period), so the period does
+not drift with the execution time of the loop. The execution time of each
+phase of a tick (socket, motors, lidar, io, ...) is recorded in a fixed
+memory histogram. A tick running longer than the period is an overrun:
+the missed deadlines are skipped (no burst of catch-up ticks) and the next
+tick runs degraded, so the loop can leave out optional work.
+
+- Class: LoopScheduler
+- Methods: phase, wait, get_stats, reset
+
+Usage: loop = LoopScheduler(rate=10)
+       while True:
+           with loop.phase('socket'):
+               ...
+           if not loop.degraded:
+               with loop.phase('lidar'):
+                   ...
+           loop.wait()
+"""
+
+import time
+import contextlib
+
+import raspicar_latency
+
+
+class LoopScheduler:
+
+    def __init__(self, rate=10.0, degrade_ticks=1):
+        """ rate -> ticks per second
+            degrade_ticks -> number of ticks running degraded after an overrun """
+        self._period = 1.0 / rate
+        self._degrade_ticks = degrade_ticks
+        self._phases = {}
+        self.reset()
+
+
+    def reset(self):
+        """ Restarts the deadlines and clears the statistics """
+        self._start_time = time.monotonic()
+        self._tick = 0
+        self._tick_start = self._start_time
+        self._ticks, self._overruns, self._skipped = 0, 0, 0
+        self._degraded_cnt = 0
+        self._tick_time = raspicar_latency.LatencyRecorder(max_latency=10 * self._period)
+        self._lateness = raspicar_latency.LatencyRecorder(max_latency=10 * self._period)
+        for recorder in self._phases.values():
+            recorder.reset()
+
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Context manager measuring the execution time of a phase of the tick """
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            recorder = self._phases.get(name)
+            if recorder is None:
+                recorder = self._phases[name] = raspicar_latency.LatencyRecorder(
+                    max_latency=10 * self._period)
+            recorder.record(time.monotonic() - start_time)
+
+
+    def wait(self):
+        """ Ends the tick and waits for the deadline of the next one.
+            Returns False if the tick overran its period. """
+        now = time.monotonic()
+        self._ticks += 1
+        self._tick_time.record(now - self._tick_start)
+        self._tick += 1
+        deadline = self._start_time + self._tick * self._period
+        on_time = now <= deadline
+        if not on_time:
+            # skip the missed deadlines, continue with the next one in the future
+            missed = int((now - deadline) / self._period) + 1
+            self._tick += missed
+            self._skipped += missed
+            self._overruns += 1
+            self._degraded_cnt = self._degrade_ticks
+            deadline = self._start_time + self._tick * self._period
+        elif self._degraded_cnt > 0:
+            self._degraded_cnt -= 1
+        time.sleep(max(deadline - time.monotonic(), 0))
+        self._tick_start = time.monotonic()
+        self._lateness.record(self._tick_start - deadline)
+        return on_time
+
+
+    def get_stats(self):
+        """ Returns a dict: ticks, overruns, skipped deadlines, tick time, wake-up
+            lateness and the time per phase (mean, p99, max in ms) """
+        def short(recorder):
+            st = recorder.stats(window=False)
+            return {'mean': st['mean'], 'p99': st['p99'], 'max': st['max']}
+        return {'ticks': self._ticks, 'overruns': self._overruns, 'skipped': self._skipped,
+                'tick': short(self._tick_time), 'lateness': short(self._lateness),
+                'phases': {name: short(recorder) for name, recorder in self._phases.items()}}
+
+
+    @property
+    def degraded(self):
+        """ True for degrade_ticks ticks after an overrun """
+        return self._degraded_cnt > 0
+
+    @property
+    def period(self):
+        return self._period
+
+
+#- main program starts here ----------------------------------------------
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    import random
+
+    # 100 ticks at 50 Hz, a phase of random duration overruns now and then
+    loop = LoopScheduler(rate=50)
+    rnd = random.Random(0)
+    start_time = time.monotonic()
+    for i in range(100):
+        with loop.phase('work'):
+            time.sleep(rnd.choice([0.002] * 9 + [0.03]))
+        if not loop.degraded:
+            with loop.phase('optional'):
+                time.sleep(0.005)
+        loop.wait()
+    print("duration: {:.3f} s (expected {:.3f} s)".format(time.monotonic() - start_time,
+                                                       (100 + loop.get_stats()['skipped']) * loop.period))
+    print(loop.get_stats())
@@ -0,0 +1,548 @@
+"""
+Modul: raspicar_serial.py
+Pipelined serial command channel to the rp2040 motor driver
+
+The motor driver answers every command line with exactly one response line,
+in the order the commands were received. The channel therefore writes
+commands without waiting for the previous response and matches the
+responses in order (FIFO) by a reader thread. Each command returns a
+future holding the response.
+To protect the small UART FIFO of the rp2040, the number of bytes in flight
+(sent, but not yet answered) is limited.
+
+Optionally the link uses binary frames, negotiated by the command "PB"
+(firmware without binary support rejects it, the channel stays ASCII):
+    SOF (0xA5) | LEN | TAG | PAYLOAD (LEN bytes) | CRC16 (little endian)
+TAG holds the frame type (bits 7..6) and a sequence number (bits 5..0).
+CRC-16/CCITT (init 0xFFFF) over LEN, TAG and PAYLOAD. The response carries
+the same TAG, so lost or corrupted frames only fail their own command.
+Frame types: ASCII command line, combined motor frame (dir, power and rpm of
+both motors) and status frame (battery voltage and status code).
+A motor frame (10 bytes) is as long as "MR300,300\n" and replaces the
+direction and power commands as well; its response is an empty frame
+(5 bytes), 2 bytes more than "OK\n" for the CRC and the sequence number.
+
+With "PE1" the motor driver pushes changes of the battery status without a
+request: as line "!BS<voltage>,<status>" or as status event frame. Events
+are passed to the event handler of the channel, not to a pending command.
+
+Commands are scheduled in priority lanes by the CommandScheduler:
+safety (stop) commands first, then motion, status and display commands.
+Superseded speed commands are coalesced, stale display updates dropped.
+
+- Class: SerialChannel
+- Methods: send, request, negotiate, set_event_handler, close
+- Class: CommandScheduler
+- Methods: send, request, get_lane_stats, close
+- Functions: classify, encode_frame, motor_payload
+"""
+
+import time
+import struct
+import binascii
+import threading
+import collections
+from concurrent.futures import Future
+
+# Priority lanes, lower number -> higher priority
+LANE_SAFETY = 0
+LANE_MOTION = 1
+LANE_STATUS = 2
+LANE_DISPLAY = 3
+LANE_NAMES = ('safety', 'motion', 'status', 'display')
+
+# Binary frames, the type is sent in the upper two bits of the tag
+FRAME_SOF = 0xA5
+FRAME_STATUS_EVENT = 0      # unsolicited status change (motor driver only), payload like a status response
+FRAME_ASCII = 1             # payload: command line, response: response line
+FRAME_MOTOR = 2             # payload: flags, rpm a, rpm b (uint16), response: empty, error code on error
+FRAME_STATUS = 3            # no payload, response: voltage (uint16, 10 mV), status code
+FRAME_SEQ_MASK = 0x3F
+MOTOR_DIR_A, MOTOR_DIR_B, MOTOR_POWER_A, MOTOR_POWER_B = 0x01, 0x02, 0x04, 0x08
+# battery status codes of the firmware (battery.h) and their ASCII names
+STATUS_CODES = ('OK', 'BL', 'SB', 'BE', 'SR', 'SX')
+_FRAME_HEADER = struct.Struct("<BB")        # LEN, TAG
+_MOTOR = struct.Struct("<BHH")
+_STATUS = struct.Struct("<hB")
+_BINARY_ACK = "OK,BIN1"
+
+
+def encode_frame(seq, frame_type, payload=b''):
+    """ Returns a complete frame """
+    body = _FRAME_HEADER.pack(len(payload), frame_type << 6 | seq & FRAME_SEQ_MASK) + payload
+    return bytes((FRAME_SOF,)) + body + struct.pack("<H", binascii.crc_hqx(body, 0xFFFF))
+
+
+def motor_payload(dir_a, dir_b, rpm_a, rpm_b, power):
+    """ Returns the payload of a motor frame (power -> both motors) """
+    flags = (MOTOR_DIR_A if dir_a else 0) | (MOTOR_DIR_B if dir_b else 0) | \
+            (MOTOR_POWER_A | MOTOR_POWER_B if power else 0)
+    return _MOTOR.pack(flags, min(int(rpm_a), 0xFFFF), min(int(rpm_b), 0xFFFF))
+
+
+def _decode_response(frame_type, payload):
+    """ Converts the payload of a response frame:
+        ASCII -> str, motor -> 'OK' or error, status -> (voltage in V, status name) """
+    if frame_type == FRAME_ASCII:
+        return payload.decode('UTF-8', errors='replace')
+    if frame_type == FRAME_MOTOR:
+        return 'OK' if not payload else 'Motor frame error'
+    if frame_type in (FRAME_STATUS, FRAME_STATUS_EVENT) and len(payload) == _STATUS.size:
+        voltage, code = _STATUS.unpack(payload)
+        return voltage / 100, STATUS_CODES[code] if code < len(STATUS_CODES) else '??'
+    return None
+
+
+class SerialChannel:
+
+    def __init__(self, ser, max_in_flight=32, response_timeout=1.0):
+        """ ser -> open serial port (or serial-like object with read, write, readline)
+            max_in_flight -> maximum number of bytes sent but not yet answered
+            response_timeout -> time (s) to wait for a response """
+        self._ser = ser
+        self._max_in_flight = max_in_flight
+        self._response_timeout = response_timeout
+        self._lock = threading.Lock()
+        self._space = threading.Condition(self._lock)
+        self._pending = collections.deque()     # (future, number of bytes, deadline)
+        self._pending_frames = collections.OrderedDict()    # seq -> (future, number of bytes, deadline)
+        self._in_flight = 0
+        self._binary = False                    # frames are sent
+        self._rx_binary = False                 # frames are received (switched by the reader)
+        self._seq = 0
+        self._running = True
+        self._timeout_cnt = 0
+        self._frame_error_cnt = 0
+        self._event_handler = None
+        self._reader = threading.Thread(target=self._read_responses, daemon=True)
+        self._reader.start()
+
+
+    def negotiate(self, timeout=None):
+        """ Switches to binary frames if the motor driver supports them.
+            Call it before other commands are sent. Returns True for binary frames. """
+        if not self._binary and self.request("PB", timeout) == _BINARY_ACK:
+            self._binary = True
+        return self._binary
+
+
+    def set_event_handler(self, handler):
+        """ handler(voltage, status) is called by the reader thread for each status
+            event (voltage in V, None if unknown). It must not block. """
+        self._event_handler = handler
+
+
+    def _event(self, voltage, status):
+        if self._event_handler is not None:
+            try:
+                self._event_handler(voltage, status)
+            except Exception as e:
+                print(" - serial channel: event handler failed", e)
+
+
+    def _line_event(self, line):
+        """ Decodes a status event line "!BS<voltage>,<status>" """
+        try:
+            voltage = float(line[3:-3])
+        except ValueError:
+            voltage = None
+        self._event(voltage, line[-2:])
+
+
+    def send(self, msg, frame_type=None):
+        """ Sends a command, returns a future for the response.
+            msg -> command line (str), or the payload (bytes) of a frame of frame_type
+            The response of a command line is a str without line end, see
+            _decode_response for the responses of frames.
+            Blocks only while the bytes in flight exceed the limit. """
+        future = Future()
+        if frame_type is not None and not self._binary:
+            future.set_exception(ValueError("binary frames not negotiated"))
+            return future
+        with self._space:
+            if self._binary:
+                seq = self._seq
+                self._seq = (self._seq + 1) & FRAME_SEQ_MASK
+                if frame_type is None:
+                    msg_bytes = encode_frame(seq, FRAME_ASCII, bytes(msg, 'UTF-8'))
+                else:
+                    msg_bytes = encode_frame(seq, frame_type, msg)
+            else:
+                msg_bytes = bytes(msg + '\n', 'UTF-8')
+            if not self._running:
+                future.set_exception(ConnectionError("serial channel closed"))
+                return future
+            self._space.wait_for(lambda: not self._running or self._in_flight == 0 or
+                                 self._in_flight + len(msg_bytes) <= self._max_in_flight)
+            if not self._running:
+                future.set_exception(ConnectionError("serial channel closed"))
+                return future
+            # write and enqueue under the lock, so the order of both is the same
+            entry = (future, len(msg_bytes), time.monotonic() + self._response_timeout)
+            if self._binary:
+                self._pending_frames[seq] = entry
+            else:
+                self._pending.append(entry)
+            self._in_flight += len(msg_bytes)
+            self._ser.write(msg_bytes)
+        return future
+
+
+    def request(self, msg, timeout=None, frame_type=None):
+        """ Sends a command and waits for the response. Returns '' on timeout. """
+        try:
+            return self.send(msg, frame_type).result(
+                timeout if timeout is not None else self._response_timeout + 0.5)
+        except Exception:
+            return ''
+
+
+    def _read_responses(self):
+        """ Reader thread: assigns each response line to the oldest pending command,
+            each response frame to the command with the same sequence number """
+        buf = b''
+        while self._running:
+            try:
+                if self._rx_binary:
+                    buf += self._ser.read(max(1, getattr(self._ser, 'in_waiting', 0)))
+                    buf = self._read_frames(buf)
+                else:
+                    buf += self._ser.readline()
+            except Exception as e:
+                if self._running:
+                    print(" - serial channel: read error", e)
+                    self._fail_pending(e)
+                break
+            if not self._rx_binary and buf.endswith(b'\n'):
+                line, buf = buf.rstrip(b'\r\n').decode('UTF-8', errors='replace'), b''
+                if line.startswith('!BS'):
+                    self._line_event(line)
+                    line = None
+                with self._space:
+                    if line is None:
+                        future = None
+                    elif self._pending:
+                        future, n, _ = self._pending.popleft()
+                        self._in_flight -= n
+                        self._space.notify_all()
+                    else:
+                        future = None
+                    # the motor driver sends frames from the next response on
+                    if line == _BINARY_ACK and not self._pending:
+                        self._rx_binary = True
+                if future is not None:
+                    future.set_result(line)
+            self._check_timeout()
+
+
+    def _read_frames(self, buf):
+        """ Decodes all complete frames in buf, returns the remaining bytes.
+            Bytes are skipped up to the next start of frame after a CRC error. """
+        while True:
+            start = buf.find(bytes((FRAME_SOF,)))
+            if start < 0:
+                return b''
+            buf = buf[start:]
+            if len(buf) < 1 + _FRAME_HEADER.size:
+                return buf
+            length, tag = _FRAME_HEADER.unpack_from(buf, 1)
+            seq, frame_type = tag & FRAME_SEQ_MASK, tag >> 6
+            end = 1 + _FRAME_HEADER.size + length
+            if len(buf) < end + 2:
+                return buf
+            if struct.unpack_from("<H", buf, end)[0] != binascii.crc_hqx(buf[1:end], 0xFFFF):
+                self._frame_error_cnt += 1
+                buf = buf[1:]
+                continue
+            payload, buf = buf[1 + _FRAME_HEADER.size : end], buf[end + 2:]
+            if frame_type == FRAME_STATUS_EVENT:
+                status = _decode_response(FRAME_STATUS_EVENT, payload)
+                if status is not None:
+                    self._event(*status)
+                continue
+            with self._space:
+                entry = self._pending_frames.pop(seq, None)
+                if entry is not None:
+                    self._in_flight -= entry[1]
+                    self._space.notify_all()
+            if entry is not None:
+                entry[0].set_result(_decode_response(frame_type, payload))
+
+
+    def _check_timeout(self):
+        """ Fails all pending commands if the oldest one was not answered in time.
+            Late responses could not be matched any more, so the input is flushed.
+            With frames only the commands not answered in time fail. """
+        now = time.monotonic()
+        with self._space:
+            expired = []
+            while self._pending_frames:
+                seq, entry = next(iter(self._pending_frames.items()))
+                if entry[2] > now:
+                    break
+                del self._pending_frames[seq]
+                self._in_flight -= entry[1]
+                expired.append(entry[0])
+            if expired:
+                self._timeout_cnt += len(expired)
+                self._space.notify_all()
+            line_timeout = self._pending and self._pending[0][2] <= now
+            if line_timeout:
+                self._timeout_cnt += 1
+        for future in expired:
+            future.set_exception(TimeoutError("no response from motor driver"))
+        if not line_timeout:
+            return
+        self._fail_pending(TimeoutError("no response from motor driver"))
+        try:
+            self._ser.reset_input_buffer()
+        except AttributeError:
+            pass
+
+
+    def _fail_pending(self, exc):
+        with self._space:
+            pending, self._pending = self._pending, collections.deque()
+            pending.extend(self._pending_frames.values())
+            self._pending_frames.clear()
+            self._in_flight = 0
+            self._space.notify_all()
+        for future, _, _ in pending:
+            future.set_exception(exc)
+
+
+    def close(self):
+        """ Stops the reader thread; pending commands fail """
+        with self._space:
+            self._running = False
+            self._space.notify_all()
+        self._reader.join(2)
+        self._fail_pending(ConnectionError("serial channel closed"))
+
+
+    @property
+    def pending(self):
+        return len(self._pending) + len(self._pending_frames)
+
+    @property
+    def timeout_cnt(self):
+        return self._timeout_cnt
+
+    @property
+    def frame_error_cnt(self):
+        return self._frame_error_cnt
+
+    @property
+    def binary(self):
+        return self._binary
+
+
+def command_key(msg, frame_type=None):
+    """ Returns the command as upper case text, 'MF' for motor and 'BS' for status frames """
+    if frame_type == FRAME_MOTOR:
+        return 'MF'
+    if frame_type == FRAME_STATUS:
+        return 'BS'
+    return msg.strip().upper()
+
+
+def classify(msg, frame_type=None):
+    """ Returns the lane of a motor driver command """
+    cmd = command_key(msg, frame_type)
+    if frame_type == FRAME_MOTOR:
+        # a frame with zero speed stops the car, with or without power (like MR0,0)
+        return LANE_SAFETY if not any(msg[1:]) else LANE_MOTION
+    if cmd in ("MR0,0", "MP0,0", "ME0,0", "BX"):
+        return LANE_SAFETY
+    if cmd.startswith('M'):
+        return LANE_MOTION
+    if cmd.startswith('D'):
+        return LANE_DISPLAY
+    return LANE_STATUS
+
+
+class _Command:
+    """ Queued command: message (or frame payload), frame type, key for coalescing, lane,
+        futures waiting for the response, time of enqueuing """
+
+    def __init__(self, msg, frame_type, lane, future):
+        self.msg = msg
+        self.frame_type = frame_type
+        self.key = command_key(msg, frame_type)
+        self.lane = lane
+        self.futures = [future]
+        self.enqueue_time = time.monotonic()
+
+
+class _LaneStats:
+    """ Fixed size statistics of a lane (times in s) """
+
+    def __init__(self):
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.queue_sum, self.queue_max = 0.0, 0.0
+        self.response_sum, self.response_max = 0.0, 0.0
+        self.responses = 0
+
+
+class CommandScheduler:
+
+    def __init__(self, channel, display_max_age=0.5):
+        """ channel -> SerialChannel
+            display_max_age -> display commands waiting longer (s) are dropped """
+        self._channel = channel
+        self._display_max_age = display_max_age
+        self._cond = threading.Condition()
+        self._lanes = [collections.deque() for _ in LANE_NAMES]
+        self._stats = [_LaneStats() for _ in LANE_NAMES]
+        self._running = True
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+
+    def send(self, msg, lane=None, frame_type=None):
+        """ Queues a command, returns a future for the response.
+            lane -> one of the LANE_* constants, default: classified by the command
+            frame_type -> msg is the payload of a binary frame of this type """
+        if lane is None:
+            lane = classify(msg, frame_type)
+        future = Future()
+        cmd = _Command(msg, frame_type, lane, future)
+        key = cmd.key
+        with self._cond:
+            if not self._running:
+                future.set_exception(ConnectionError("serial channel closed"))
+                return future
+            if key == 'MF':
+                # a motor frame sets the complete state and supersedes all queued motor state
+                self._coalesce(self._lanes[LANE_MOTION], cmd, ('MR', 'MP', 'MD', 'MF'))
+            elif lane == LANE_SAFETY and key.startswith('M'):
+                # a stop supersedes all queued speed and power commands
+                self._coalesce(self._lanes[LANE_MOTION], cmd, ('MR', 'MP', 'MF'))
+            elif lane == LANE_MOTION and key.startswith('MR'):
+                self._coalesce(self._lanes[LANE_MOTION], cmd, ('MR',))
+            elif lane == LANE_DISPLAY:
+                self._coalesce(self._lanes[LANE_DISPLAY], cmd, (key[:2],))
+            self._lanes[lane].append(cmd)
+            self._cond.notify_all()
+        return future
+
+
+    def _coalesce(self, queue, cmd, prefixes):
+        """ Removes queued commands starting with one of prefixes; their futures
+            get the response of cmd. Called with the lock held. """
+        keep = collections.deque()
+        for queued in queue:
+            if queued.key.startswith(prefixes):
+                cmd.futures.extend(queued.futures)
+                self._stats[queued.lane].coalesced += 1
+            else:
+                keep.append(queued)
+        queue.clear()
+        queue.extend(keep)
+
+
+    def request(self, msg, timeout=None, lane=None, frame_type=None):
+        """ Queues a command and waits for the response. Returns '' on timeout. """
+        try:
+            return self.send(msg, lane, frame_type).result(timeout if timeout is not None else 2.0)
+        except Exception:
+            return ''
+
+
+    def _next_command(self):
+        """ Returns the command with the highest priority, drops stale display commands.
+            Called with the lock held. """
+        now = time.monotonic()
+        display = self._lanes[LANE_DISPLAY]
+        while display and now - display[0].enqueue_time > self._display_max_age:
+            stale = display.popleft()
+            self._stats[LANE_DISPLAY].dropped += 1
+            for future in stale.futures:
+                future.set_result('')
+        for queue in self._lanes:
+            if queue:
+                return queue.popleft()
+        return None
+
+
+    def _dispatch(self):
+        """ Dispatcher thread: passes commands to the channel in order of priority """
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: not self._running or any(self._lanes))
+                if not self._running:
+                    break
+                cmd = self._next_command()
+            if cmd is None:
+                continue
+            sent_time = time.monotonic()
+            stats = self._stats[cmd.lane]
+            stats.sent += 1
+            stats.queue_sum += sent_time - cmd.enqueue_time
+            stats.queue_max = max(stats.queue_max, sent_time - cmd.enqueue_time)
+            # blocks while the channel has too many bytes in flight
+            self._channel.send(cmd.msg, cmd.frame_type).add_done_callback(lambda f, cmd=cmd: self._done(cmd, f))
+
+
+    def _done(self, cmd, future):
+        """ Passes the response to all futures waiting for the command """
+        latency = time.monotonic() - cmd.enqueue_time
+        stats = self._stats[cmd.lane]
+        stats.responses += 1
+        stats.response_sum += latency
+        stats.response_max = max(stats.response_max, latency)
+        exc = future.exception()
+        for f in cmd.futures:
+            if exc is not None:
+                f.set_exception(exc)
+            else:
+                f.set_result(future.result())
+
+
+    def get_lane_stats(self):
+        """ Returns a dict per lane: sent, coalesced, dropped, queued, mean and max queue
+            latency and mean and max response latency (ms) """
+        result = {}
+        with self._cond:
+            for lane, name in enumerate(LANE_NAMES):
+                st = self._stats[lane]
+                result[name] = {
+                    'sent': st.sent, 'coalesced': st.coalesced, 'dropped': st.dropped,
+                    'queued': len(self._lanes[lane]),
+                    'queue_mean': round(st.queue_sum * 1000 / st.sent, 2) if st.sent else 0.0,
+                    'queue_max': round(st.queue_max * 1000, 2),
+                    'response_mean': round(st.response_sum * 1000 / st.responses, 2) if st.responses else 0.0,
+                    'response_max': round(st.response_max * 1000, 2)}
+        return result
+
+
+    def close(self):
+        """ Stops the dispatcher; queued commands fail """
+        with self._cond:
+            self._running = False
+            queued = [cmd for queue in self._lanes for cmd in queue]
+            for queue in self._lanes:
+                queue.clear()
+            self._cond.notify_all()
+        self._dispatcher.join(2)
+        for cmd in queued:
+            for f in cmd.futures:
+                f.set_exception(ConnectionError("serial channel closed"))
+
+
+#- main program starts here ----------------------------------------------
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    # The lanes of the ASCII commands of Motors and of their motor frames must agree
+    pairs = [("drive", "MR300,200", motor_payload(True, False, 300, 200, True)),
+             ("zero speed, power on", "MR0,0", motor_payload(True, True, 0, 0, True)),
+             ("power off", "MP0,0", motor_payload(True, True, 0, 0, False))]
+    for label, cmd, payload in pairs:
+        lane_ascii, lane_frame = classify(cmd), classify(payload, FRAME_MOTOR)
+        print("{:22s} {:10s} {:8s} frame {:8s}".format(label, cmd, LANE_NAMES[lane_ascii], LANE_NAMES[lane_frame]))
+        assert lane_ascii == lane_frame, "lanes differ: " + label
+    print("ASCII commands and motor frames are scheduled in the same lanes")
@@ -0,0 +1,410 @@
+"""
+Modul: raspicar_simulator.py
+Simulator of the rp2040 motor driver on a pseudo terminal
+
+Implements the command set of rp2040_motor_driver.ino: motor (M*), display (D*),
+battery (B*) and protocol (P*) commands, ASCII lines as well as binary frames,
+and the status events pushed after "PE1".
+The simulator serves a pty; its port name is passed to IoCtrl in place of
+/dev/ttyUSB0, so IoCtrl, Motors and the serial stack run without the car.
+Configurable: baud rate pacing, response latency and injected faults
+(dropped and corrupted responses).
+
+- Class: MotorDriverSimulator
+- Methods: start, set_battery, set_faults, close
+- Class: SimulatedPi (GPIO backend for raspicar_ioctrl, like pigpio.pi)
+- Class: SimulatedGPIO (GPIO backend for raspicar_ioctrl2, like RPi.GPIO)
+
+Usage: sim = MotorDriverSimulator(latency=0.002)
+       io = raspicar_ioctrl.IoCtrl(port=sim.port, gpio=SimulatedPi())
+"""
+
+import os
+import pty
+import tty
+import time
+import random
+import select
+import struct
+import binascii
+import threading
+
+import raspicar_serial
+
+# battery status codes (battery.h)
+STATUS_OK = 0
+STATUS_BAT_LOW = 1
+STATUS_BAT_SHUTDOWN = 2
+STATUS_BAT_EXTERNAL = 3
+STATUS_SHUTDOWN_REQUESTED = 4
+STATUS_SHUTDOWN_ACTIVE = 5
+
+BUF_SIZE = 40           # input buffer of the firmware, longer lines are truncated
+_BITS_PER_BYTE = 10     # start bit, 8 data bits, stop bit
+
+
+class MotorDriverSimulator:
+
+    def __init__(self, baudrate=115200, latency=0.0, jitter=0.0, drop_rate=0.0,
+                 corrupt_rate=0.0, binary=True, seed=None):
+        """ baudrate -> transfer time of each byte is paced to this rate, None: no pacing
+            latency, jitter -> processing time (s) of a command: latency + random(0, jitter)
+            drop_rate -> probability of a command without response
+            corrupt_rate -> probability of a response with a flipped bit
+            binary -> support binary frames (False: behaves like the old firmware) """
+        self._baudrate = baudrate
+        self._latency, self._jitter = latency, jitter
+        self._drop_rate, self._corrupt_rate = drop_rate, corrupt_rate
+        self._binary_support = binary
+        self._random = random.Random(seed)
+        self._binary = False
+        self._switch_binary = None          # protocol switch after the response
+        self._events = False
+        self._event_pending = False         # report the status after enabling events
+        self._write_lock = threading.Lock()
+        # motor driver state
+        self.dir = [False, False]
+        self.enabled = [False, False]
+        self.power = [False, False]
+        self.rpm = [0, 0]
+        self.title, self.message = "", ""
+        self.voltage = 11.52
+        self.status = STATUS_OK
+        # statistics
+        self.command_cnt = 0
+        self.frame_cnt = 0
+        self.dropped_cnt = 0
+        self.corrupted_cnt = 0
+        self.rx_bytes, self.tx_bytes = 0, 0
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self._port = os.ttyname(self._slave)
+        self._running = False
+        self._t = None
+        self.start()
+
+
+    def start(self):
+        """ Starts the simulator thread (called by __init__) """
+        if not self._running:
+            self._running = True
+            self._t = threading.Thread(target=self._run, daemon=True)
+            self._t.start()
+
+
+    def set_battery(self, voltage=None, status=None):
+        """ Sets battery voltage (V) and status code (STATUS_*) """
+        if voltage is not None:
+            self.voltage = voltage
+        if status is not None and status != self.status:
+            self.status = status
+            self._send_event()
+
+
+    def _send_event(self):
+        """ Pushes the battery status if events are enabled """
+        if not self._events:
+            return
+        if self._binary:
+            self._write(raspicar_serial.encode_frame(0, raspicar_serial.FRAME_STATUS_EVENT,
+                        struct.pack("<hB", int(round(self.voltage * 100)), self.status)))
+        else:
+            self._write(bytes("!BS{:.2f},{:s}\r\n".format(
+                self.voltage, raspicar_serial.STATUS_CODES[self.status]), 'UTF-8'))
+
+
+    def set_faults(self, drop_rate=None, corrupt_rate=None, latency=None, jitter=None):
+        """ Changes the injected faults and the latency while running """
+        if drop_rate is not None:
+            self._drop_rate = drop_rate
+        if corrupt_rate is not None:
+            self._corrupt_rate = corrupt_rate
+        if latency is not None:
+            self._latency = latency
+        if jitter is not None:
+            self._jitter = jitter
+
+
+    def _byte_time(self, n):
+        return n * _BITS_PER_BYTE / self._baudrate if self._baudrate else 0.0
+
+
+    def _run(self):
+        """ Simulator thread: receives, decodes and answers commands """
+        line, frame = bytearray(), bytearray()
+        rx_done = time.monotonic()          # time the last received byte has arrived
+        while self._running:
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                data = os.read(self._master, 256)
+            except OSError:
+                break
+            self.rx_bytes += len(data)
+            rx_done = max(rx_done, time.monotonic()) + self._byte_time(len(data))
+            for c in data:
+                if self._binary:
+                    frame.append(c)
+                    frame = self._add_to_frame(frame, rx_done)
+                elif c in (10, 13):
+                    self._wait_until(rx_done)
+                    self._command(bytes(line[:BUF_SIZE - 1]).decode('UTF-8', errors='replace'))
+                    line.clear()
+                elif c == 8:
+                    del line[-1:]
+                else:
+                    line.append(c)
+
+
+    def _wait_until(self, rx_done):
+        """ Waits until the command has been received completely and processed """
+        delay = rx_done - time.monotonic() + self._latency + self._random.uniform(0, self._jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+
+    def _write(self, data):
+        """ Sends a response, applies the injected faults and the baud rate pacing """
+        with self._write_lock:
+            if self._random.random() < self._drop_rate:
+                self.dropped_cnt += 1
+                return
+            if data and self._random.random() < self._corrupt_rate:
+                data = bytearray(data)
+                data[self._random.randrange(len(data))] ^= 1 << self._random.randrange(8)
+                self.corrupted_cnt += 1
+            time.sleep(self._byte_time(len(data)))
+            self.tx_bytes += len(data)
+            os.write(self._master, bytes(data))
+
+
+    def _command(self, cmd):
+        """ Decodes an ASCII command line and sends the response line """
+        self.command_cnt += 1
+        self._write(bytes(self._decode_command(cmd) + "\r\n", 'UTF-8'))
+        self._after_response()
+
+
+    def _after_response(self):
+        """ Switches the protocol and reports the status after "PE1", like the firmware """
+        if self._switch_binary is not None:
+            self._binary, self._switch_binary = self._switch_binary, None
+        if self._event_pending:
+            self._event_pending = False
+            self._send_event()
+
+
+    def _decode_command(self, cmd):
+        """ Returns the response to a command, like decode_command of the firmware """
+        text = cmd.lstrip(' ')
+        if not text:
+            return ""
+        group, sub = text[0].upper(), text[1:2].upper()
+        if group == 'M':
+            if sub in ('D', 'E', 'P', 'R'):
+                a, b = self._get_ints(text[2:])
+                for i, value in enumerate((a, b)):
+                    if value is None:
+                        continue
+                    if sub == 'D':
+                        self.dir[i] = value > 0
+                    elif sub == 'E':
+                        self.enabled[i] = value > 0
+                    elif sub == 'P':
+                        self.power[i] = value > 0
+                    else:
+                        self.rpm[i] = max(value, 0)
+                        if value > 0:
+                            self.enabled[i] = True
+                return "OK"
+            return "Motor command not recognized: " + cmd
+        if group == 'D':
+            if sub == 'C':
+                self.title, self.message = "", ""
+            elif sub == 'T':
+                self.title = cmd[2:]
+            elif sub == 'M':
+                self.message = cmd[2:]
+            else:
+                return "Display command not recognized: " + cmd
+            return "OK"
+        if group == 'B':
+            if sub == 'V':
+                return "{:.2f}".format(self.voltage)
+            if sub == 'S':
+                return "{:.2f},{:s}".format(self.voltage, raspicar_serial.STATUS_CODES[self.status])
+            if sub == 'X':
+                # Battery::start_shutdown sets status 2 ('SB'), reported as event like a change
+                self.message = "Shutting down"
+                if self.status != STATUS_BAT_SHUTDOWN:
+                    self.status = STATUS_BAT_SHUTDOWN
+                    self._event_pending = True
+                return "OK"
+            return "Battery command not recognized: " + cmd
+        if group == 'P' and self._binary_support:
+            if sub == 'B':
+                self._switch_binary = True
+                return "OK,BIN1"
+            if sub == 'A':
+                self._switch_binary = False
+                return "OK"
+            if sub == 'E':
+                self._events = (self._get_ints(text[2:])[0] or 0) > 0
+                self._event_pending = self._events
+                return "OK"
+            return "Protocol command not recognized: " + cmd
+        return "Not recognized: " + cmd
+
+
+    def _get_ints(self, text):
+        """ Returns two integers separated by comma, None for a missing value """
+        values = []
+        for part in (text.split(',') + ['', ''])[:2]:
+            try:
+                values.append(int(part.strip()))
+            except ValueError:
+                values.append(None)
+        return values
+
+
+    def _add_to_frame(self, frame, rx_done):
+        """ Decodes the frame when complete, returns the remaining bytes """
+        start = frame.find(raspicar_serial.FRAME_SOF)
+        if start < 0:
+            return bytearray()
+        del frame[:start]
+        if len(frame) < 3 or len(frame) < 5 + frame[1]:
+            return frame
+        n, seq, frame_type = frame[1], frame[2] & raspicar_serial.FRAME_SEQ_MASK, frame[2] >> 6
+        body, crc = bytes(frame[1 : 3 + n]), frame[3 + n] | frame[4 + n] << 8
+        del frame[:5 + n]
+        if crc != binascii.crc_hqx(body, 0xFFFF):
+            return frame                    # dropped like the firmware does
+        self._wait_until(rx_done)
+        self._decode_frame(seq, frame_type, body[2:])
+        return frame
+
+
+    def _decode_frame(self, seq, frame_type, payload):
+        """ Answers a frame, like decode_frame of the firmware """
+        self.frame_cnt += 1
+        if frame_type == raspicar_serial.FRAME_ASCII:
+            response = bytes(self._decode_command(payload[:BUF_SIZE - 1].decode('UTF-8', errors='replace')), 'UTF-8')
+        elif frame_type == raspicar_serial.FRAME_MOTOR:
+            if len(payload) == 5:
+                flags, rpm_a, rpm_b = struct.unpack("<BHH", payload)
+                self.dir = [bool(flags & raspicar_serial.MOTOR_DIR_A), bool(flags & raspicar_serial.MOTOR_DIR_B)]
+                self.power = [bool(flags & raspicar_serial.MOTOR_POWER_A), bool(flags & raspicar_serial.MOTOR_POWER_B)]
+                self.rpm = [rpm_a, rpm_b]
+                self.enabled = [self.enabled[0] or rpm_a > 0, self.enabled[1] or rpm_b > 0]
+                response = b''
+            else:
+                response = b'\x01'
+        elif frame_type == raspicar_serial.FRAME_STATUS:
+            response = struct.pack("<hB", int(round(self.voltage * 100)), self.status)
+        else:
+            response = b''
+        self._write(raspicar_serial.encode_frame(seq, frame_type, response))
+        self._after_response()
+
+
+    def close(self):
+        """ Stops the simulator and closes the pty """
+        self._running = False
+        if self._t is not None:
+            self._t.join(1)
+        os.close(self._master)
+        os.close(self._slave)
+
+
+    @property
+    def port(self):
+        """ name of the pty to be opened instead of the serial port """
+        return self._port
+
+    @property
+    def binary(self):
+        return self._binary
+
+
+class SimulatedPi:
+    """ GPIO backend like pigpio.pi, records the pin levels """
+
+    connected = True
+
+    def __init__(self):
+        self.pins = {}
+
+    def set_mode(self, pin, mode):
+        self.pins.setdefault(pin, 0)
+
+    def write(self, pin, level):
+        self.pins[pin] = level
+
+    def read(self, pin):
+        return self.pins.get(pin, 0)
+
+    def stop(self):
+        pass
+
+
+class SimulatedGPIO:
+    """ GPIO backend like the module RPi.GPIO, records the pin levels """
+
+    BCM, OUT, IN = 11, 0, 1
+
+    def __init__(self):
+        self.pins = {}
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, mode):
+        self.pins.setdefault(pin, 0)
+
+    def output(self, pin, level):
+        self.pins[pin] = level
+
+    def input(self, pin):
+        return self.pins.get(pin, 0)
+
+    def cleanup(self):
+        pass
+
+
+#- main program starts here ----------------------------------------------
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    import sys
+    import raspicar_ioctrl
+    import raspicar_motors
+
+    # Benchmark of the serial stack: Motors.run at 10 Hz against the simulator,
+    # in ASCII and binary mode, optionally with faults
+    ticks = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    drop_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    for binary in (False, True):
+        sim = MotorDriverSimulator(latency=0.001, jitter=0.001, drop_rate=drop_rate, seed=1)
+        io = raspicar_ioctrl.IoCtrl(binary=binary, port=sim.port, gpio=SimulatedPi())
+        mot = raspicar_motors.Motors(io)
+        rx_bytes = sim.rx_bytes
+        start_time = time.perf_counter()
+        for i in range(ticks):
+            speed = int(60 * ((i // 20) % 3 - 1))           # backward, stop, forward
+            mot.run((i % 21) - 10, speed)
+            time.sleep(0.1)
+        duration = time.perf_counter() - start_time
+        print("{:s}: {:d} ticks, {:.0f} bytes/tick to the driver, timeouts: {:d}".format(
+            "binary" if io.binary else "ASCII", ticks, (sim.rx_bytes - rx_bytes) / ticks,
+            io._channel.timeout_cnt))
+        for lane, stats in io.get_lane_stats().items():
+            print("  {:8s} {}".format(lane, stats))
+        mot.stop()
+        io.close()
+        sim.close()
@@ -3,22 +3,78 @@ Modul: raspicar_socket.py
 UDP socket connection for the RaspiCar
 
 - Class: RaspiCarSocket
-- Methods: send_msg, get_data, get_stats, close
+- Methods: send_msg, get_data, subscribe, unsubscribe, get_stats, get_latency_stats,
+           dump_stats, fileno, close
+
+Controller data is requested with a binary packet b'b' + version (uint8) +
+sequence number (uint16). The controller answers with a fixed size packet:
+version (uint8), sequence number of the request (uint16), controller time
+(uint32, ms), buttons (uint8), adc x, adc y (uint16), little endian.
+Datagrams with another sequence number are late or duplicates and are
+discarded. Controllers without binary support answer the ASCII request b'd'
+with "buttons,adcx,adcy"; the protocol is chosen by the first response.
+
+In push mode (subscribe) the controller streams the same packets at a
+given rate, or on change only, without requests. The sequence numbers then
+count the packets of the stream. get_data reads all queued packets without
+blocking and returns the latest state. The subscription is a lease, renewed
+every STREAM_RENEW seconds; without any packet for STREAM_LEASE seconds the
+socket falls back to request/response. After a restart of the controller
+(its time goes back) or a timeout the sequence numbers are resynchronised.
+
+Latency is recorded per mode: 'request' -> round trip time of a request,
+'push' -> one-way delay of a pushed packet relative to the fastest packet
+so far (the clocks are not synchronized). The statistics name their mode.
 
 SLW 16-06-2023
 """
 
 import time
 import socket
+import struct
 import subprocess
 import os
 
+import raspicar_latency
+
+PACKET_VERSION = 1
+_REQUEST = struct.Struct("<cBH")
+_SUBSCRIBE = struct.Struct("<cBBBB")        # b's', version, rate (Hz), flags, lease (s)
+STREAM_ON_CHANGE = 1
+STREAM_LEASE = 3
+STREAM_RENEW = 1.0
+STREAM_RESTART = 1000       # ms, the controller time going back further means the controller restarted
+_PACKET = struct.Struct("<BHIBHH")
+
 
 class RaspiCarSocket:
     
-    def __init__(self):
+    def __init__(self, binary=True, server_addr=None):
+        """ binary -> request binary packets, fall back to ASCII if the controller does not answer
+            server_addr -> (ip address, port) of the controller, e.g. of an emulator,
+                           default: address of the current WLAN from ip_addr.dat """
         self._port_no = 12000
-        self._latency = []
+        self._timeout = 0.5
+        self._binary = None if binary else False    # None: protocol not known yet
+        self._seq = 0
+        self._probe_cnt = 0
+        self._stale_cnt = 0
+        self._controller_time = None
+        # push mode
+        self._push = False
+        self._subscription = None
+        self._renew_time = 0.0
+        self._stream_seq = None
+        self._state = (0, 0, 0)
+        self._state_time = None
+        self._next_timeout = 0.0
+        self._min_offset = None
+        self._subscribe_time = 0.0
+        self._rx_buf = bytearray(32)
+        self._rx_view = memoryview(self._rx_buf)
+        # latency histograms of fixed size, sliding window of 60 s: round trip, pushed one-way delay
+        self._recorder = raspicar_latency.LatencyRecorder(window=60.0)
+        self._push_recorder = raspicar_latency.LatencyRecorder(window=60.0)
         self._timeout_cnt = 0
         self._max_timeout_cnt = 10
         self._timeout_sum = 0
@@ -30,11 +86,17 @@ class RaspiCarSocket:
         self._ymin, self._ymax = 80, 950
         self._y_mute = 15
         # Read expected IP addresses
-        if self._read_ip_addr():
+        if server_addr is not None:
+            self._ssid = None
+            self._server_ip_addr, self._port_no = server_addr
+            self._raspi_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._raspi_socket.settimeout(self._timeout)
+            self._okay = True
+        elif self._read_ip_addr():
             self._ssid = self._get_ssid()
             self._server_ip_addr = self._expected_server_ip_addr[self._ssid]
             self._raspi_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self._raspi_socket.settimeout(0.5)
+            self._raspi_socket.settimeout(self._timeout)
             self._okay = True
         else:
             self._okay = False
@@ -71,31 +133,162 @@ class RaspiCarSocket:
         self._raspi_socket.sendto(message.encode('UTF-8'), (self._server_ip_addr, self._port_no))
         
         
+    def _request(self):
+        """ Sends a data request: binary, ASCII or alternating while the protocol is unknown """
+        if self._binary is None:
+            binary = self._probe_cnt % 2 == 0
+            self._probe_cnt += 1
+        else:
+            binary = self._binary
+        if binary:
+            self._seq = (self._seq + 1) & 0xFFFF
+            self._raspi_socket.sendto(_REQUEST.pack(b'b', PACKET_VERSION, self._seq),
+                                      (self._server_ip_addr, self._port_no))
+        else:
+            self._raspi_socket.sendto(b'd', (self._server_ip_addr, self._port_no))
+
+
+    def _receive(self, deadline):
+        """ Receives the response to the last request, returns buttons, adcx, adcy.
+            Discards late and duplicate packets, raises socket.timeout. """
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout()
+            self._raspi_socket.settimeout(remaining)
+            n, _ = self._raspi_socket.recvfrom_into(self._rx_buf)
+            data = self._rx_view[:n]
+            if n == _PACKET.size and data[0] == PACKET_VERSION:
+                _, seq, controller_time, buttons, adcx, adcy = _PACKET.unpack(data)
+                if seq != self._seq:
+                    self._stale_cnt += 1
+                    continue
+                self._binary = True
+                self._controller_time = controller_time
+                return buttons, adcx, adcy
+            try:
+                buttons, adcx, adcy = [int(z) for z in bytes(data).decode('UTF-8').split(',')]
+            except ValueError:
+                self._stale_cnt += 1
+                continue
+            if self._binary is None:
+                self._binary = False
+            return buttons, adcx, adcy
+
+
+    def _calibrate(self, adcx, adcy):
+        """ Converts the joystick adc values to x, y in the range -100 ... 100 """
+        if adcx < self._x_midpoint - self._x_mute:
+            x = -round((adcx - self._x_midpoint - self._x_mute) * 100 / (self._x_midpoint - self._xmin + self._x_mute))
+        elif adcx > self._x_midpoint + self._x_mute:
+            x = -round((adcx - self._x_midpoint + self._x_mute) * 100 / (self._xmax - self._x_midpoint + self._x_mute))
+        else:
+            x = 0
+        if adcy < self._y_midpoint - self._y_mute:
+            y = round((adcy - self._y_midpoint - self._y_mute) * 100 / (self._y_midpoint - self._ymin + self._y_mute))
+        elif adcy > self._y_midpoint + self._y_mute:
+            y = round((adcy - self._y_midpoint + self._y_mute) * 100 / (self._ymax - self._y_midpoint + self._y_mute))
+        else:
+            y = 0
+        return x, y
+
+
+    def subscribe(self, rate=20, on_change=False):
+        """ Requests the controller to stream its data at rate (Hz),
+            on_change -> only changed data (and a keepalive packet) is sent """
+        self._subscription = _SUBSCRIBE.pack(b's', PACKET_VERSION, rate,
+                                             STREAM_ON_CHANGE if on_change else 0, STREAM_LEASE)
+        self._push = True
+        self._stream_seq = None
+        self._state_time = None
+        self._subscribe_time = time.time()
+        self._renew_time = 0.0
+
+
+    def unsubscribe(self):
+        """ Ends the stream, get_data requests the data again """
+        if self._push:
+            self._raspi_socket.sendto(b'u', (self._server_ip_addr, self._port_no))
+        self._push = False
+        self._raspi_socket.settimeout(self._timeout)
+
+
+    def _get_pushed_data(self):
+        """ Reads all queued stream packets without blocking, returns the latest state """
+        now = time.time()
+        if now >= self._renew_time:
+            self._raspi_socket.sendto(self._subscription, (self._server_ip_addr, self._port_no))
+            self._renew_time = now + STREAM_RENEW
+        self._raspi_socket.settimeout(0.0)
+        received = False
+        if self._state_time is not None and now - self._state_time > self._timeout:
+            # no packet accepted for a timeout period: resynchronise to the stream
+            self._stream_seq = None
+        while True:
+            try:
+                n, _ = self._raspi_socket.recvfrom_into(self._rx_buf)
+            except (BlockingIOError, socket.timeout):
+                break
+            data = self._rx_view[:n]
+            if n != _PACKET.size or data[0] != PACKET_VERSION:
+                self._stale_cnt += 1
+                continue
+            _, seq, controller_time, buttons, adcx, adcy = _PACKET.unpack(data)
+            if self._controller_time is not None and controller_time + STREAM_RESTART < self._controller_time:
+                # the controller restarted, its stream starts over with new sequence numbers
+                self._stream_seq = None
+            # only packets newer than the latest one (16 bit sequence numbers wrap around)
+            if self._stream_seq is not None and not 0 < (seq - self._stream_seq) & 0xFFFF < 0x8000:
+                self._stale_cnt += 1
+                continue
+            self._stream_seq = seq
+            self._controller_time = controller_time
+            self._state = (buttons, adcx, adcy)
+            received = True
+        if received:
+            self._state_time = now
+            self._timeout_cnt = 0
+            self._binary = True
+            # delay relative to the fastest packet so far (clocks are not synchronized)
+            offset = now * 1000 - self._controller_time
+            if self._min_offset is None or offset < self._min_offset or offset - self._min_offset > 10000:
+                self._min_offset = offset
+            self._push_recorder.record((offset - self._min_offset) / 1000)
+        elif now - (self._subscribe_time if self._state_time is None else self._state_time) > STREAM_LEASE:
+            # no packet within the lease time, the next call requests the data
+            print(" - socket: controller does not stream, requesting data")
+            self.unsubscribe()
+        if self._state_time is None or now - self._state_time > self._timeout:
+            # count one timeout per timeout period without packets
+            if now >= self._next_timeout:
+                self._next_timeout = now + self._timeout
+                self._timeout_sum += 1
+                self._push_recorder.record_loss()
+                self._timeout_cnt += 1
+                if self._timeout_cnt > self._max_timeout_cnt:
+                    print(" - socket error: socket connection failed!")
+                    self._okay = False
+            return False, 0, 0, 0
+        x, y = self._calibrate(self._state[1], self._state[2])
+        return True, self._state[0], x, y
+
+
     def get_data(self):
+        if self._push:
+            return self._get_pushed_data()
         success = True
         start_time = time.time()
-        self._raspi_socket.sendto(b'd', (self._server_ip_addr, self._port_no))
+        self._request()
         try:
-            data, _ = self._raspi_socket.recvfrom(32)
-            self._latency.append(time.time() - start_time)
-            buttons, adcx, adcy = [int(z) for z in data.decode('UTF-8').split(',')]
-            if adcx < self._x_midpoint - self._x_mute:
-                x = -round((adcx - self._x_midpoint - self._x_mute) * 100 / (self._x_midpoint - self._xmin + self._x_mute))
-            elif adcx > self._x_midpoint + self._x_mute:
-                x = -round((adcx - self._x_midpoint + self._x_mute) * 100 / (self._xmax - self._x_midpoint + self._x_mute))
-            else:
-                x = 0
-            if adcy < self._y_midpoint - self._y_mute:
-                y = round((adcy - self._y_midpoint - self._y_mute) * 100 / (self._y_midpoint - self._ymin + self._y_mute))
-            elif adcy > self._y_midpoint + self._y_mute:
-                y = round((adcy - self._y_midpoint + self._y_mute) * 100 / (self._ymax - self._y_midpoint + self._y_mute))
-            else:
-                y = 0
+            buttons, adcx, adcy = self._receive(start_time + self._timeout)
+            self._recorder.record(time.time() - start_time)
+            x, y = self._calibrate(adcx, adcy)
             self._timeout_cnt = 0
         except socket.timeout:
             success = False
             buttons, x, y = 0, 0, 0
             self._timeout_sum += 1
+            self._recorder.record_loss()
             self._timeout_cnt += 1
             if self._timeout_cnt > self._max_timeout_cnt:
                 print(" - socket error: socket connection failed!")
@@ -104,16 +297,47 @@ class RaspiCarSocket:
         return success, buttons, x, y
         
         
-    def get_stats(self):
-        cnt = len(self._latency)
-        if cnt > 0:
-            return cnt, self._timeout_sum, \
-                   round(min(self._latency) * 1000, 1), round(sum(self._latency) * 1000 / cnt, 1), round(max(self._latency) * 1000, 1)
-        else:
-            return 0, cnt, self._timeout_cnt, 0.0, 0.0, 0.0
-        
+    def _mode_recorder(self, mode):
+        """ Returns the mode ('request', 'push', None -> current mode) and its recorder """
+        if mode is None:
+            mode = 'push' if self._push else 'request'
+        if mode not in ('request', 'push'):
+            raise ValueError("RaspiCarSocket: unknown latency mode: " + str(mode))
+        return mode, self._push_recorder if mode == 'push' else self._recorder
+
+
+    def get_stats(self, mode=None):
+        """ Returns count, timeouts (both modes), min, mean and max latency (ms)
+            of the whole run in mode ('request', 'push', default: current mode) """
+        _, recorder = self._mode_recorder(mode)
+        st = recorder.stats(window=False)
+        return st['count'], self._timeout_sum, st['min'], st['mean'], st['max']
+
+
+    def get_latency_stats(self, window=True, mode=None):
+        """ Returns a dict with mode, count, loss rate, percentiles and jitter (ms)
+            of the sliding window (True) or the whole run (False).
+            mode -> 'request': round trip, 'push': one-way delay, default: current mode """
+        mode, recorder = self._mode_recorder(mode)
+        st = recorder.stats(window)
+        st['mode'] = mode
+        return st
+
+
+    def dump_stats(self, filename, mode=None):
+        """ Writes the latency statistics and histogram of the whole run (json)
+            in mode ('request', 'push', default: current mode) """
+        _, recorder = self._mode_recorder(mode)
+        recorder.dump(filename)
+
+    def fileno(self):
+        """ File descriptor of the socket, to wait for packets with select or an event loop """
+        return self._raspi_socket.fileno()
+
+
     def close(self):
         print(" - socket: closing ...")
+        self.unsubscribe()
         self._raspi_socket.close()
                    
         
@@ -128,6 +352,26 @@ class RaspiCarSocket:
     @property
     def okay(self):
         return self._okay
+
+    @property
+    def binary(self):
+        """ True: binary packets, False: ASCII, None: not known yet """
+        return self._binary
+
+    @property
+    def controller_time(self):
+        """ controller time (ms) of the last binary packet """
+        return self._controller_time
+
+    @property
+    def push(self):
+        """ True while the controller streams its data """
+        return self._push
+
+    @property
+    def stale_cnt(self):
+        """ number of discarded late, duplicate or invalid datagrams """
+        return self._stale_cnt
     
         
 #-------------------------------------------------------------
@@ -160,6 +404,7 @@ if __name__ == '__main__':
         print("Script stopped with errors!")
     else:
         print(s.get_stats())
+        print(s.get_latency_stats(window=False))
         s.send_msg("Okay, done!")
     
     s.close()
@@ -0,0 +1,121 @@
+"""
+Modul: raspicar_startup_benchmark.py
+Startup benchmark for the RaspiCar subsystems
+
+Reports the import time of each module (the minimum of several runs, each
+in a fresh interpreter) and the init time of IoCtrl, YDLidarX2, Motors and
+RaspiCarSocket.
+Subsystems which fail to start (e.g. missing hardware) are reported as such.
+The results are stored in a json file; a subsequent run compares against
+them and flags regressions beyond a relative and an absolute tolerance.
+
+Usage: python3 raspicar_startup_benchmark.py [results.json]
+"""
+
+import os
+import sys
+import json
+import time
+import subprocess
+
+MODULES = ['raspicar_ioctrl', 'ydlidar_x2', 'raspicar_motors', 'raspicar_socket',
+           'raspicar_camera', 'numpy', 'serial', 'pigpio', 'cv2']
+IMPORT_RUNS = 5             # import times: minimum of the runs, robust against load peaks
+REGRESSION_LIMIT = 1.2      # flag results more than 20% slower than the previous run
+REGRESSION_TOLERANCE = 0.005    # s, and more than 5 ms slower (noise of short times)
+
+
+def import_time(module, runs=IMPORT_RUNS):
+    """ Returns the minimum time (s) to import a module in a fresh interpreter
+        over runs runs, None on failure """
+    code = "import time; t = time.perf_counter(); import {:s}; print(time.perf_counter() - t)".format(module)
+    times = []
+    for _ in range(runs):
+        try:
+            out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, timeout=60)
+        except subprocess.TimeoutExpired:
+            return None
+        if out.returncode != 0:
+            return None
+        times.append(float(out.stdout.strip()))
+    return min(times)
+
+
+def init_times():
+    """ Initiates the subsystems in the order of RaspiCar, returns dict of init times (s) """
+    times = {}
+    io = lid = mot = sck = None
+    try:
+        start_time = time.perf_counter()
+        import raspicar_ioctrl
+        io = raspicar_ioctrl.IoCtrl()
+        times['IoCtrl'] = time.perf_counter() - start_time
+    except Exception as e:
+        print(" - IoCtrl failed:", e)
+    try:
+        start_time = time.perf_counter()
+        import ydlidar_x2
+        lid = ydlidar_x2.YDLidarX2('/dev/serial0')
+        if lid.connect():
+            times['YDLidarX2'] = time.perf_counter() - start_time
+    except Exception as e:
+        print(" - YDLidarX2 failed:", e)
+    if io is not None:
+        try:
+            start_time = time.perf_counter()
+            import raspicar_motors
+            mot = raspicar_motors.Motors(io)
+            times['Motors'] = time.perf_counter() - start_time
+        except Exception as e:
+            print(" - Motors failed:", e)
+    try:
+        start_time = time.perf_counter()
+        import raspicar_socket
+        sck = raspicar_socket.RaspiCarSocket()
+        if sck.okay:
+            times['RaspiCarSocket'] = time.perf_counter() - start_time
+    except Exception as e:
+        print(" - RaspiCarSocket failed:", e)
+    # clean up
+    if mot is not None:
+        mot.stop()
+    if lid is not None and lid.is_connected:
+        lid.disconnect()
+    if sck is not None and sck.okay:
+        sck.close()
+    if io is not None:
+        io.close()
+    return times
+
+
+def print_results(title, results, previous):
+    print(title)
+    for name, duration in results.items():
+        if duration is None:
+            print("  {:16s}      -".format(name))
+            continue
+        line = "  {:16s} {:7.1f} ms".format(name, duration * 1000)
+        old = previous.get(name)
+        if old:
+            regression = duration > old * REGRESSION_LIMIT and duration - old > REGRESSION_TOLERANCE
+            line += "   (previous {:.1f} ms{:s})".format(old * 1000, ", REGRESSION" if regression else "")
+        print(line)
+
+
+#-------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    results_file = sys.argv[1] if len(sys.argv) > 1 else "startup_benchmark.json"
+    previous = {}
+    if os.path.exists(results_file):
+        with open(results_file, "r") as f:
+            previous = json.load(f)
+
+    imports = {module: import_time(module) for module in MODULES}
+    print_results("Import times:", imports, previous.get('imports', {}))
+    inits = init_times()
+    print_results("Init times:", inits, previous.get('inits', {}))
+
+    with open(results_file, "w") as f:
+        json.dump({'imports': imports, 'inits': inits}, f, indent=2)
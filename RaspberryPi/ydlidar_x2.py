@@ -3,22 +3,25 @@
     SLW - January 2023
 """
 
-import serial
 import math
 import numpy as np
 import time
-import tkinter as tk
 import warnings
 import threading
     
 
 class YDLidarX2:
     
-    def __init__(self, port, chunk_size=2000):
-        self.__version = 1.03
-        self._port = port                # string denoting the serial interface
+    def __init__(self, port, chunk_size=2000, vectorized=True, aligned=False):
+        self.__version = 1.04
+        self._port = port                # string denoting the serial interface (or serial-like object)
         self._ser = None
         self._chunk_size = chunk_size    # reasonable range: 1000 ... 10000
+        self._vectorized = vectorized    # decode chunks with NumPy instead of sample by sample
+        self._aligned = aligned          # publish one scan per revolution instead of per chunk
+        self._min_read = 64              # minimal number of bytes per read in aligned mode
+        self._max_rev_packets = 200      # upper limit of packets per revolution in aligned mode
+        self._filter = None              # optional scan filter, see ydlidar_x2_filter
         self._min_range = 10			 # minimal measurable distance
         self._max_range = 8000			 # maximal measurable distance
         self._max_data = 20              # maximum number of datapoints per angle
@@ -29,7 +32,6 @@ class YDLidarX2:
         self._availability_flag = False
         self._debug_level = 0
         self._error_cnt = 0
-        self._lock = threading.Lock()
         self._last_chunk = None
         # 2D array capturing the distances for angles from 0 to 359
         self._distances = np.array([[self._out_of_range for _ in range(self._max_data)] for l in range(360)], dtype=np.uint32)
@@ -37,8 +39,14 @@ class YDLidarX2:
         self._distances_pnt = np.array([0 for _ in range(360)], dtype=np.uint32)
         # predefined list of angle corrections for distances from 0 to 8000
         self._corrections = np.array([0.0] + [math.atan(21.8*((155.3-dist)/(155.3*dist)))*(180/math.pi) for dist in range(1, 8001)])
-        # measured distances for angles from 0 to 359
-        self._result = np.array([self._out_of_range for _ in range(360)], dtype=np.int32)
+        # published scan: read-only distances for angles from 0 to 359, sequence number, timestamp.
+        # The tuple is replaced as a whole, readers always see a consistent scan.
+        result = np.array([self._out_of_range for _ in range(360)], dtype=np.int32)
+        result.flags.writeable = False
+        self._snapshot = (result, 0, 0.0)
+        # notification of new scans: waiting threads and subscribed callbacks
+        self._scan_cond = threading.Condition()
+        self._callbacks = []
         # operating variables for plot functions
         self._org_x, self._org_y = 0, 0
         self._scale_factor = 0.2
@@ -49,16 +57,24 @@ class YDLidarX2:
         # array of midpoint angles for each sector
         self._sector40_midpoints = np.arange(4.5, 360.0,  9.0)
         self._sector20_midpoints = np.arange(9.0, 360.0, 18.0)
+        # index tables for sector layouts, calculated on first use (see _sector_layout)
+        self._sector_layouts = {}
         # arrays with pre-calculated sinus and cosinus
         self._sin_x = np.array([math.sin(x * math.pi / 180) for x in range(-180, 180)])
         self._cos_x = np.array([math.cos(x * math.pi / 180) for x in range(-180, 180)])
         
         
     def connect(self):
-        """ Connects on serial interface """
+        """ Connects on serial interface.
+            Instead of a port name, the lidar also accepts an object providing
+            read() and close(), e.g. a capture replay (see ydlidar_x2_capture). """
         if not self._is_connected:
             try:
-                self._ser = serial.Serial(self._port, 115200, timeout = 1)
+                if isinstance(self._port, str):
+                    import serial
+                    self._ser = serial.Serial(self._port, 115200, timeout = 1)
+                else:
+                    self._ser = self._port
                 self._is_connected = True
             except Exception as e:
                 print(e)
@@ -96,9 +112,7 @@ class YDLidarX2:
             return False
         else:
             self._is_scanning = False
-            while not self._scan_is_active:
-                time.sleep(0.1)
-            time.sleep(self._chunk_size / 6000)		# wait for the last chunk to finish reading
+            self._scan_thread.join(2 + self._chunk_size / 6000)		# wait for the last chunk to finish reading
         return True
     
     
@@ -106,41 +120,146 @@ class YDLidarX2:
         """ Core routine to retrieve and decode lidar data.
             Availaility flag is set after each successful decoding process. """
         self._scan_is_active = True
+        if self._aligned:
+            self._scan_revolutions()
+        else:
+            while self._is_scanning:
+                # Retrieve data
+                packets = self._split_chunk(self._ser.read(self._chunk_size))
+                self._decode_and_publish(packets)
+        # end of decoding loop        
+        self._scan_is_active = False
+        with self._scan_cond:
+            self._scan_cond.notify_all()       # release threads waiting for a scan
+
+
+    def _scan_revolutions(self):
+        """ Scan routine for the aligned mode: reads whatever is waiting on the
+            serial interface and publishes exactly one scan per revolution.
+            A revolution starts with a start packet (sample count 1, zero angle). """
+        revolution = None       # packets of the current revolution, None until first start packet
         while self._is_scanning:
-            # Retrieve data
-            data = self._ser.read(self._chunk_size).split(b"\xaa\x55")
-            if self._last_chunk is not None:
-                data[0] = self._last_chunk + data[0]
-            self._last_chunk = data.pop()
-            # Clear array for new scan
-            distances_pnt = np.array([0 for _ in range(360)], dtype=np.uint32)
-            error_cnt = 0
-            # Decode data
-            for idx, d in enumerate(data):
-                # Reasonable length of the data slice?
-                l = len(d)
-                if l < 10:
-                    error_cnt += 1
+            packets = self._split_chunk(self._ser.read(max(self._ser.in_waiting, self._min_read)))
+            for d in packets:
+                if len(d) >= 10 and d[1] == 1:
+                    if revolution:
+                        self._decode_and_publish(revolution)
+                    revolution = [d]
+                elif revolution is not None:
+                    revolution.append(d)
+                    if len(revolution) > self._max_rev_packets:
+                        if self._debug_level > 0:
+                            print("No start packet - revolution dropped")
+                        revolution = None
+    
+    
+    def _decode_and_publish(self, packets):
+        """ Decodes a list of packets and publishes the result """
+        if self._vectorized:
+            result, error_cnt = self._decode_packets_np(packets)
+        else:
+            result, error_cnt = self._decode_packets(packets)
+        if self._debug_level > 0 and error_cnt > 0:
+            print("Error cnt:", error_cnt)
+        if self._filter is not None:
+            result = self._filter.update(result)
+        self._error_cnt = error_cnt
+        self._publish(result)
+    
+    
+    def _publish(self, result):
+        """ Publishes a new scan by a single swap of the snapshot reference.
+            The result array must not be modified afterwards.
+            Wakes up waiting threads and calls the subscribed callbacks. """
+        result.flags.writeable = False
+        with self._scan_cond:
+            self._snapshot = (result, self._snapshot[1] + 1, time.time())
+            self._availability_flag = True
+            self._scan_cond.notify_all()
+        for callback in self._callbacks:
+            try:
+                callback(self._snapshot)
+            except Exception as e:
+                # a failing subscriber must not stop scanning for the others
+                print("Scan callback failed:", e)
+
+
+    def _split_chunk(self, chunk):
+        """ Splits a chunk of raw bytes into packets at the header 0xAA55.
+            The incomplete last packet is kept and prepended to the next chunk. """
+        data = chunk.split(b"\xaa\x55")
+        if self._last_chunk is not None:
+            data[0] = self._last_chunk + data[0]
+        self._last_chunk = data.pop()
+        return data
+
+
+    def _decode_packets(self, packets):
+        """ Decodes a list of packets sample by sample (reference implementation).
+            Returns an array of 360 distances and the error count. """
+        # Clear array for new scan
+        distances_pnt = np.array([0 for _ in range(360)], dtype=np.uint32)
+        result = np.empty(360, dtype=np.int32)
+        error_cnt = 0
+        for idx, d in enumerate(packets):
+            # Reasonable length of the data slice?
+            l = len(d)
+            if l < 10:
+                error_cnt += 1
+                if self._debug_level > 0:
+                    print("Idx:", idx, "ignored - len:", len(d))
+                continue
+            # Get sample count and start and end angle
+            sample_cnt = d[1]
+            # Do we have any samples?
+            if sample_cnt == 0:
+                error_cnt += 1
+                if self._debug_level > 0:
+                    print("Idx:", idx, "ignored - sample_cnt: 0")
+                continue
+            # Get start and end angle
+            start_angle = ((d[2] + 256 * d[3]) >> 1) / 64
+            end_angle = ((d[4] + 256 * d[5]) >> 1) / 64
+ 
+            # Start data block
+            if sample_cnt == 1:
+                dist = round((d[8] + 256*d[9]) / 4)
+                if self._debug_level > 1:
+                    print("Start package: angle:", start_angle, "   dist:", dist)
+                if dist > self._min_range:
+                    if dist > self._max_range: dist = self._max_range
+                    angle = round(start_angle + self._corrections[dist])
+                    if angle < 0: angle += 360
+                    if angle >= 360: angle -= 360
+                    self._distances[angle][distances_pnt[angle]] = dist
+                    if distances_pnt[angle] < self._max_data - 1:
+                        distances_pnt[angle] += 1
+                    else:
+                        if self._debug_level > 0:
+                            print("Idx:", idx, " - pointer overflow")
+                        error_cnt += 1
+
+            # Cloud data block
+            else:
+                if start_angle == end_angle:
                     if self._debug_level > 0:
-                        print("Idx:", idx, "ignored - len:", len(d))
-                    continue
-                # Get sample count and start and end angle
-                sample_cnt = d[1]
-                # Do we have any samples?
-                if sample_cnt == 0:
+                        print("Idx:", idx, "ignored - start angle equals end angle for cloud package")
                     error_cnt += 1
+                    continue
+                if l != 8 + 2 * sample_cnt:
                     if self._debug_level > 0:
-                        print("Idx:", idx, "ignored - sample_cnt: 0")
+                        print("Idx:", idx, "ignored - len does not match sample count - len:", l, " - sample_cnt:", sample_cnt)
+                    error_cnt += 1
                     continue
-                # Get start and end angle
-                start_angle = ((d[2] + 256 * d[3]) >> 1) / 64
-                end_angle = ((d[4] + 256 * d[5]) >> 1) / 64
- 
-                # Start data block
-                if sample_cnt == 1:
-                    dist = round((d[8] + 256*d[9]) / 4)
-                    if self._debug_level > 1:
-                        print("Start package: angle:", start_angle, "   dist:", dist)
+                if self._debug_level > 1:
+                    print("Cloud package: angle:", start_angle, "-", end_angle)
+                if end_angle < start_angle:
+                    step_angle = (end_angle + 360 - start_angle) / (sample_cnt - 1)
+                else:
+                    step_angle = (end_angle - start_angle) / (sample_cnt - 1)
+                pnt = 8
+                while pnt < l:
+                    dist = round((d[pnt] + 256*d[pnt+1]) / 4)
                     if dist > self._min_range:
                         if dist > self._max_range: dist = self._max_range
                         angle = round(start_angle + self._corrections[dist])
@@ -153,71 +272,158 @@ class YDLidarX2:
                             if self._debug_level > 0:
                                 print("Idx:", idx, " - pointer overflow")
                             error_cnt += 1
+                    start_angle += step_angle
+                    if start_angle >= 360: start_angle -= 360
+                    pnt += 2
+        for angle in range(360):
+            if distances_pnt[angle] == 0:
+                result[angle] = self._out_of_range
+            else:
+                result[angle] = self._distances[angle][:distances_pnt[angle]].mean()
+        return result, error_cnt
 
-                # Cloud data block
-                else:
-                    if start_angle == end_angle:
-                        if self._debug_level > 0:
-                            print("Idx:", idx, "ignored - start angle equals end angle for cloud package")
-                        error_cnt += 1
-                        continue
-                    if l != 8 + 2 * sample_cnt:
-                        if self._debug_level > 0:
-                            print("Idx:", idx, "ignored - len does not match sample count - len:", l, " - sample_cnt:", sample_cnt)
-                        error_cnt += 1
-                        continue
-                    if self._debug_level > 1:
-                        print("Cloud package: angle:", start_angle, "-", end_angle)
-                    if end_angle < start_angle:
-                        step_angle = (end_angle + 360 - start_angle) / (sample_cnt - 1)
-                    else:
-                        step_angle = (end_angle - start_angle) / (sample_cnt - 1)
-                    pnt = 8
-                    while pnt < l:
-                        dist = round((d[pnt] + 256*d[pnt+1]) / 4)
-                        if dist > self._min_range:
-                            if dist > self._max_range: dist = self._max_range
-                            angle = round(start_angle + self._corrections[dist])
-                            if angle < 0: angle += 360
-                            if angle >= 360: angle -= 360
-                            self._distances[angle][distances_pnt[angle]] = dist
-                            if distances_pnt[angle] < self._max_data - 1:
-                                distances_pnt[angle] += 1
-                            else:
-                                if self._debug_level > 0:
-                                    print("Idx:", idx, " - pointer overflow")
-                                error_cnt += 1
-                        start_angle += step_angle
-                        if start_angle >= 360: start_angle -= 360
-                        pnt += 2
-            # calculate result
-            if self._debug_level > 0 and error_cnt > 0:
-                print("Error cnt:", error_cnt)
-            
-            for angle in range(360):
-                if distances_pnt[angle] == 0:
-                    self._result[angle] = self._out_of_range
-                else:
-                    self._result[angle] = self._distances[angle][:distances_pnt[angle]].mean()
-            self._error_cnt = error_cnt
-            self._availability_flag = True
-        # end of decoding loop        
-        self._scan_is_active = False
+
+    def _decode_packets_np(self, packets):
+        """ Decodes a list of packets with NumPy, all samples of the chunk at once.
+            Only the packet headers are checked in Python; distances, angles,
+            corrections and binning are vectorized. The result is identical to
+            _decode_packets (first max_data-1 samples per angle are averaged).
+            Returns an array of 360 distances and the error count. """
+        error_cnt = 0
+        starts, steps, counts, payloads = [], [], [], []
+        for d in packets:
+            l = len(d)
+            if l < 10 or d[1] == 0:
+                error_cnt += 1
+                continue
+            sample_cnt = d[1]
+            start_angle = ((d[2] + 256 * d[3]) >> 1) / 64
+            if sample_cnt == 1:
+                starts.append(start_angle)
+                steps.append(0.0)
+                counts.append(1)
+                payloads.append(d[8:10])
+                continue
+            end_angle = ((d[4] + 256 * d[5]) >> 1) / 64
+            if start_angle == end_angle or l != 8 + 2 * sample_cnt:
+                error_cnt += 1
+                continue
+            if end_angle < start_angle:
+                step_angle = (end_angle + 360 - start_angle) / (sample_cnt - 1)
+            else:
+                step_angle = (end_angle - start_angle) / (sample_cnt - 1)
+            starts.append(start_angle)
+            steps.append(step_angle)
+            counts.append(sample_cnt)
+            payloads.append(d[8:])
+        result = np.full(360, self._out_of_range, dtype=np.int32)
+        if not counts:
+            return result, error_cnt
         
+        # distances of all samples in packet order
+        dists = np.rint(np.frombuffer(b"".join(payloads), dtype='<u2') / 4).astype(np.int64)
+        # angles: running sum of the step angle per packet (one row per packet),
+        # accumulated sequentially to match the reference decoder bit by bit
+        counts = np.array(counts)
+        valid = np.arange(counts.max()) < counts[:, None]
+        angles = np.repeat(np.array(steps)[:, None], valid.shape[1], axis=1)
+        angles[:, 0] = starts
+        np.cumsum(angles, axis=1, out=angles)
+        # rows passing 360 degrees are rare, redo them with wrap-around
+        for row in np.flatnonzero((valid[:, 1:] & (angles[:, 1:] >= 360)).any(axis=1)):
+            angle, step_angle = starts[row], steps[row]
+            for k in range(counts[row]):
+                angles[row, k] = angle
+                angle += step_angle
+                if angle >= 360: angle -= 360
+        angles = angles[valid]
         
+        # drop samples below minimum range, limit to maximum range, correct angles
+        in_range = dists > self._min_range
+        dists = np.minimum(dists[in_range], self._max_range)
+        angles = np.rint(angles[in_range] + self._corrections[dists]).astype(np.int64)
+        angles[angles < 0] += 360
+        angles[angles >= 360] -= 360
+        
+        # keep the first max_data-1 samples of each angle, count the others as errors
+        angle_cnt = np.bincount(angles, minlength=360)
+        error_cnt += int(np.maximum(angle_cnt - (self._max_data - 1), 0).sum())
+        order = np.argsort(angles, kind='stable')
+        rank = np.arange(len(order)) - (np.cumsum(angle_cnt) - angle_cnt)[angles[order]]
+        keep = order[rank < self._max_data - 1]
+        sums = np.bincount(angles[keep], weights=dists[keep], minlength=360)
+        cnts = np.bincount(angles[keep], minlength=360)
+        hit = cnts > 0
+        result[hit] = sums[hit] / cnts[hit]
+        return result, error_cnt
+
+
     def get_data(self):
         """ Returns an array of distance data (360 values, one for each degree).
             Resets availability flag"""
         if not self._is_scanning:
             warnings.warn("get_data: Lidar is not scanning", RuntimeWarning)
-        self._lock.acquire()
-        distances = self._result.copy()
+        distances = self._snapshot[0].copy()
         self._availability_flag = False
-        self._lock.release()
         return distances
     
     
-    def get_sectors40(self):
+    def get_scan(self):
+        """ Returns the latest scan without copying it: a read-only array of distance
+            data (360 values, one for each degree), the scan sequence number and the
+            time of the scan. Resets availability flag. """
+        if not self._is_scanning:
+            warnings.warn("get_scan: Lidar is not scanning", RuntimeWarning)
+        self._availability_flag = False
+        return self._snapshot
+    
+    
+    def wait_for_scan(self, timeout=None, last_seq=None):
+        """ Waits for a scan newer than last_seq (default: the latest scan at the time of the call).
+            Returns the scan like get_scan, or None in case of a timeout or if scanning stops.
+            Resets availability flag. """
+        if not self._is_scanning:
+            warnings.warn("wait_for_scan: Lidar is not scanning", RuntimeWarning)
+            return None
+        return self._wait_for_scan(timeout, last_seq)
+    
+    
+    def _wait_for_scan(self, timeout, last_seq):
+        """ Waits for a scan newer than last_seq, see wait_for_scan """
+        with self._scan_cond:
+            if last_seq is None:
+                last_seq = self._snapshot[1]
+            if not self._scan_cond.wait_for(lambda: self._snapshot[1] > last_seq or not self._is_scanning,
+                                            timeout):
+                return None
+            if self._snapshot[1] <= last_seq:
+                return None
+            self._availability_flag = False
+            return self._snapshot
+    
+    
+    def scans(self, timeout=None):
+        """ Iterator over new scans (as returned by get_scan).
+            Ends when scanning stops or no scan arrives within timeout. """
+        scan = self.wait_for_scan(timeout)
+        while scan is not None:
+            yield scan
+            scan = self._wait_for_scan(timeout, scan[1])
+    
+    
+    def subscribe(self, callback):
+        """ Registers a function to be called with each new scan (as returned by get_scan).
+            The callback runs in the scan thread and should return quickly. """
+        if callback not in self._callbacks:
+            self._callbacks = self._callbacks + [callback]
+    
+    
+    def unsubscribe(self, callback):
+        """ Removes a function registered with subscribe """
+        self._callbacks = [c for c in self._callbacks if c != callback]
+    
+    
+    def get_sectors40(self, result=None):
         """ Returns an array of minimum distances for sectors 0 ... 39.
             Resets availability flag.
             Sectors are:
@@ -228,19 +434,16 @@ class YDLidarX2:
             - sectors[38] -> 342 - 350 degree,
             - sectors[39] -> 351 - 359 degree 
             Sectors with missing values are reset to the minimum range.
+            result -> distances of a scan from get_scan, default: the latest scan
             """
         if not self._is_scanning:
             warnings.warn("get_sectors40: Lidar is not scanning", RuntimeWarning)
        
-        self._lock.acquire()
-        sectors = np.array([self._result[_ * 9 : _ * 9 + 9].min() for _ in range(40)])
-        sectors[sectors > self._max_range] = self._min_range
         self._availability_flag = False
-        self._lock.release()
-        return sectors
+        return self._sectors(self._snapshot[0] if result is None else result, 40, 'min')
     
     
-    def get_sectors20(self):
+    def get_sectors20(self, result=None):
         """ Returns an array of minimum distances for sectors 0 ... 19.
             Resets availability flag.
             Sectors are:
@@ -251,16 +454,89 @@ class YDLidarX2:
             - sectors[38] -> 324 - 341 degree,
             - sectors[39] -> 342 - 359 degree 
             Sectors with missing values are reset to the minimum range.
+            result -> distances of a scan from get_scan, default: the latest scan
             """
         if not self._is_scanning:
             warnings.warn("get_sectors20: Lidar is not scanning", RuntimeWarning)
         
-        self._lock.acquire()
-        sectors = np.array([self._result[_ * 18 : _ * 18 + 18].min() for _ in range(20)])
-        sectors[sectors > self._max_range] = self._min_range
         self._availability_flag = False
-        self._lock.release()
-        return sectors
+        return self._sectors(self._snapshot[0] if result is None else result, 20, 'min')
+    
+    
+    def get_sectors(self, layout=40, stat='min', q=50):
+        """ Returns an array with one value per sector. Resets availability flag.
+            layout -> number of equal sectors starting at 0 degree (int), or
+                      list of boundary angles, e.g. [-30, -10, -5, 0, 5, 10, 30, 330]
+                      for fine sectors in front and coarse ones behind.
+                      Boundaries must be increasing and span at most 360 degree.
+            stat   -> 'min', 'mean' or 'percentile'
+            q      -> percentile (0 ... 100), used with stat='percentile'
+            Invalid measurements are ignored. Sectors with missing values are reset
+            to the minimum range. """
+        if not self._is_scanning:
+            warnings.warn("get_sectors: Lidar is not scanning", RuntimeWarning)
+        self._availability_flag = False
+        return self._sectors(self._snapshot[0], layout, stat, q)
+    
+    
+    def get_sector_boundaries(self, layout):
+        """ Returns the boundary angles of a sector layout (see get_sectors) """
+        return self._sector_layout(layout)[0]
+    
+    
+    def _sector_layout(self, layout):
+        """ Returns the cached index tables of a sector layout:
+            boundaries, gather index (angles of all sectors in sequence),
+            start offsets into the gather index, padded index matrix and padding mask """
+        key = layout if isinstance(layout, int) else tuple(layout)
+        if key not in self._sector_layouts:
+            if isinstance(layout, int):
+                boundaries = np.array([round(i * 360 / layout) for i in range(layout + 1)], dtype=np.int32)
+            else:
+                boundaries = np.array(layout, dtype=np.int32)
+            if len(boundaries) < 2 or (np.diff(boundaries) <= 0).any() or boundaries[-1] - boundaries[0] > 360:
+                raise ValueError("get_sectors: invalid sector layout " + str(layout))
+            gather = np.arange(boundaries[0], boundaries[-1]) % 360
+            offsets = boundaries[:-1] - boundaries[0]
+            widths = np.diff(boundaries)
+            padded = offsets[:, None] + np.arange(widths.max())
+            pad_mask = np.arange(widths.max()) >= widths[:, None]
+            padded[pad_mask] = 0
+            self._sector_layouts[key] = (boundaries, gather, offsets, gather[padded], pad_mask)
+        return self._sector_layouts[key]
+    
+    
+    def _sectors(self, result, layout, stat='min', q=50):
+        """ Calculates sector values of a result array """
+        boundaries, gather, offsets, padded, pad_mask = self._sector_layout(layout)
+        if stat == 'min':
+            sectors = np.minimum.reduceat(result[gather], offsets)
+            sectors[sectors > self._max_range] = self._min_range
+            return sectors
+        if stat == 'mean':
+            values = result[gather]
+            valid = values <= self._max_range
+            cnt = np.add.reduceat(valid, offsets)
+            total = np.add.reduceat(np.where(valid, values, 0), offsets)
+            sectors = np.full(len(offsets), float(self._min_range))
+            np.divide(total, cnt, out=sectors, where=cnt > 0)
+            return sectors
+        if stat == 'percentile':
+            # sort invalid values to the end, interpolate linearly between valid ones
+            values = result[padded].astype(np.float64)
+            invalid = pad_mask | (values > self._max_range)
+            values[invalid] = self._out_of_range
+            values.sort(axis=1)
+            cnt = values.shape[1] - invalid.sum(axis=1)
+            pos = q / 100 * np.maximum(cnt - 1, 0)
+            lo = np.floor(pos).astype(np.int64)
+            hi = np.minimum(lo + 1, np.maximum(cnt - 1, 0))
+            v_lo = np.take_along_axis(values, lo[:, None], axis=1)[:, 0]
+            v_hi = np.take_along_axis(values, hi[:, None], axis=1)[:, 0]
+            sectors = v_lo + (pos - lo) * (v_hi - v_lo)
+            sectors[cnt == 0] = self._min_range
+            return sectors
+        raise ValueError("get_sectors: unknown statistic " + str(stat))
     
     
     def plot_data(self, cv, dist_measure=None, angle_limit=30):
@@ -399,6 +675,11 @@ class YDLidarX2:
         """ Sets the debug level. Range: 0, 1, or 2 """
         self._debug_level = debug_level
     
+    def set_filter(self, scan_filter):
+        """ Sets a filter applied to each scan before it is published,
+            e.g. ydlidar_x2_filter.ScanFilter. None disables filtering. """
+        self._filter = scan_filter
+    
     def _get_sector40_lst(self):
         """ Returns an array of the border angles for each of the 40 sectors. """
         return self._sector40_lst
@@ -419,6 +700,14 @@ class YDLidarX2:
         """ Indicates whether a new dataset is available """
         return self._availability_flag
     
+    def _get_scan_seq(self):
+        """ Returns the sequence number of the latest scan (0 -> no scan yet) """
+        return self._snapshot[1]
+    
+    def _get_scan_time(self):
+        """ Returns the time of the latest scan """
+        return self._snapshot[2]
+    
     def _get_error_cnt(self):
         """ Returns the error count of last data chunk """
         return self._error_cnt
@@ -455,8 +744,10 @@ class YDLidarX2:
     out_of_range = property(_get_out_of_range)
     available = property(_available)
     error_cnt = property(_get_error_cnt)
+    scan_seq = property(_get_scan_seq)
+    scan_time = property(_get_scan_time)
     sector40_lst = property(_get_sector40_lst)
-    sector20_lst = property(_get_sector40_lst)
+    sector20_lst = property(_get_sector20_lst)
     sector40_midpoints = property(_get_sector40_midpoints)
     sector20_midpoints = property(_get_sector20_midpoints)
     scale_factor = property(_get_scale_factor, _set_scale_factor)
@@ -468,6 +759,7 @@ class YDLidarX2:
 # --------------------------------------------------------------------------
 if __name__ == "__main__":
 
+    import tkinter as tk
     import RPi.GPIO as GPIO
 
     # Global constants
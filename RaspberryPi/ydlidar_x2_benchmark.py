@@ -0,0 +1,150 @@
+""" Module ydlidar_x2_benchmark
+    Microbenchmark for the YD LiDAR X2 packet decoders.
+    Compares the sample-by-sample decoder with the NumPy decoder on recorded
+    chunks and checks that both deliver identical results.
+    Compares the former list based sector calculation with get_sectors.
+    Reports the run time of filter, occupancy grid and scan matching.
+
+    Usage: python3 ydlidar_x2_benchmark.py [capture file] [chunk_size]
+    Without a capture file a synthetic data stream is generated.
+    The capture file is either recorded with ydlidar_x2_capture.py or a raw
+    dump of the serial port, e.g.
+        stty -F /dev/serial0 115200 raw; head -c 200000 /dev/serial0 > raw_dump.bin
+"""
+
+import sys
+import time
+import random
+import numpy as np
+
+import ydlidar_x2
+import ydlidar_x2_capture
+import ydlidar_x2_filter
+import ydlidar_x2_grid
+import ydlidar_x2_icp
+
+
+def make_stream(revolutions=50, samples=40, seed=0):
+    """ Synthesizes a raw X2 byte stream of a rectangular room.
+        Each revolution starts with a zero-angle start packet,
+        followed by cloud packets of the given number of samples. """
+    rnd = random.Random(seed)
+    stream = bytearray()
+    angle_step = 360 / (11 * samples)
+    for _ in range(revolutions):
+        # start packet
+        stream += b"\xaa\x55" + bytes([1, 1]) + (1).to_bytes(2, 'little') * 2 + b"\x00\x00"
+        stream += (rnd.randint(100, 2000) * 4).to_bytes(2, 'little')
+        angle = rnd.uniform(0.0, 1.0)
+        while angle < 360 - samples * angle_step:
+            end_angle = angle + (samples - 1) * angle_step
+            fsa = (round(angle * 64) << 1) | 1
+            lsa = (round(end_angle * 64) % (360 * 64) << 1) | 1
+            stream += b"\xaa\x55" + bytes([0, samples])
+            stream += fsa.to_bytes(2, 'little') + lsa.to_bytes(2, 'little') + b"\x00\x00"
+            for s in range(samples):
+                a = (angle + s * angle_step) * np.pi / 180
+                dist = min(1500 / max(abs(np.cos(a)), 1e-3), 2500 / max(abs(np.sin(a)), 1e-3), 7990)
+                if rnd.random() < 0.05:
+                    dist = 0                                    # invalid sample
+                raw = int(dist * rnd.uniform(0.98, 1.02)) * 4 + rnd.randint(0, 3)
+                stream += min(raw, 0xffff).to_bytes(2, 'little')
+            angle += samples * angle_step
+    return bytes(stream)
+
+
+def run_decoder(lid, chunks, vectorized):
+    """ Decodes all chunks, returns list of (result, error_cnt) and run time per chunk """
+    lid._last_chunk = None
+    packets = [lid._split_chunk(chunk) for chunk in chunks]
+    decode = lid._decode_packets_np if vectorized else lid._decode_packets
+    start_time = time.perf_counter()
+    results = [decode(p) for p in packets]
+    duration = (time.perf_counter() - start_time) / len(chunks)
+    return results, duration
+
+
+def sectors_lst(lid, result, n):
+    """ Former list based calculation of get_sectors40 / get_sectors20 """
+    width = 360 // n
+    sectors = np.array([result[_ * width : _ * width + width].min() for _ in range(n)])
+    sectors[sectors > lid._max_range] = lid._min_range
+    return sectors
+
+
+def run_sectors(lid, results, func, *args):
+    """ Calculates sectors for all results, returns list of sectors and run time per call """
+    start_time = time.perf_counter()
+    sectors = [func(result, *args) for result in results]
+    duration = (time.perf_counter() - start_time) / len(results)
+    return sectors, duration
+
+
+#- main program starts here ----------------------------------------------
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        try:
+            replay = ydlidar_x2_capture.CaptureReplay(sys.argv[1])
+            stream = replay.read(replay.size)
+            replay.close()
+        except ValueError:
+            with open(sys.argv[1], "rb") as f:
+                stream = f.read()
+        print("Capture:", sys.argv[1], "-", len(stream), "bytes")
+        if not stream:
+            sys.exit("No data in " + sys.argv[1])
+    else:
+        stream = make_stream()
+        print("Synthetic stream:", len(stream), "bytes")
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    chunks = [stream[i : i + chunk_size] for i in range(0, len(stream), chunk_size)]
+
+    lid = ydlidar_x2.YDLidarX2('/dev/null', chunk_size)
+    results_loop, duration_loop = run_decoder(lid, chunks, False)
+    results_np, duration_np = run_decoder(lid, chunks, True)
+
+    mismatches = 0
+    for (res_loop, err_loop), (res_np, err_np) in zip(results_loop, results_np):
+        if not np.array_equal(res_loop, res_np) or err_loop != err_np:
+            mismatches += 1
+
+    print("Chunks:", len(chunks), "  chunk size:", chunk_size)
+    print("Loop decoder:  {:.2f} ms per chunk".format(duration_loop * 1000))
+    print("NumPy decoder: {:.2f} ms per chunk".format(duration_np * 1000))
+    print("Speed-up:      {:.1f}x".format(duration_loop / duration_np))
+    print("Mismatches:   ", mismatches)
+
+    results = [res for res, _ in results_np] * 20
+    front_fine = [-90, -30, -20, -15, -10, -5, 0, 5, 10, 15, 20, 30, 90, 270]
+    print()
+    print("Sectors:", len(results), "calls each")
+    for n in (40, 20):
+        sectors_old, duration_old = run_sectors(lid, results, lambda r: sectors_lst(lid, r, n))
+        sectors_new, duration_new = run_sectors(lid, results, lid._sectors, n)
+        mismatches = sum(not np.array_equal(a, b) for a, b in zip(sectors_old, sectors_new))
+        print("Sectors{:d} list:  {:.1f} us".format(n, duration_old * 1e6))
+        print("Sectors{:d} NumPy: {:.1f} us  (mismatches: {:d})".format(n, duration_new * 1e6, mismatches))
+    for stat in ('mean', 'percentile'):
+        _, duration = run_sectors(lid, results, lid._sectors, 40, stat)
+        print("Sectors40 {:s}: {:.1f} us".format(stat, duration * 1e6))
+    _, duration = run_sectors(lid, results, lid._sectors, front_fine, 'min')
+    print("Front-fine layout min: {:.1f} us".format(duration * 1e6))
+
+    print()
+    for method in ('median', 'ema'):
+        scan_filter = ydlidar_x2_filter.ScanFilter(depth=5, method=method, outlier_dist=300)
+        _, duration = run_sectors(lid, results, scan_filter.update)
+        print("Filter {:s} (depth 5, outliers): {:.1f} us".format(method, duration * 1e6))
+    grid = ydlidar_x2_grid.OccupancyGrid(lid, size=200, cell_size=50)
+    _, duration = run_sectors(lid, results, grid.update)
+    print("Occupancy grid update (200 x 200): {:.2f} ms".format(duration * 1000))
+    matcher = ydlidar_x2_icp.ScanMatcher(lid)
+    iterations = []
+    start_time = time.perf_counter()
+    for ref, scan in zip(results[:-1], results[1:]):
+        _, _, it = matcher.match(matcher.to_points(ref), matcher.to_points(scan))
+        iterations.append(it)
+    duration = (time.perf_counter() - start_time) / len(iterations)
+    print("ICP match: {:.2f} ms ({:.1f} iterations)".format(duration * 1000, sum(iterations) / len(iterations)))
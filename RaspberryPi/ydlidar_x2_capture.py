@@ -0,0 +1,275 @@
+""" Module ydlidar_x2_capture
+    Record and replay of raw YD LiDAR X2 serial streams.
+
+    File format (little endian):
+    - file header:   magic b"YDX2CAP", version (uint8), start time (float64, epoch)
+    - record header: timestamp (float64, seconds since start), length (uint32)
+    - record data:   raw bytes as returned by one read() of the serial port
+    Capture files are memory-mapped for replay, so the data is not copied
+    into memory as a whole.
+
+    - Class CaptureRecorder: wraps a serial port and records all reads
+    - Class CaptureReplay: serial-like source to be used in place of the port
+    - Functions: decode_capture, save_golden, check_golden
+"""
+
+import os
+import mmap
+import struct
+import time
+import numpy as np
+
+_MAGIC = b"YDX2CAP"
+_VERSION = 1
+_FILE_HEADER = struct.Struct("<7sBd")
+_RECORD_HEADER = struct.Struct("<dI")
+
+
+class CaptureRecorder:
+    """ Serial-like wrapper recording every read() of the underlying port.
+        Can be passed to YDLidarX2 in place of the port name. """
+
+    def __init__(self, ser, filename):
+        self._ser = ser
+        self._file = open(filename, "wb")
+        self._start_time = time.monotonic()
+        self._file.write(_FILE_HEADER.pack(_MAGIC, _VERSION, time.time()))
+        self._record_cnt = 0
+
+    def read(self, size=1):
+        data = self._ser.read(size)
+        if data:
+            self._file.write(_RECORD_HEADER.pack(time.monotonic() - self._start_time, len(data)))
+            self._file.write(data)
+            self._record_cnt += 1
+        return data
+
+    def close(self):
+        self._file.close()
+        self._ser.close()
+
+    @property
+    def in_waiting(self):
+        return self._ser.in_waiting
+
+    @property
+    def record_cnt(self):
+        return self._record_cnt
+
+
+class CaptureReplay:
+    """ Serial-like source replaying a capture file.
+        realtime -> True: data is delivered according to the recorded timestamps,
+                    False: data is delivered as fast as possible
+        loop     -> restart at the beginning when the end of the capture is reached """
+
+    def __init__(self, filename, realtime=False, loop=False):
+        self._realtime = realtime
+        self._loop = loop
+        self._file = open(filename, "rb")
+        try:
+            if os.fstat(self._file.fileno()).st_size < _FILE_HEADER.size:
+                raise ValueError("CaptureReplay: file too short for a capture file: " + str(filename))
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError as e:
+            self._file.close()
+            raise ValueError("CaptureReplay: capture file can not be mapped: " + str(filename)) from e
+        except ValueError:
+            self._file.close()
+            raise
+        magic, version, self._start_time = _FILE_HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC or version != _VERSION:
+            self.close()
+            raise ValueError("CaptureReplay: no valid capture file: " + str(filename))
+        # index of all records: timestamp, offset and length of the data
+        timestamps, offsets, lengths = [], [], []
+        pnt = _FILE_HEADER.size
+        while pnt + _RECORD_HEADER.size <= len(self._map):
+            ts, l = _RECORD_HEADER.unpack_from(self._map, pnt)
+            pnt += _RECORD_HEADER.size
+            if pnt + l > len(self._map):
+                break                               # truncated last record
+            timestamps.append(ts)
+            offsets.append(pnt)
+            lengths.append(l)
+            pnt += l
+        self._timestamps = np.array(timestamps)
+        self._offsets = np.array(offsets, dtype=np.int64)
+        self._lengths = np.array(lengths, dtype=np.int64)
+        self.rewind()
+
+    def rewind(self):
+        """ Restarts the replay at the first record """
+        self._record = 0
+        self._pos = int(self._offsets[0]) if len(self._offsets) > 0 else 0
+        self._replay_start = time.monotonic()
+
+    def _available(self):
+        """ Returns the number of bytes which may be delivered right now """
+        if self._record >= len(self._offsets):
+            return 0
+        end = len(self._offsets)
+        if self._realtime:
+            end = int(np.searchsorted(self._timestamps, time.monotonic() - self._replay_start, side='right'))
+            if end <= self._record:
+                return 0
+        last = end - 1
+        return int(self._offsets[last] + self._lengths[last] - self._pos) - \
+               int(_RECORD_HEADER.size * (last - self._record))
+
+    def read(self, size=1):
+        """ Returns up to size bytes. In realtime mode it waits until the
+            requested bytes have been 'received', like a serial port without timeout. """
+        data = bytearray()
+        while len(data) < size:
+            if self._record >= len(self._offsets):
+                if not self._loop or len(self._offsets) == 0:
+                    break
+                self.rewind()
+            if self._realtime:
+                delay = self._timestamps[self._record] - (time.monotonic() - self._replay_start)
+                if delay > 0:
+                    time.sleep(delay)
+            end = int(self._offsets[self._record] + self._lengths[self._record])
+            n = min(size - len(data), end - self._pos)
+            data += self._map[self._pos : self._pos + n]
+            self._pos += n
+            if self._pos >= end:
+                self._record += 1
+                if self._record < len(self._offsets):
+                    self._pos = int(self._offsets[self._record])
+        if not data:
+            time.sleep(0.01)        # end of capture, behave like a serial timeout
+        return bytes(data)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    @property
+    def in_waiting(self):
+        return self._available()
+
+    @property
+    def eof(self):
+        return not self._loop and self._record >= len(self._offsets)
+
+    @property
+    def duration(self):
+        return self._timestamps[-1] if len(self._timestamps) > 0 else 0.0
+
+    @property
+    def size(self):
+        return int(self._lengths.sum())
+
+    @property
+    def start_time(self):
+        return self._start_time
+
+
+def decode_capture(lid, filename, vectorized=True):
+    """ Decodes a capture file chunk by chunk with the decoder of lid (YDLidarX2),
+        without running the scan thread. Returns an array of results (one row
+        of 360 distances per chunk) and an array of error counts. """
+    replay = CaptureReplay(filename)
+    lid._last_chunk = None
+    decode = lid._decode_packets_np if vectorized else lid._decode_packets
+    results, error_cnts = [], []
+    while not replay.eof:
+        result, error_cnt = decode(lid._split_chunk(replay.read(lid._chunk_size)))
+        results.append(result)
+        error_cnts.append(error_cnt)
+    replay.close()
+    return np.array(results, dtype=np.int32).reshape(-1, 360), np.array(error_cnts, dtype=np.int32)
+
+
+def save_golden(lid, filename, golden_file):
+    """ Stores the decoded results of a capture file as golden reference (.npz) """
+    results, error_cnts = decode_capture(lid, filename, vectorized=False)
+    np.savez_compressed(golden_file, results=results, error_cnts=error_cnts,
+                        chunk_size=lid._chunk_size)
+
+
+def check_golden(lid, filename, golden_file, vectorized=True):
+    """ Decodes a capture file and compares it against the golden reference.
+        Returns the list of chunk indices which differ. """
+    golden = np.load(golden_file)
+    if int(golden['chunk_size']) != lid._chunk_size:
+        raise ValueError("check_golden: chunk size does not match golden file")
+    results, error_cnts = decode_capture(lid, filename, vectorized)
+    if results.shape != golden['results'].shape:
+        return list(range(max(len(results), len(golden['results']))))
+    differ = (results != golden['results']).any(axis=1) | (error_cnts != golden['error_cnts'])
+    return list(np.flatnonzero(differ))
+
+
+#- main program starts here ----------------------------------------------
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    import sys
+    import ydlidar_x2
+
+    usage = """Usage:
+    python3 ydlidar_x2_capture.py record <capture file> <seconds> [port]
+    python3 ydlidar_x2_capture.py replay <capture file> [realtime]
+    python3 ydlidar_x2_capture.py golden <capture file> <golden file>
+    python3 ydlidar_x2_capture.py check  <capture file> <golden file>"""
+
+    if len(sys.argv) < 3:
+        print(usage)
+        sys.exit(1)
+    cmd, capture_file = sys.argv[1], sys.argv[2]
+
+    if cmd == "record" and len(sys.argv) > 3:
+        import serial
+        import RPi.GPIO as GPIO
+        PIN_LIDAR_PWR = 21      # GPIO pin to power the LiDAR
+        GPIO.setwarnings(False)
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(PIN_LIDAR_PWR, GPIO.OUT)
+        GPIO.output(PIN_LIDAR_PWR, GPIO.HIGH)
+        time.sleep(0.5)
+        port = sys.argv[4] if len(sys.argv) > 4 else '/dev/serial0'
+        rec = CaptureRecorder(serial.Serial(port, 115200, timeout = 1), capture_file)
+        lid = ydlidar_x2.YDLidarX2(rec)
+        lid.connect()
+        lid.start_scan()
+        time.sleep(float(sys.argv[3]))
+        lid.stop_scan()
+        lid.disconnect()
+        GPIO.output(PIN_LIDAR_PWR, GPIO.LOW)
+        print("Records:", rec.record_cnt)
+
+    elif cmd == "replay":
+        realtime = len(sys.argv) > 3 and sys.argv[3] == "realtime"
+        replay = CaptureReplay(capture_file, realtime=realtime)
+        print("Capture: {:d} bytes, {:.1f} s".format(replay.size, replay.duration))
+        lid = ydlidar_x2.YDLidarX2(replay)
+        lid.connect()
+        start_time = time.perf_counter()
+        lid.start_scan()
+        scans = 0
+        while not replay.eof:
+            if lid.available:
+                lid.get_data()
+                scans += 1
+            time.sleep(0.001)
+        lid.stop_scan()
+        duration = time.perf_counter() - start_time
+        lid.disconnect()
+        print("Scans: {:d}, {:.0f} kB/s".format(scans, replay.size / duration / 1000))
+
+    elif cmd == "golden" and len(sys.argv) > 3:
+        save_golden(ydlidar_x2.YDLidarX2(capture_file), capture_file, sys.argv[3])
+        print("Golden file saved:", sys.argv[3])
+
+    elif cmd == "check" and len(sys.argv) > 3:
+        differ = check_golden(ydlidar_x2.YDLidarX2(capture_file), capture_file, sys.argv[3])
+        print("Okay" if not differ else "Chunks differing: " + str(differ))
+        sys.exit(1 if differ else 0)
+
+    else:
+        print(usage)
+        sys.exit(1)
@@ -0,0 +1,99 @@
+""" Module ydlidar_x2_filter
+    Temporal and spatial filtering of YD LiDAR X2 scans.
+    Keeps the last scans per angle in a preallocated ring buffer and filters
+    them without any per-sample Python code.
+
+    - Class ScanFilter
+    - Methods: update, reset
+
+    Usage: lid.set_filter(ScanFilter(depth=5, method='median', outlier_dist=300))
+"""
+
+import numpy as np
+
+
+class ScanFilter:
+    """ Filter for scans of 360 distances (one per degree).
+        depth        -> number of scans kept in the ring buffer
+        method       -> 'median': median of the valid values in the ring buffer,
+                        'ema': exponential moving average of valid values,
+                        None: no temporal filter (latest scan)
+        alpha        -> weight of the latest value for method 'ema' (0 < alpha <= 1)
+        outlier_dist -> distance (mm) a value must differ from both (valid) neighbouring
+                        angles to be rejected as outlier, None disables rejection
+        An angle without any valid value in the ring buffer is invalid (out_of_range). """
+
+    def __init__(self, depth=5, method='median', alpha=0.5, outlier_dist=None,
+                 out_of_range=32768, max_range=8000):
+        if method not in ('median', 'ema', None):
+            raise ValueError("ScanFilter: unknown method " + str(method))
+        if depth < 1 or not 0 < alpha <= 1:
+            raise ValueError("ScanFilter: depth must be >= 1 and alpha in range 0 ... 1")
+        self._depth = depth
+        self._method = method
+        self._alpha = alpha
+        self._outlier_dist = outlier_dist
+        self._out_of_range = out_of_range
+        self._max_range = max_range
+        # ring buffer: one row per scan
+        self._history = np.empty((depth, 360), dtype=np.int32)
+        self._sorted = np.empty((depth, 360), dtype=np.int32)
+        self._ema = np.empty(360, dtype=np.float64)
+        self.reset()
+
+
+    def reset(self):
+        """ Clears the ring buffer """
+        self._history.fill(self._out_of_range)
+        self._ema.fill(np.nan)
+        self._pnt = 0
+
+
+    def update(self, result):
+        """ Adds a scan to the ring buffer and returns the filtered scan (int32 array) """
+        self._history[self._pnt] = result
+        self._pnt = (self._pnt + 1) % self._depth
+        valid = self._history <= self._max_range
+        valid_cnt = valid.sum(axis=0)
+
+        if self._method == 'median':
+            # invalid values are larger than all valid ones and sort to the end
+            self._sorted[:] = self._history
+            self._sorted.sort(axis=0)
+            lo = np.maximum(valid_cnt - 1, 0) // 2
+            hi = valid_cnt // 2
+            values = (np.take_along_axis(self._sorted, lo[None, :], axis=0)[0] +
+                      np.take_along_axis(self._sorted, hi[None, :], axis=0)[0]) / 2
+        elif self._method == 'ema':
+            new_valid = result <= self._max_range
+            start = new_valid & np.isnan(self._ema)
+            self._ema[start] = result[start]
+            update = new_valid & ~start
+            self._ema[update] += self._alpha * (result[update] - self._ema[update])
+            self._ema[valid_cnt == 0] = np.nan
+            values = self._ema
+        else:
+            values = np.asarray(result, dtype=np.float64)
+
+        filtered = np.full(360, self._out_of_range, dtype=np.int32)
+        ok = (valid_cnt > 0) & (values <= self._max_range)
+        filtered[ok] = values[ok]
+
+        if self._outlier_dist is not None:
+            # reject values differing from both neighbouring angles, only if both
+            # neighbours are valid: thin objects (poles, table legs) in open space are kept
+            neighbours = np.stack((np.roll(filtered, 1), np.roll(filtered, -1)), axis=1)
+            neighbours_ok = np.stack((np.roll(ok, 1), np.roll(ok, -1)), axis=1)
+            diff = np.abs(filtered.astype(np.int64)[:, None] - neighbours)
+            outlier = ok & neighbours_ok.all(axis=1) & (diff > self._outlier_dist).all(axis=1)
+            filtered[outlier] = self._out_of_range
+        return filtered
+
+
+    @property
+    def depth(self):
+        return self._depth
+
+    @property
+    def method(self):
+        return self._method
@@ -0,0 +1,128 @@
+""" Module ydlidar_x2_grid
+    Local occupancy grid built from YD LiDAR X2 scans.
+    The grid stores log-odds per cell and is centered on the car. It keeps a
+    fixed orientation and scrolls when the car moves by more than one cell.
+    Rays are marked with a precomputed table of cell offsets per angle, so an
+    update has no per-sample Python code.
+
+    - Class OccupancyGrid
+    - Methods: update, move, reset, probabilities
+
+    Usage: grid = OccupancyGrid(lid)
+           lid.subscribe(lambda scan: grid.update(scan[0]))
+"""
+
+import threading
+import numpy as np
+
+
+class OccupancyGrid:
+    """ Occupancy grid of size x size cells, each cell_size mm wide.
+        Axis 0 of the grid points forward (at heading 0), axis 1 to the right.
+        l_occ, l_free -> log-odds added for a hit or a traversed cell
+        l_min, l_max  -> limits of the log-odds """
+
+    def __init__(self, lid, size=200, cell_size=50, l_occ=0.85, l_free=-0.4, l_min=-4.0, l_max=4.0):
+        self._size = size
+        self._cell_size = cell_size
+        self._l_occ, self._l_free = l_occ, l_free
+        self._l_min, self._l_max = l_min, l_max
+        self._max_range = lid._max_range
+        self._lock = threading.Lock()
+        self._grid = np.zeros((size, size), dtype=np.float32)
+        # position of the car relative to the grid center (mm) and heading (degree)
+        self._pos = np.zeros(2)
+        self._heading = 0.0
+        # sinus and cosinus per angle 0 ... 359 from the tables of the driver (-180 ... 179)
+        sin_a, cos_a = np.roll(lid._sin_x, -180), np.roll(lid._cos_x, -180)
+        # cell offsets along each ray: one row per angle, column j at a distance of j+1 cells
+        self._steps = int(np.ceil(size * 0.75))
+        t = np.arange(1, self._steps + 1)
+        self._ray_x = np.floor(cos_a[:, None] * t + 0.5).astype(np.int32)
+        self._ray_y = np.floor(sin_a[:, None] * t + 0.5).astype(np.int32)
+        self._cos_a, self._sin_a = cos_a, sin_a
+
+
+    def reset(self):
+        """ Clears the grid and resets the position """
+        with self._lock:
+            self._grid.fill(0)
+            self._pos[:] = 0
+            self._heading = 0.0
+
+
+    def move(self, dx, dy, dheading=0.0):
+        """ Moves the car by dx (forward) and dy (right) in mm relative to its
+            heading, then turns it by dheading degree (clockwise).
+            Scrolls the grid when the car leaves the center cell. """
+        with self._lock:
+            a = int(round(self._heading)) % 360
+            self._pos += (dx * self._cos_a[a] - dy * self._sin_a[a],
+                          dx * self._sin_a[a] + dy * self._cos_a[a])
+            self._heading = (self._heading + dheading) % 360
+            shift = np.trunc(self._pos / self._cell_size).astype(int)
+            if shift.any():
+                self._scroll(shift)
+                self._pos -= shift * self._cell_size
+
+
+    def _scroll(self, shift):
+        """ Shifts the grid content by -shift cells, new cells are unknown """
+        grid = np.zeros_like(self._grid)
+        sx, sy = shift
+        n = self._size
+        if abs(sx) < n and abs(sy) < n:
+            grid[max(-sx, 0) : n - max(sx, 0), max(-sy, 0) : n - max(sy, 0)] = \
+                self._grid[max(sx, 0) : n - max(-sx, 0), max(sy, 0) : n - max(-sy, 0)]
+        self._grid = grid
+
+
+    def update(self, distances):
+        """ Adds a scan (360 distances, one per degree) to the grid """
+        with self._lock:
+            a0 = int(round(self._heading))
+            rows = (np.arange(360) + a0) % 360
+            center = self._size // 2 + np.rint(self._pos / self._cell_size).astype(int)
+            dist = np.asarray(distances)
+            valid = dist <= self._max_range
+            # cells of each ray up to the measured distance (free) and at the distance (hit)
+            hit_step = np.where(valid, np.floor(dist / self._cell_size + 0.5) - 1, -1).astype(int)
+            free = np.arange(self._steps)[None, :] < hit_step[:, None]
+            cx = center[0] + self._ray_x[rows]
+            cy = center[1] + self._ray_y[rows]
+            inside = (cx >= 0) & (cx < self._size) & (cy >= 0) & (cy < self._size)
+            free_cells = np.unique((cx * self._size + cy)[free & inside])
+            hit = (hit_step >= 0) & (hit_step < self._steps)
+            hit_cells = (cx * self._size + cy)[hit, hit_step[hit]]
+            hit_cells = np.unique(hit_cells[inside[hit, hit_step[hit]]])
+            free_cells = np.setdiff1d(free_cells, hit_cells, assume_unique=True)
+            flat = self._grid.reshape(-1)
+            flat[free_cells] += self._l_free
+            flat[hit_cells] += self._l_occ
+            np.clip(self._grid, self._l_min, self._l_max, out=self._grid)
+
+
+    def probabilities(self):
+        """ Returns the occupancy probability per cell (0.5 -> unknown) """
+        with self._lock:
+            return 1 - 1 / (1 + np.exp(self._grid))
+
+
+    @property
+    def grid(self):
+        """ log-odds per cell (copy) """
+        with self._lock:
+            return self._grid.copy()
+
+    @property
+    def pose(self):
+        """ position relative to the grid center (mm) and heading (degree) """
+        return self._pos.copy(), self._heading
+
+    @property
+    def cell_size(self):
+        return self._cell_size
+
+    @property
+    def size(self):
+        return self._size
@@ -0,0 +1,140 @@
+""" Module ydlidar_x2_icp
+    Scan matching odometry for the YD LiDAR X2.
+    Estimates the motion of the car between consecutive scans with a
+    point-to-point ICP (iterative closest point). Correspondences are searched
+    in a grid: each cell holds one reference point, a query point checks all
+    cells within the maximal correspondence distance. Iterations stop when the
+    estimate converges or the time budget per scan is used up.
+
+    Coordinates: x forward, y right (mm), angles clockwise (degree),
+    the same as ydlidar_x2_grid.OccupancyGrid.
+
+    - Class ScanMatcher
+    - Methods: to_points, match, update, reset
+"""
+
+import math
+import time
+import numpy as np
+
+
+class ScanMatcher:
+    """ max_iterations -> upper limit of ICP iterations per scan
+        max_time       -> time budget per scan (s)
+        max_dist       -> maximal distance of corresponding points (mm)
+        cell_size      -> cell size of the correspondence grid (mm)
+        min_points     -> minimal number of correspondences for a valid match
+        tolerance      -> convergence limit for the change of translation (mm) and rotation (degree) """
+
+    def __init__(self, lid, max_iterations=30, max_time=0.05, max_dist=300, cell_size=100,
+                 min_points=30, tolerance=0.5):
+        self._max_iterations = max_iterations
+        self._max_time = max_time
+        self._max_dist = max_dist
+        self._cell_size = cell_size
+        self._min_points = min_points
+        self._tolerance = tolerance
+        self._max_range = lid._max_range
+        # sinus and cosinus per angle 0 ... 359 from the tables of the driver (-180 ... 179)
+        self._sin_a, self._cos_a = np.roll(lid._sin_x, -180), np.roll(lid._cos_x, -180)
+        # correspondence grid covering the full range
+        n = int(math.ceil(max_dist / cell_size))
+        self._cells = 2 * (int(math.ceil(self._max_range / cell_size)) + n) + 1
+        self._grid = np.full((self._cells, self._cells), -1, dtype=np.int32)
+        self._neighbours = np.array([(i, j) for i in range(-n, n + 1) for j in range(-n, n + 1)])
+        self.reset()
+
+
+    def reset(self):
+        """ Forgets the previous scan and resets the accumulated pose """
+        self._ref = None
+        self._pose = np.zeros(3)        # x, y (mm), heading (degree)
+
+
+    def to_points(self, distances):
+        """ Converts a scan (360 distances) to an array of points (n x 2) """
+        dist = np.asarray(distances)
+        valid = dist <= self._max_range
+        return np.stack((dist[valid] * self._cos_a[valid], dist[valid] * self._sin_a[valid]), axis=1)
+
+
+    def _cell_index(self, points):
+        """ Returns the grid cell (row, column) of each point """
+        return np.floor(points / self._cell_size).astype(np.int64) + self._cells // 2
+
+
+    def _set_reference(self, ref):
+        """ Enters the reference points into the correspondence grid """
+        self._grid.fill(-1)
+        cells = self._cell_index(ref)
+        self._grid[cells[:, 0], cells[:, 1]] = np.arange(len(ref), dtype=np.int32)
+
+
+    def _correspondences(self, ref, points):
+        """ Returns the index of the nearest reference point for each point (-1 -> none) """
+        cells = self._cell_index(points)[:, None, :] + self._neighbours[None, :, :]
+        np.clip(cells, 0, self._cells - 1, out=cells)
+        candidates = self._grid[cells[..., 0], cells[..., 1]]          # n x neighbours
+        diff = ref[candidates] - points[:, None, :]
+        dist2 = (diff ** 2).sum(axis=2)
+        dist2[candidates < 0] = np.inf
+        best = dist2.argmin(axis=1)
+        nearest = candidates[np.arange(len(points)), best]
+        nearest[dist2[np.arange(len(points)), best] > self._max_dist ** 2] = -1
+        return nearest
+
+
+    def match(self, ref, points, initial=(0.0, 0.0, 0.0)):
+        """ Estimates the transformation mapping points onto ref (both n x 2 arrays).
+            Returns (dx, dy, dtheta in degree), mean residual distance (mm) and
+            number of iterations; the transformation is None if the match failed. """
+        start_time = time.perf_counter()
+        self._set_reference(ref)
+        theta = math.radians(initial[2])
+        t = np.array(initial[:2], dtype=np.float64)
+        residual, iterations = math.inf, 0
+        while iterations < self._max_iterations:
+            iterations += 1
+            c, s = math.cos(theta), math.sin(theta)
+            moved = points @ np.array([[c, s], [-s, c]]) + t
+            nearest = self._correspondences(ref, moved)
+            pair = nearest >= 0
+            if pair.sum() < self._min_points:
+                return None, residual, iterations
+            p, q = moved[pair], ref[nearest[pair]]
+            residual = float(np.sqrt(((p - q) ** 2).sum(axis=1)).mean())
+            # closed form of the best rigid transformation for the pairs
+            p_mean, q_mean = p.mean(axis=0), q.mean(axis=0)
+            h = (p - p_mean).T @ (q - q_mean)
+            d_theta = math.atan2(h[0, 1] - h[1, 0], h[0, 0] + h[1, 1])
+            dc, ds = math.cos(d_theta), math.sin(d_theta)
+            d_t = q_mean - np.array([dc * p_mean[0] - ds * p_mean[1], ds * p_mean[0] + dc * p_mean[1]])
+            theta += d_theta
+            t = np.array([dc * t[0] - ds * t[1], ds * t[0] + dc * t[1]]) + d_t
+            if np.hypot(*d_t) < self._tolerance and abs(math.degrees(d_theta)) < self._tolerance:
+                break
+            if time.perf_counter() - start_time > self._max_time:
+                break
+        return (t[0], t[1], math.degrees(theta)), residual, iterations
+
+
+    def update(self, distances):
+        """ Matches a scan against the previous one and accumulates the pose.
+            Returns the motion since the previous scan (dx, dy, dtheta) or None. """
+        points = self.to_points(distances)
+        ref, self._ref = self._ref, points
+        if ref is None or len(ref) < self._min_points:
+            return None
+        motion, _, _ = self.match(ref, points)
+        if motion is not None:
+            a = math.radians(self._pose[2])
+            self._pose[0] += motion[0] * math.cos(a) - motion[1] * math.sin(a)
+            self._pose[1] += motion[0] * math.sin(a) + motion[1] * math.cos(a)
+            self._pose[2] = (self._pose[2] + motion[2]) % 360
+        return motion
+
+
+    @property
+    def pose(self):
+        """ accumulated pose: x, y (mm) and heading (degree) """
+        return tuple(self._pose)
@@ -4,6 +4,7 @@ SLW - June-2023
 """
 
 import time
+import struct
 import network
 import socket
 from machine import I2C, Pin, ADC, Timer
@@ -12,6 +13,17 @@ from lcd_i2c import LCD
 
 __version__ = '20230624'
 
+# Binary data packets: request b'b' + version + sequence number,
+# response version, sequence number, time (ms), buttons, adc x, adc y
+PACKET_VERSION = 1
+PACKET_FORMAT = '<BHIBHH'
+# Streaming: request b's' + version, rate (Hz), flags, lease (s); b'u' ends it.
+# Packets are sent at the rate (flag 1: only on change, at least every
+# STREAM_KEEPALIVE ms) until the lease expires, the Raspi renews it.
+STREAM_ON_CHANGE = 1
+STREAM_KEEPALIVE = 200
+ADC_DEADBAND = 4
+
 #---------------------------------------------------------------------------    
 def lcd_print(txt):
     lcd.set_cursor(col=0, row=0)
@@ -164,6 +176,56 @@ def connect_to_wlan(ssid_file):
     return server_ip_addr
 
 
+#---------------------------------------------------------------------------
+def read_buttons():
+    return ((bt_blue.value() == 0)     << 0)  |  \
+           ((bt_green.value() == 0)    << 1)  |  \
+           ((bt_yellow.value() == 0)   << 2)  |  \
+           ((bt_red.value() == 0)      << 3)  |  \
+           ((bt_joystick.value() == 0) << 4)
+
+
+#---------------------------------------------------------------------------
+def send_data(seq, buttons, x, y, addr):
+    struct.pack_into(PACKET_FORMAT, packet, 0, PACKET_VERSION, seq,
+                     time.ticks_ms() & 0xFFFFFFFF, buttons, x, y)
+    server_socket.sendto(packet, addr)
+
+
+#---------------------------------------------------------------------------
+def subscribe(message, addr):
+    """ Starts or renews the stream to addr """
+    global stream_addr, stream_period, stream_on_change, stream_end
+    if len(message) < 5 or message[1] != PACKET_VERSION:
+        return
+    stream_addr = addr
+    stream_period = 1000 // max(message[2], 1)
+    stream_on_change = (message[3] & STREAM_ON_CHANGE) != 0
+    stream_end = time.ticks_add(time.ticks_ms(), message[4] * 1000)
+
+
+#---------------------------------------------------------------------------
+def stream_data():
+    """ Sends a packet to the subscriber when the next period is due """
+    global stream_addr, stream_seq, stream_next, stream_last, stream_sent
+    now = time.ticks_ms()
+    if time.ticks_diff(now, stream_end) > 0:
+        stream_addr = None      # lease expired
+        return
+    if time.ticks_diff(now, stream_next) < 0:
+        return
+    stream_next = time.ticks_add(now, stream_period)
+    state = (read_buttons(), adcx.read_u16() // 64, adcy.read_u16() // 64)
+    if stream_on_change and time.ticks_diff(now, stream_sent) < STREAM_KEEPALIVE and \
+       state[0] == stream_last[0] and abs(state[1] - stream_last[1]) <= ADC_DEADBAND and \
+       abs(state[2] - stream_last[2]) <= ADC_DEADBAND:
+        return
+    stream_seq = (stream_seq + 1) & 0xFFFF
+    send_data(stream_seq, state[0], state[1], state[2], stream_addr)
+    stream_last, stream_sent = state, now
+    led_green.toggle()
+
+
 #---------------------------------------------------------------------------
 def timer_interrupt(tim):
     """ Manage lcd backlight """
@@ -238,6 +300,14 @@ lcd_print("Ready on port " +  config['port'])
 # Initialze ADC
 adcx = ADC(0)
 adcy = ADC(1)
+packet = bytearray(struct.calcsize(PACKET_FORMAT))
+
+# Stream state
+stream_addr = None
+stream_period, stream_on_change = 50, False
+stream_end = stream_next = stream_sent = time.ticks_ms()
+stream_seq = 0
+stream_last = (0, 0, 0)
 
 # Start periodic timer 
 tim = Timer(mode=Timer.PERIODIC, period=250, callback=timer_interrupt)
@@ -245,14 +315,25 @@ tim = Timer(mode=Timer.PERIODIC, period=250, callback=timer_interrupt)
 # main loop 
 try:
     while True:
-        message, addr = server_socket.recvfrom(1024)
-        if message[0] == ord('d'):   # read data
-            buttons = ((bt_blue.value() == 0)     << 0)  |  \
-                      ((bt_green.value() == 0)    << 1)  |  \
-                      ((bt_yellow.value() == 0)   << 2)  |  \
-                      ((bt_red.value() == 0)      << 3)  |  \
-                      ((bt_joystick.value() == 0) << 4)
-            response = str(buttons) + ',' + str(adcx.read_u16() // 64) + ',' + str(adcy.read_u16() // 64)
+        # wait for messages, but only shortly while streaming
+        server_socket.settimeout(None if stream_addr is None else 0.005)
+        try:
+            message, addr = server_socket.recvfrom(1024)
+        except OSError:
+            message = b''
+        if stream_addr is not None:
+            stream_data()
+        if not message:
+            continue
+        if message[0] == ord('b') and len(message) >= 4:   # read data, binary packet
+            seq = message[2] | (message[3] << 8)
+            send_data(seq, read_buttons(), adcx.read_u16() // 64, adcy.read_u16() // 64, addr)
+        elif message[0] == ord('s'):   # start or renew the stream
+            subscribe(message, addr)
+        elif message[0] == ord('u'):   # end the stream
+            stream_addr = None
+        elif message[0] == ord('d'):   # read data, ASCII
+            response = str(read_buttons()) + ',' + str(adcx.read_u16() // 64) + ',' + str(adcy.read_u16() // 64)
             server_socket.sendto(response, addr)
         elif message[0] == ord('t'):   # print message to display
             lcd_print(message[1:].decode('UTF-8'))
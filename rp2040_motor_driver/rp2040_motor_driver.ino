@@ -25,6 +25,28 @@
 // Decode input from serial interface
 #define VALID_LIMIT 999999
 
+// Status events (enabled by "PE1"): a change of the battery status is pushed
+// unsolicited, as ASCII line "!BS<voltage>,<status>" or as FRAME_STATUS_EVENT.
+
+// Binary frames (negotiated by the command "PB", "PA" returns to ASCII lines)
+// SOF | LEN | TAG | PAYLOAD (LEN bytes) | CRC16 (low byte first)
+// TAG: frame type (bits 7..6) and sequence number (bits 5..0).
+// CRC-16/CCITT (poly 0x1021, init 0xFFFF) over LEN, TAG and PAYLOAD.
+// A response has the same TAG as the request.
+#define FRAME_SOF         0xA5
+#define FRAME_STATUS_EVENT 0     // sent unsolicited (SEQ 0) on a status change, payload as status
+#define FRAME_ASCII       1      // payload: command line, response: response line
+#define FRAME_MOTOR       2      // payload: flags, rpm a (uint16), rpm b (uint16), response: empty
+#define FRAME_STATUS      3      // no payload, response: voltage (uint16, 10 mV), status
+#define FRAME_SEQ_MASK    0x3F
+#define FRAME_HEADER      3
+#define FRAME_MAX_PAYLOAD BUF_SIZE
+// flags of a motor frame
+#define MOTOR_DIR_A       0x01
+#define MOTOR_DIR_B       0x02
+#define MOTOR_POWER_A     0x04
+#define MOTOR_POWER_B     0x08
+
 // Global variables
 LCD_Display display;
 Motors motors;
@@ -34,6 +56,87 @@ int buf_pnt=0;
 int i = 0;
 volatile uint8_t job_flags = 0b00000000;
 int power_down_bt_status = 0;
+bool binary_mode = false;
+bool requested_binary_mode = false;     // applied after the response is sent
+uint8_t frame[FRAME_HEADER + FRAME_MAX_PAYLOAD + 2];
+int frame_pnt = 0;
+uint32_t frame_error_cnt = 0;
+char reply_buf[2 * BUF_SIZE + 16];
+int reply_pnt = 0;
+bool events_enabled = false;
+uint8_t event_status = 0xFF;            // status sent by the last event
+
+
+//-------------------------------------------------------------------------
+// Sends a response text. In binary mode the text is collected in the reply
+// buffer and sent as one frame after the command has been decoded.
+void reply(const char *s) {
+  if (!binary_mode) {
+    uart_puts(uart1, s);
+    return;
+  }
+  while ((*s != '\0') && (reply_pnt < (int) sizeof(reply_buf) - 1)) {
+    reply_buf[reply_pnt++] = *s++;
+  }
+  reply_buf[reply_pnt] = '\0';
+}
+
+//-------------------------------------------------------------------------
+// CRC-16/CCITT, no lookup table to save flash
+uint16_t crc16(const uint8_t *data, int len) {
+  uint16_t crc = 0xFFFF;
+
+  while (len-- > 0) {
+    crc ^= (uint16_t) *data++ << 8;
+    for (int j = 0; j < 8; j++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+//-------------------------------------------------------------------------
+void send_frame(uint8_t seq, uint8_t type, const uint8_t *payload, uint8_t len) {
+  uint8_t out[FRAME_HEADER + sizeof(reply_buf) + 2];
+  uint16_t crc;
+
+  if (len > sizeof(reply_buf)) len = sizeof(reply_buf);
+  out[0] = FRAME_SOF;
+  out[1] = len;
+  out[2] = (type << 6) | (seq & FRAME_SEQ_MASK);
+  memcpy(out + FRAME_HEADER, payload, len);
+  crc = crc16(out + 1, FRAME_HEADER - 1 + len);
+  out[FRAME_HEADER + len] = crc & 0xFF;
+  out[FRAME_HEADER + len + 1] = crc >> 8;
+  uart_write_blocking(uart1, out, FRAME_HEADER + len + 2);
+}
+
+//-------------------------------------------------------------------------
+// Adds a byte from the serial interface to the frame buffer.
+// Returns true when a complete frame with a valid CRC has been received.
+// Invalid frames are dropped, the sender detects the missing response.
+bool add_to_frame(uint8_t c) {
+  int len;
+  uint16_t crc;
+
+  if ((frame_pnt == 0) && (c != FRAME_SOF)) return false;   // wait for start of frame
+  if ((frame_pnt == 1) && (c > FRAME_MAX_PAYLOAD)) {
+    frame_pnt = 0;
+    frame_error_cnt++;
+    return false;
+  }
+  frame[frame_pnt++] = c;
+  if (frame_pnt < FRAME_HEADER) return false;
+  len = frame[1];
+  if (frame_pnt < FRAME_HEADER + len + 2) return false;
+  frame_pnt = 0;
+  crc = crc16(frame + 1, FRAME_HEADER - 1 + len);
+  if ((frame[FRAME_HEADER + len] != (crc & 0xFF)) || (frame[FRAME_HEADER + len + 1] != (crc >> 8))) {
+    frame_error_cnt++;
+    return false;
+  }
+  return true;
+}
 
 
 //-------------------------------------------------------------------------
@@ -100,30 +203,30 @@ void decode_bat_command(uint8_t pnt) {
     case 'v':               // get battery voltage
     case 'V':
       itoaf(bat.get_voltage(), local_buf, 4, 2, false);
-      uart_puts(uart1, local_buf); 
+      reply(local_buf); 
       break;
 
     case 's':               // get battery status
     case 'S':
       bat.get_full_status(local_buf);
-      uart_puts(uart1, local_buf);
+      reply(local_buf);
       break;
 
     case 'x':
     case 'X':
       display.print_msg("Shutting down");
       bat.start_shutdown();
-      uart_puts(uart1, "OK");
+      reply("OK");
       break;
  
     default:
       okay = false;
   }
   if (!okay) {
-      uart_puts(uart1, "Battery command not recognized: ");
-      uart_puts(uart1, buf);
+      reply("Battery command not recognized: ");
+      reply(buf);
   }
-  uart_puts(uart1, "\r\n");
+  reply("\r\n");
 }
 
 //-------------------------------------------------------------------------
@@ -150,12 +253,12 @@ void decode_display_command(uint8_t pnt) {
       okay = false;
   }
   if (okay) {
-    uart_puts(uart1, "OK");
+    reply("OK");
   } else {
-      uart_puts(uart1, "Display command not recognized: ");
-      uart_puts(uart1, buf);
+      reply("Display command not recognized: ");
+      reply(buf);
   }
-  uart_puts(uart1, "\r\n");
+  reply("\r\n");
 }
 
 //-------------------------------------------------------------------------
@@ -216,11 +319,11 @@ void decode_motor_command(uint8_t pnt) {
       if (a < VALID_LIMIT) {
         if (a < MOT_STEP_TIME_MIN) {
           a = MOT_STEP_TIME_MIN;
-          uart_puts(uart1, "Mot A: Lower limit\n\r");
+          reply("Mot A: Lower limit\n\r");
         }
         else if (a > MOT_STEP_TIME_MAX) {
           a = MOT_STEP_TIME_MAX;
-          uart_puts(uart1, "Mot A: Upper limit\n\r");
+          reply("Mot A: Upper limit\n\r");
         }
         mot_a_step_time_target = a;  
         display.mot_a_rpm(CONVERSION_FACTOR / a);  
@@ -228,10 +331,10 @@ void decode_motor_command(uint8_t pnt) {
       if (b < VALID_LIMIT) {
         if (b < MOT_STEP_TIME_MIN) {
           b = MOT_STEP_TIME_MIN;
-          uart_puts(uart1, "Mot B: Lower limit\n\r");
+          reply("Mot B: Lower limit\n\r");
         }
         else if (b > MOT_STEP_TIME_MAX) {
-          uart_puts(uart1, "Mot B: Upper limit\n\r");
+          reply("Mot B: Upper limit\n\r");
           b = MOT_STEP_TIME_MAX;
         }
         mot_b_step_time_target = b; 
@@ -263,12 +366,43 @@ void decode_motor_command(uint8_t pnt) {
       okay = false;
   }
   if (okay) {
-    uart_puts(uart1, "OK");
+    reply("OK");
   } else {
-    uart_puts(uart1, "Motor command not recognized: ");
-    uart_puts(uart1, buf);
+    reply("Motor command not recognized: ");
+    reply(buf);
+  }
+  reply("\r\n");
+}
+
+//-------------------------------------------------------------------------
+// Protocol selection: "PB" binary frames, "PA" ASCII lines
+void decode_protocol_command(uint8_t pnt) {
+  switch (buf[pnt]) {
+    case 'b':
+    case 'B':
+      requested_binary_mode = true;
+      reply("OK,BIN1");
+      break;
+
+    case 'a':
+    case 'A':
+      requested_binary_mode = false;
+      reply("OK");
+      break;
+
+    case 'e':
+    case 'E':
+      pnt += 1;
+      events_enabled = get_int(&pnt) > 0;
+      event_status = 0xFF;              // the next event reports the current status
+      reply("OK");
+      break;
+
+    default:
+      reply("Protocol command not recognized: ");
+      reply(buf);
   }
-  uart_puts(uart1, "\r\n");
+  reply("\r\n");
 }
 
 //-------------------------------------------------------------------------
@@ -277,7 +411,7 @@ void decode_command(void) {
 
   while (buf[pnt] == ' ') pnt += 1;     // skip leading blanks
   if (strlen(buf+pnt) == 0) {
-    uart_puts(uart1, "\r\n");
+    reply("\r\n");
     return;
   }
   
@@ -294,13 +428,99 @@ void decode_command(void) {
     case 'M':
       decode_motor_command(pnt+1);
       break;
+    case 'p':
+    case 'P':
+      decode_protocol_command(pnt+1);
+      break;
     default:
-      uart_puts(uart1, "Not recognized: ");
-      uart_puts(uart1, buf);
-      uart_puts(uart1, "\r\n");
+      reply("Not recognized: ");
+      reply(buf);
+      reply("\r\n");
   }  
 }    
 
+//-------------------------------------------------------------------------
+// Decodes a valid frame and sends the response frame
+void decode_frame(void) {
+  uint8_t len = frame[1], seq = frame[2] & FRAME_SEQ_MASK, type = frame[2] >> 6;
+  uint8_t *payload = frame + FRAME_HEADER;
+  uint8_t response[3];
+  uint16_t rpm_a, rpm_b;
+  int16_t voltage;
+
+  switch (type) {
+    case FRAME_ASCII:               // command line, same as in ASCII mode
+      if (len >= BUF_SIZE) len = BUF_SIZE - 1;
+      memcpy(buf, payload, len);
+      buf[len] = '\0';
+      reply_pnt = 0;
+      reply_buf[0] = '\0';
+      decode_command();
+      // the frame marks the end of the response, no line end needed
+      while ((reply_pnt > 0) && ((reply_buf[reply_pnt-1] == '\r') || (reply_buf[reply_pnt-1] == '\n')))
+        reply_pnt--;
+      send_frame(seq, FRAME_ASCII, (uint8_t *) reply_buf, reply_pnt);
+      break;
+
+    case FRAME_MOTOR:               // dir, power and rpm of both motors at once
+      if (len != 5) {
+        response[0] = 1;              // error code
+        send_frame(seq, FRAME_MOTOR, response, 1);
+        break;
+      }
+      rpm_a = payload[1] | (payload[2] << 8);
+      rpm_b = payload[3] | (payload[4] << 8);
+      motors.set_a_dir(payload[0] & MOTOR_DIR_A);
+      motors.set_b_dir(payload[0] & MOTOR_DIR_B);
+      motors.set_a_power(payload[0] & MOTOR_POWER_A);
+      motors.set_b_power(payload[0] & MOTOR_POWER_B);
+      motors.set_a_rpm(rpm_a);
+      motors.set_b_rpm(rpm_b);
+      display.mot_a_rpm(motors.get_a_rpm());
+      display.mot_a_enabled(motors.get_a_enabled());
+      display.mot_a_power(motors.get_a_power());
+      display.mot_b_rpm(motors.get_b_rpm());
+      display.mot_b_enabled(motors.get_b_enabled());
+      display.mot_b_power(motors.get_b_power());
+      send_frame(seq, FRAME_MOTOR, response, 0);
+      break;
+
+    case FRAME_STATUS:              // battery voltage and status
+      voltage = bat.get_voltage();
+      response[0] = voltage & 0xFF;
+      response[1] = voltage >> 8;
+      response[2] = bat.get_status();
+      send_frame(seq, FRAME_STATUS, response, 3);
+      break;
+
+    default:                        // unknown type: empty response of the same type
+      send_frame(seq, type, response, 0);
+  }
+}
+
+//-------------------------------------------------------------------------
+// Pushes the battery status if it changed since the last event
+void send_status_event(void) {
+  char local_buf[16];
+  uint8_t payload[3];
+  int16_t voltage;
+
+  if (!events_enabled || (bat.get_status() == event_status)) return;
+  event_status = bat.get_status();
+  if (binary_mode) {
+    voltage = bat.get_voltage();
+    payload[0] = voltage & 0xFF;
+    payload[1] = voltage >> 8;
+    payload[2] = event_status;
+    send_frame(0, FRAME_STATUS_EVENT, payload, 3);
+  } else {
+    bat.get_full_status(local_buf);
+    uart_puts(uart1, "!BS");
+    uart_puts(uart1, local_buf);
+    uart_puts(uart1, "\r\n");
+  }
+}
+
 //-------------------------------------------------------------------------
 void setup() {
   // initialize power management
@@ -341,8 +561,15 @@ void loop() {
   char local_buf[16];
   
   if (uart_is_readable(uart1)) {
-    if (add_to_buffer(uart_getc(uart1)) == true) {
+    if (binary_mode) {
+      if (add_to_frame(uart_getc(uart1)) == true) {
+        decode_frame();
+        binary_mode = requested_binary_mode;
+      }
+    } else if (add_to_buffer(uart_getc(uart1)) == true) {
       decode_command();
+      binary_mode = requested_binary_mode;
+      frame_pnt = 0;
     }
   }
 
@@ -355,5 +582,6 @@ void loop() {
     }
     motors.check_step_time_a();
     motors.check_step_time_b();
+    send_status_event();
   }
 }